@@ -19,6 +19,8 @@ from app.models.user import User
 from app.models.cases import CaseModel
 from app.security.security import get_password_hash
 from app.routes import auth, cases, ml  # ⚠️ если внутри cases есть weaviate — см. примечание ниже
+from app.ml.generator import open_generator_client, close_generator_client, start_protocol_negotiation
+from app.ml.ingest import shutdown_ingest_pool
 
 # 🔧 env
 load_dotenv()
@@ -74,10 +76,14 @@ async def lifespan(app: FastAPI):
     logger.info("🔄 Инициализация приложения (без Weaviate)...")
     # старт
     bootstrap_default_user_and_case()
+    await open_generator_client()
+    start_protocol_negotiation()
     try:
         yield
     finally:
         logger.info("🛑 Завершение работы приложения...")
+        await close_generator_client()
+        shutdown_ingest_pool()
 
 app = FastAPI(lifespan=lifespan)
 
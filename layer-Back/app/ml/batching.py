@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
-from typing import Dict, List, Any, Set, Tuple
-from .config import BATCH_MAX_FILES, BATCH_MAX_TOKENS
+import math
+from typing import Dict, List, Any, Optional, Set, Tuple
+from .config import BATCH_MAX_FILES, BATCH_MAX_TOKENS, BATCH_PACKING
 from .chunking import tokens_stats
 from .config import logger
 
@@ -35,6 +36,115 @@ def build_batches_for_docs(
     if cur: batches.append(cur)
     return batches
 
+def _ffd(items: List[Tuple[int, int, int, List[Dict[str, Any]]]], max_files: int, max_tokens_in: int) -> List[List[Any]]:
+    """
+    First-fit decreasing: items (токены, файлы, позиция, документы) по убыванию размера кладутся
+    в первый батч, где хватает места и по токенам, и по файлам. Предмет больше лимита идёт один.
+    Возвращает батчи [токены, файлы, документы].
+    """
+    bins: List[List[Any]] = []
+    for toks, files, _, docs in sorted(items, key=lambda it: (-it[0], -it[1], it[2])):
+        for b in bins:
+            if b[0] + toks <= max_tokens_in and b[1] + files <= max_files:
+                b[0] += toks; b[1] += files; b[2].extend(docs)
+                break
+        else:
+            bins.append([toks, files, list(docs)])
+    return bins
+
+def pack_batches_for_docs(
+    docs_map: Dict[str, List[Dict[str, Any]]],
+    doc_order: List[str],
+    max_files: int,
+    max_tokens_in: int,
+    include_chunks: Dict[str, List[int]],
+    clusters: Optional[List[List[str]]] = None,
+    report: Optional[Dict[str, Any]] = None,
+) -> List[List[Dict[str, Any]]]:
+    """
+    Упаковка документов в минимум батчей (first-fit decreasing) под оба лимита — в отличие от
+    build_batches_for_docs, которая закрывает батч при первом переполнении и оставляет его полупустым.
+    - кластер (cluster_docs_by_markers), влезающий в один батч, пакуется как один предмет;
+      больший кластер сначала раскладывается FFD на свои куски, дальше пакуются куски;
+    - если раскладка без учёта кластеров или последовательное заполнение дают меньше батчей —
+      берётся она (меньше вызовов важнее);
+    - внутри батча и между батчами сохраняется порядок doc_order (соседи по кластеру рядом).
+    report (если передан) — нижняя граница числа батчей, выбранная стратегия, разорванные кластеры,
+    заполнение каждого батча по токенам/файлам.
+    """
+    pos = {doc_id: i for i, doc_id in enumerate(doc_order)}
+    entries: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+    for doc_id in doc_order:
+        idxs = include_chunks.get(doc_id, [])
+        if not idxs:
+            continue
+        take = [docs_map[doc_id][i] for i in idxs]
+        entries[doc_id] = (sum(ch["n_tokens"] for ch in take), {"doc_id": doc_id, "chunks": take})
+
+    def doc_item(doc_id: str) -> Tuple[int, int, int, List[Dict[str, Any]]]:
+        return entries[doc_id][0], 1, pos[doc_id], [entries[doc_id][1]]
+
+    groups: List[List[str]] = []
+    seen: Set[str] = set()
+    for cluster in clusters or []:
+        g = sorted((d for d in cluster if d in entries and d not in seen), key=pos.__getitem__)
+        if g:
+            groups.append(g); seen.update(g)
+    groups += [[d] for d in entries if d not in seen]
+
+    grouped_items: List[Tuple[int, int, int, List[Dict[str, Any]]]] = []
+    for g in groups:
+        toks = sum(entries[d][0] for d in g)
+        if len(g) <= max_files and toks <= max_tokens_in:
+            grouped_items.append((toks, len(g), pos[g[0]], [entries[d][1] for d in g]))
+        else:
+            for b_toks, b_files, b_docs in _ffd([doc_item(d) for d in g], max_files, max_tokens_in):
+                grouped_items.append((b_toks, b_files, min(pos[d["doc_id"]] for d in b_docs), b_docs))
+    # кандидаты в порядке предпочтения; берётся первый с минимумом батчей
+    # (FFD под двумя лимитами не всегда лучше последовательного заполнения)
+    candidates = [("clusters", [b[2] for b in _ffd(grouped_items, max_files, max_tokens_in)])]
+    if len(groups) < len(entries):
+        candidates.append(("flat", [b[2] for b in _ffd([doc_item(d) for d in entries], max_files, max_tokens_in)]))
+    candidates.append(("sequential", build_batches_for_docs(docs_map, doc_order, max_files, max_tokens_in, include_chunks)))
+    strategy, chosen = min(candidates, key=lambda c: len(c[1]))
+
+    batches = [sorted(b, key=lambda d: pos[d["doc_id"]]) for b in chosen]
+    batches.sort(key=lambda b: pos[b[0]["doc_id"]])
+
+    if report is not None:
+        total = sum(t for t, _ in entries.values())
+        batch_of = {d["doc_id"]: i for i, b in enumerate(batches) for d in b}
+        report["strategy"] = strategy
+        report["sequential"] = len(candidates[-1][1])
+        report["lower_bound"] = max(math.ceil(total / max_tokens_in), math.ceil(len(entries) / max_files)) if entries else 0
+        report["split_clusters"] = sum(1 for g in groups if len({batch_of[d] for d in g}) > 1)
+        report["batches"] = [{
+            "docs": [d["doc_id"] for d in b],
+            "tokens": sum(entries[d["doc_id"]][0] for d in b),
+            "fill_tokens": round(sum(entries[d["doc_id"]][0] for d in b) / max_tokens_in, 3),
+            "fill_files": round(len(b) / max_files, 3),
+        } for b in batches]
+    return batches
+
+def plan_batches(
+    docs_map: Dict[str, List[Dict[str, Any]]],
+    doc_order: List[str],
+    max_files: int,
+    max_tokens_in: int,
+    include_chunks: Dict[str, List[int]],
+    clusters: Optional[List[List[str]]] = None,
+    title: str = "",
+) -> List[List[Dict[str, Any]]]:
+    """Батчи прохода по BATCH_PACKING (ffd | sequential)."""
+    if BATCH_PACKING != "ffd":
+        return build_batches_for_docs(docs_map, doc_order, max_files, max_tokens_in, include_chunks)
+    report: Dict[str, Any] = {}
+    batches = pack_batches_for_docs(docs_map, doc_order, max_files, max_tokens_in, include_chunks, clusters, report)
+    if batches:
+        logger.info(f"[BATCH] {title}: packed {len(batches)} batches ({report['strategy']}, sequential fill {report['sequential']}, "
+                    f"lower bound {report['lower_bound']}), split clusters={report['split_clusters']}")
+    return batches
+
 def plan_pass1(docs_map: Dict[str, List[Dict[str, Any]]], per_doc_cap: int) -> Dict[str, List[int]]:
     plan: Dict[str, List[int]] = {}
     for doc_id, chunks in docs_map.items():
@@ -59,9 +169,11 @@ def plan_pass2(docs_map: Dict[str, List[Dict[str, Any]]], used_set: Set[Tuple[st
         if acc: plan[doc_id] = acc
     return plan
 
-def log_batches_overview(batches: List[List[Dict[str, Any]]], title: str):
-    logger.info(f"[BATCH] {title}: построено батчей: {len(batches)}")
-    for i, b in enumerate(batches, 1):
+def log_batches_overview(batches: List[List[Dict[str, Any]]], title: str, max_tokens_in: int = BATCH_MAX_TOKENS):
+    fills = [sum(ch["n_tokens"] for d in b for ch in d["chunks"]) / max_tokens_in for b in batches]
+    mean_fill = f"{100.0 * sum(fills) / len(fills):.0f}%" if fills else "-"
+    logger.info(f"[BATCH] {title}: построено батчей: {len(batches)}, среднее заполнение по токенам: {mean_fill}")
+    for i, (b, fill) in enumerate(zip(batches, fills), 1):
         toks = [ch["n_tokens"] for d in b for ch in d["chunks"]]
         doc_ids = [d["doc_id"] for d in b]
-        logger.info(f"[BATCH {title} {i}] файлов: {len(b)}, чанков: {sum(len(d['chunks']) for d in b)}, токены: {tokens_stats(toks)}, docs={doc_ids}")
+        logger.info(f"[BATCH {title} {i}] файлов: {len(b)}, чанков: {sum(len(d['chunks']) for d in b)}, токены: {tokens_stats(toks)}, заполнение: {100.0 * fill:.0f}%, docs={doc_ids}")
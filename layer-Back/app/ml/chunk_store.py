@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Бинарное хранилище чанков дела (storage/docs/<case>/chunkstore).
+- index-<gen>.bin — массив записей фиксированного размера (_REC): doc_id, chunk_id, section_id,
+  doc_type, heading, n_tokens, страницы, смещение/длина текста, sha1 текста;
+- text-<gen>.bin — тексты чанков подряд (UTF-8), читаются через mmap по смещению;
+- meta.json — поколение, валидные длины файлов, таблицы строк (doc_type/heading/title)
+  и отпечатки исходных .jsonl. Пишется последним (tmp + rename), поэтому недописанный
+  хвост index/text после сбоя просто не виден.
+JSONL остаётся форматом записи ingest'а (по файлу на документ, атомарно); хранилище —
+скомпилированное представление для чтения: при первом обращении строится из JSONL,
+новые документы дописываются, изменённые/удалённые — полная пересборка.
+"""
+from __future__ import annotations
+
+import os
+import json
+import mmap
+import struct
+import hashlib
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import logger
+from .io_utils import storage_paths
+
+# doc_id, chunk_id, section_id, doc_type, heading, n_tokens, source_page, page_end, offset, length, sha1
+_REC = struct.Struct("<IIIIIIiiQI20s")
+_NONE_IDX = 0xFFFFFFFF
+_NO_PAGE = -1
+_VERSION = 2  # 2: doc_type — uint32 (как heading), иначе _NONE_IDX в нём недостижим
+
+_locks: Dict[int, threading.Lock] = {}
+_locks_guard = threading.Lock()
+
+def _case_lock(case_id: int) -> threading.Lock:
+    with _locks_guard:
+        return _locks.setdefault(case_id, threading.Lock())
+
+def _source_fingerprints(chunks_dir: Path) -> Dict[str, List[int]]:
+    out: Dict[str, List[int]] = {}
+    if chunks_dir.exists():
+        for fn in chunks_dir.glob("*.jsonl"):
+            st = fn.stat()
+            out[fn.stem] = [st.st_mtime_ns, st.st_size]
+    return out
+
+class _Builder:
+    """Дописывает документы из JSONL в index/text текущего поколения."""
+    def __init__(self, root: Path, meta: Dict[str, Any]):
+        self.root = root
+        self.meta = meta
+        self._strings = {name: {s: i for i, s in enumerate(meta[name])} for name in ("doc_types", "headings")}
+
+    def _intern(self, name: str, s: Optional[str]) -> int:
+        if s is None:
+            return _NONE_IDX
+        table = self._strings[name]
+        if s not in table:
+            table[s] = len(self.meta[name])
+            self.meta[name].append(s)
+        return table[s]
+
+    def add_docs(self, chunks_dir: Path, doc_ids: List[str]) -> int:
+        gen = self.meta["gen"]
+        n = 0
+        with (self.root / f"index-{gen}.bin").open("r+b" if self.meta["index_bytes"] else "wb") as fi, \
+             (self.root / f"text-{gen}.bin").open("r+b" if self.meta["text_bytes"] else "wb") as ft:
+            # всё, что за валидными длинами из meta, — мусор прерванной записи
+            fi.seek(self.meta["index_bytes"]); fi.truncate()
+            ft.seek(self.meta["text_bytes"]); ft.truncate()
+            offset = self.meta["text_bytes"]
+            for doc_id in sorted(doc_ids, key=int):
+                with (chunks_dir / f"{doc_id}.jsonl").open("r", encoding="utf-8") as f:
+                    for line in f:
+                        rec = json.loads(line)
+                        data = rec["text"].encode("utf-8")
+                        sha = bytes.fromhex(rec["hash"]) if rec.get("hash") else hashlib.sha1(data).digest()
+                        sp, pe = rec.get("source_page"), rec.get("page_end")
+                        fi.write(_REC.pack(
+                            int(doc_id), int(rec["chunk_id"]), int(rec.get("section_id") or 0),
+                            self._intern("doc_types", rec.get("doc_type") or "unknown"),
+                            self._intern("headings", rec.get("heading")),
+                            int(rec["n_tokens"]),
+                            _NO_PAGE if sp is None else int(sp), _NO_PAGE if pe is None else int(pe),
+                            offset, len(data), sha,
+                        ))
+                        ft.write(data)
+                        offset += len(data)
+                        self.meta["titles"][doc_id] = rec.get("title")
+                        n += 1
+            fi.flush(); os.fsync(fi.fileno())
+            ft.flush(); os.fsync(ft.fileno())
+            self.meta["index_bytes"] = fi.tell()
+            self.meta["text_bytes"] = offset
+        return n
+
+_FIELDS = ("doc_id", "title", "chunk_id", "section_id", "doc_type", "heading", "n_tokens", "hash", "source_page", "page_end", "text")
+
+class ChunkRef:
+    """
+    Лёгкий дескриптор чанка: хранилище + номер записи. Поля читаются из индекса,
+    text — из mmap в момент обращения (не кэшируется). Поддерживает доступ как у dict
+    (ch["n_tokens"], ch.get("text", "")), поэтому батчинг/маркеры работают без изменений.
+    """
+    __slots__ = ("_store", "_i")
+
+    def __init__(self, store: "ChunkStore", i: int):
+        self._store = store
+        self._i = i
+
+    @property
+    def doc_id(self) -> str:
+        return str(self._store._recs[self._i][0])
+
+    @property
+    def title(self) -> Optional[str]:
+        return self._store.meta["titles"].get(self.doc_id)
+
+    @property
+    def chunk_id(self) -> int:
+        return self._store._recs[self._i][1]
+
+    @property
+    def section_id(self) -> int:
+        return self._store._recs[self._i][2]
+
+    @property
+    def doc_type(self) -> str:
+        dt = self._store._recs[self._i][3]
+        return self._store.meta["doc_types"][dt] if dt != _NONE_IDX else "unknown"
+
+    @property
+    def heading(self) -> Optional[str]:
+        hd = self._store._recs[self._i][4]
+        return self._store.meta["headings"][hd] if hd != _NONE_IDX else None
+
+    @property
+    def n_tokens(self) -> int:
+        return self._store._recs[self._i][5]
+
+    @property
+    def source_page(self) -> Optional[int]:
+        sp = self._store._recs[self._i][6]
+        return None if sp == _NO_PAGE else sp
+
+    @property
+    def page_end(self) -> Optional[int]:
+        pe = self._store._recs[self._i][7]
+        return None if pe == _NO_PAGE else pe
+
+    @property
+    def hash(self) -> str:
+        return self._store._recs[self._i][10].hex()
+
+    @property
+    def text(self) -> str:
+        return self._store._text_at(self._i)
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in _FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key) if key in _FIELDS else default
+
+    def __contains__(self, key: str) -> bool:
+        return key in _FIELDS
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: getattr(self, k) for k in _FIELDS}
+
+    def __repr__(self) -> str:
+        return f"ChunkRef(doc_id={self.doc_id}, chunk_id={self.chunk_id}, n_tokens={self.n_tokens})"
+
+class ChunkStore:
+    """Чтение чанков дела по (doc_id, chunk_id) без разбора JSON; текст — срез mmap."""
+    def __init__(self, root: Path, meta: Dict[str, Any]):
+        self.root = root
+        self.meta = meta
+        gen = meta["gen"]
+        self._text_file = (root / f"text-{gen}.bin").open("rb") if meta["text_bytes"] else None
+        self._mm = mmap.mmap(self._text_file.fileno(), meta["text_bytes"], access=mmap.ACCESS_READ) if self._text_file else None
+
+        with (root / f"index-{gen}.bin").open("rb") as fi:
+            raw = fi.read(meta["index_bytes"]) if meta["index_bytes"] else b""
+        self._recs: List[Tuple] = list(_REC.iter_unpack(raw))
+        self._rows: Dict[str, List[int]] = {}
+        self._pos: Dict[Tuple[str, int], int] = {}
+        for i, r in enumerate(self._recs):
+            self._rows.setdefault(str(r[0]), []).append(i)
+        for doc_id, rows in self._rows.items():
+            rows.sort(key=lambda i: self._recs[i][1])
+            for i in rows:
+                self._pos[(doc_id, self._recs[i][1])] = i
+
+    def __enter__(self) -> "ChunkStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._mm is not None:
+            self._mm.close(); self._mm = None
+        if self._text_file is not None:
+            self._text_file.close(); self._text_file = None
+
+    def __len__(self) -> int:
+        return len(self._recs)
+
+    def doc_ids(self) -> List[str]:
+        return sorted(self.meta["sources"], key=int)
+
+    def _text_at(self, i: int) -> str:
+        off, ln = self._recs[i][8], self._recs[i][9]
+        return self._mm[off:off + ln].decode("utf-8") if ln else ""
+
+    def _record(self, i: int, with_text: bool = True) -> Dict[str, Any]:
+        doc_id, chunk_id, section_id, dt, hd, n_tokens, sp, pe, _, _, sha = self._recs[i]
+        rec = {
+            "doc_id": str(doc_id),
+            "title": self.meta["titles"].get(str(doc_id)),
+            "chunk_id": chunk_id,
+            "section_id": section_id,
+            "doc_type": self.meta["doc_types"][dt] if dt != _NONE_IDX else "unknown",
+            "heading": self.meta["headings"][hd] if hd != _NONE_IDX else None,
+            "n_tokens": n_tokens,
+            "hash": sha.hex(),
+            "source_page": None if sp == _NO_PAGE else sp,
+            "page_end": None if pe == _NO_PAGE else pe,
+        }
+        if with_text:
+            rec["text"] = self._text_at(i)
+        return rec
+
+    def text(self, doc_id: str, chunk_id: int) -> str:
+        return self._text_at(self._pos[(str(doc_id), int(chunk_id))])
+
+    def get(self, doc_id: str, chunk_id: int) -> Dict[str, Any]:
+        return self._record(self._pos[(str(doc_id), int(chunk_id))])
+
+    def doc_chunks(self, doc_id: str, with_text: bool = True) -> List[Dict[str, Any]]:
+        return [self._record(i, with_text) for i in self._rows.get(str(doc_id), [])]
+
+    def doc_refs(self, doc_id: str) -> List[ChunkRef]:
+        return [ChunkRef(self, i) for i in self._rows.get(str(doc_id), [])]
+
+def _write_meta(root: Path, meta: Dict[str, Any]) -> None:
+    tmp = root / "meta.json.tmp"
+    tmp.write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, root / "meta.json")
+
+def _new_meta(gen: int) -> Dict[str, Any]:
+    return {"version": _VERSION, "gen": gen, "index_bytes": 0, "text_bytes": 0,
+            "doc_types": [], "headings": [], "titles": {}, "sources": {}}
+
+def sync_chunk_store(case_id: int) -> Dict[str, Any]:
+    """Приводит хранилище в соответствие с chunks/*.jsonl: миграция, дозапись новых документов или пересборка."""
+    paths = storage_paths(case_id)
+    root = paths["store"]
+    with _case_lock(case_id):
+        sources = _source_fingerprints(paths["chunks"])
+        try:
+            meta = json.loads((root / "meta.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            meta = None
+        if meta is not None and meta.get("version") == _VERSION and meta["sources"] == sources:
+            return meta
+
+        root.mkdir(parents=True, exist_ok=True)
+        old = meta
+        appendable = (
+            meta is not None and meta.get("version") == _VERSION
+            and all(sources.get(k) == v for k, v in meta["sources"].items())
+        )
+        if appendable:
+            new_docs = [k for k in sources if k not in meta["sources"]]
+            mode = "append"
+        else:
+            meta = _new_meta((old or {}).get("gen", 0) + 1)
+            new_docs = list(sources)
+            mode = "migrate" if old is None else "rebuild"
+
+        n = _Builder(root, meta).add_docs(paths["chunks"], new_docs)
+        meta["sources"] = {k: sources[k] for k in list(meta["sources"]) + new_docs}
+        _write_meta(root, meta)
+        if old is not None and old.get("gen") != meta["gen"]:
+            for name in (f"index-{old['gen']}.bin", f"text-{old['gen']}.bin"):
+                try:
+                    (root / name).unlink()
+                except OSError:
+                    pass
+        logger.info(f"[STORE] case_id={case_id} {mode}: docs+={len(new_docs)}, chunks+={n}, text={meta['text_bytes']}B")
+        return meta
+
+def open_chunk_store(case_id: int) -> ChunkStore:
+    meta = sync_chunk_store(case_id)
+    return ChunkStore(storage_paths(case_id)["store"], meta)
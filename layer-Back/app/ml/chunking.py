@@ -1,13 +1,17 @@
 # app/ml/chunking.py
 # -*- coding: utf-8 -*-
+import os
 import re
 import json
+import hashlib
 import statistics
-from typing import Dict, List, Any, Tuple
-import tiktoken
+from pathlib import Path
+from typing import Dict, Iterable, List, Any, Optional, Tuple
 
-from .config import CHUNK_TOKENS, CHUNK_OVERLAP, MODEL_ENCODING
-from .io_utils import storage_paths
+from .config import CHUNK_TOKENS, CHUNK_OVERLAP
+from .io_utils import get_encoder
+from .chunk_store import ChunkRef, ChunkStore
+from .markers import SCAN_VERSION, scan_chunk_text, remember_chunk_scan
 
 
 # ---------- заголовки верхнего уровня ----------
@@ -20,16 +24,44 @@ HEAD_PATTERNS: List[Tuple[re.Pattern, str]] = [
 ]
 
 
-def _split_by_headings(full_text: str) -> List[Dict[str, Any]]:
+def chunk_hash(text: str) -> str:
+    """Хэш текста чанка: одинаковый текст в разных документах/делах -> одинаковый хэш."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+Page = Tuple[Optional[int], str]  # (номер страницы с 1 | None для непостраничных файлов, текст)
+
+
+def _page_segments(lines: List[Page]) -> List[Page]:
+    """Подряд идущие строки одной страницы -> сегменты (page, text); края секции strip'аются как раньше."""
+    segs: List[Page] = []
+    for pg, ln in lines:
+        if segs and segs[-1][0] == pg:
+            segs[-1] = (pg, segs[-1][1] + "\n" + ln)
+        else:
+            segs.append((pg, ln))
+    while segs and not segs[0][1].strip():
+        segs.pop(0)
+    while segs and not segs[-1][1].strip():
+        segs.pop()
+    if segs:
+        segs[0] = (segs[0][0], segs[0][1].lstrip())
+        segs[-1] = (segs[-1][0], segs[-1][1].rstrip())
+    return segs
+
+
+def _split_pages_by_headings(pages: List[Page], continued: bool = False) -> List[Dict[str, Any]]:
     """
-    Разбиваем исходный текст на секции по верхним заголовкам.
-    Возвращаем список секций: [{"heading": str|None, "doc_type": str, "text": str}, ...]
-    Если заголовков нет — одна секция с doc_type="unknown".
+    Разбиваем поток страниц на секции по верхним заголовкам.
+    Возвращаем список секций: [{"heading": str|None, "doc_type": str, "segments": [(page, text), ...]}, ...]
+    Если заголовков нет — одна секция с doc_type="unknown" (страницы как есть).
+    continued=True — страницы продолжают документ (не первый диапазон): текст до первого
+    заголовка — хвост секции предыдущего диапазона, секция с doc_type=None.
     """
-    lines = full_text.splitlines()
+    lines: List[Page] = [(pg, ln) for pg, txt in pages for ln in txt.splitlines()]
     hits: List[Tuple[int, str, str]] = []  # (line_idx, heading_text, doc_type)
 
-    for i, ln in enumerate(lines):
+    for i, (_, ln) in enumerate(lines):
         for rx, dtype in HEAD_PATTERNS:
             if rx.match(ln):
                 # Берём целиком строку как "heading"
@@ -38,38 +70,49 @@ def _split_by_headings(full_text: str) -> List[Dict[str, Any]]:
                 break
 
     if not hits:
-        return [{"heading": None, "doc_type": "unknown", "text": full_text}]
+        return [{"heading": None, "doc_type": None if continued else "unknown", "segments": list(pages)}]
 
     # Закрываем интервалы секций
     sections: List[Dict[str, Any]] = []
+    if continued and hits[0][0] > 0:
+        sections.append({"heading": None, "doc_type": None, "segments": _page_segments(lines[:hits[0][0]])})
     for j, (start_idx, heading, dtype) in enumerate(hits):
         end_idx = hits[j + 1][0] if j + 1 < len(hits) else len(lines)
-        body = "\n".join(lines[start_idx:end_idx]).strip()
-        sections.append({"heading": heading, "doc_type": dtype, "text": body})
+        sections.append({"heading": heading, "doc_type": dtype, "segments": _page_segments(lines[start_idx:end_idx])})
 
     return sections
 
 
-def chunk_text(
-    text: str,
+def chunk_pages(
+    pages: Iterable[Page],
     chunk_tokens: int = CHUNK_TOKENS,
-    overlap_tokens: int = CHUNK_OVERLAP
+    overlap_tokens: int = CHUNK_OVERLAP,
+    continued: bool = False
 ) -> List[Dict[str, Any]]:
     """
-    Чанкинг с учётом верхних заголовков:
+    Чанкинг с учётом верхних заголовков и страниц:
     1) сначала режем документ на секции по заголовкам (ПОСТАНОВЛЕНИЕ/ПРОТОКОЛ/Р А П О Р Т/УВЕДОМЛЕНИЕ),
     2) затем каждую секцию нарезаем по токенам с перекрытием.
-    В метаданные каждого чанка кладём: doc_type, heading, section_id.
+    В метаданные каждого чанка кладём: doc_type, heading, section_id,
+    hash — chunk_hash текста, source_page/page_end — страницы первого и последнего токена
+    (None для непостраничных файлов).
+    continued=True — см. _split_pages_by_headings: у чанков хвоста предыдущей секции doc_type=None,
+    section_id/heading им проставляет сборка документа (ingest.build_document).
     """
-    enc = tiktoken.get_encoding(MODEL_ENCODING)
-    sections = _split_by_headings(text)
+    enc = get_encoder()
+    sections = _split_pages_by_headings(list(pages), continued)
 
     chunks: List[Dict[str, Any]] = []
     global_idx = 0
 
     for section_id, sec in enumerate(sections):
-        sec_text = sec["text"]
-        ids = enc.encode(sec_text)
+        segs = sec["segments"]
+        ids: List[int] = []
+        tok_pages: List[Optional[int]] = []
+        for k, (pg, seg) in enumerate(segs):
+            seg_ids = enc.encode(seg + ("\n" if k < len(segs) - 1 else ""))
+            ids.extend(seg_ids)
+            tok_pages.extend([pg] * len(seg_ids))
 
         start = 0
         while start < len(ids):
@@ -84,6 +127,9 @@ def chunk_text(
                 "heading": sec["heading"],
                 "text": sub_txt,
                 "n_tokens": len(sub_ids),
+                "hash": chunk_hash(sub_txt),
+                "source_page": tok_pages[start],
+                "page_end": tok_pages[end - 1],
             })
             global_idx += 1
 
@@ -105,25 +151,64 @@ def tokens_stats(items: List[int]) -> str:
     )
 
 
-def load_doc_chunks(case_id: int) -> Dict[str, List[Dict[str, Any]]]:
+def load_doc_refs(store: ChunkStore) -> Dict[str, List[ChunkRef]]:
+    """
+    Детерминированная загрузка чанков без текста в памяти: документы по возрастанию doc_id,
+    внутри документа чанки по chunk_id; дескрипторы ChunkRef, текст читается из mmap хранилища
+    при рендере промпта/сканировании. store должен быть открыт.
+    """
+    return {doc_id: store.doc_refs(doc_id) for doc_id in store.doc_ids()}
+
+
+# ---------- предвычисленные индексы чанков (<doc_id>.scan.json рядом с .jsonl) ----------
+def scan_path(chunks_dir: Path, doc_id: Any) -> Path:
+    return Path(chunks_dir) / f"{doc_id}.scan.json"
+
+
+def chunk_scan_record(ch: Dict[str, Any]) -> Dict[str, Any]:
+    """Запись индекса для чанка: chunk_id, hash + markers.scan_chunk_text."""
+    text = ch.get("text", "")
+    return {"chunk_id": ch["chunk_id"], "hash": ch.get("hash") or chunk_hash(text), **scan_chunk_text(text)}
+
+
+def save_chunk_scans(path: Path, recs: List[Dict[str, Any]]) -> None:
+    """Атомарная запись индекса (tmp + rename)."""
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps({"version": SCAN_VERSION, "chunks": recs}, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def write_chunk_scans(path: Path, chunks: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Маркеры, заголовки постановлений/протоколов и кандидаты в потерпевшие по каждому чанку
+    (markers.scan_chunk_text).
+    """
+    recs = [chunk_scan_record(ch) for ch in chunks]
+    save_chunk_scans(path, recs)
+    return recs
+
+
+def load_chunk_scans(chunks_dir: Path, docs_map: Dict[str, List[Any]]) -> Dict[str, int]:
     """
-    Детерминированная загрузка чанков:
-    - файлы по возрастанию doc_id,
-    - внутри файла чанки по chunk_id.
+    Подгружает индексы ingest'а в кэш markers.chunk_scan, чтобы bootstrap/кластеризация/поиск
+    постановлений не сканировали текст. Индекс без пары (старые загрузки), другой версии или
+    с расхождением hash чанков пересчитывается по тексту и перезаписывается.
     """
-    paths = storage_paths(case_id)
-    chunks_dir = paths["chunks"]
-    out: Dict[str, List[Dict[str, Any]]] = {}
-    if not chunks_dir.exists():
-        return out
-
-    files = sorted(chunks_dir.glob("*.jsonl"), key=lambda p: int(p.stem))
-    for fn in files:
-        doc_id = fn.stem
-        items: List[Dict[str, Any]] = []
-        with fn.open("r", encoding="utf-8") as f:
-            for line in f:
-                items.append(json.loads(line))
-        items.sort(key=lambda x: int(x.get("chunk_id", 0)))
-        out[doc_id] = items
-    return out
+    stats = {"loaded": 0, "rebuilt": 0}
+    for doc_id, chunks in docs_map.items():
+        path = scan_path(chunks_dir, doc_id)
+        data = None
+        if path.exists():
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+            except ValueError:
+                data = None
+        recs = (data or {}).get("chunks") or []
+        if (data or {}).get("version") == SCAN_VERSION and [r["hash"] for r in recs] == [ch["hash"] for ch in chunks]:
+            stats["loaded"] += 1
+        else:
+            recs = write_chunk_scans(path, chunks)
+            stats["rebuilt"] += 1
+        for r in recs:
+            remember_chunk_scan(r["hash"], {k: r[k] for k in ("markers", "tags", "victims")})
+    return stats
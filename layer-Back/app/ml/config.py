@@ -20,19 +20,72 @@ logger.setLevel(logging.INFO)
 # ENV
 GENERATOR_MODEL = os.getenv("GENERATOR_MODEL", "deepseek-6.7b")
 GENERATOR_URL = os.getenv("GENERATOR_URL")
-if not GENERATOR_URL:
+# Несколько реплик llama.cpp/vLLM через запятую; по умолчанию — один GENERATOR_URL
+GENERATOR_URLS = [u.strip() for u in os.getenv("GENERATOR_URLS", "").split(",") if u.strip()]
+if not GENERATOR_URLS and GENERATOR_URL:
+    GENERATOR_URLS = [GENERATOR_URL]
+if not GENERATOR_URLS:
     raise RuntimeError("GENERATOR_URL не задан в .env")
+GENERATOR_URL = GENERATOR_URL or GENERATOR_URLS[0]
 
 MODEL_ENCODING = "cl100k_base"
 
+# HTTP-клиент генератора (общий пул соединений на процесс)
+GEN_HTTP_TIMEOUT = float(os.getenv("GEN_HTTP_TIMEOUT", "240"))
+GEN_CONNECT_TIMEOUT = float(os.getenv("GEN_CONNECT_TIMEOUT", "10"))
+GEN_MAX_CONNECTIONS = int(os.getenv("GEN_MAX_CONNECTIONS", "32"))
+GEN_MAX_KEEPALIVE = int(os.getenv("GEN_MAX_KEEPALIVE", "16"))
+GEN_KEEPALIVE_EXPIRY = float(os.getenv("GEN_KEEPALIVE_EXPIRY", "120"))
+GEN_HTTP2 = os.getenv("GEN_HTTP2", "0") == "1"
+# gzip тела запроса (сервер должен понимать Content-Encoding: gzip)
+GEN_GZIP_REQUESTS = os.getenv("GEN_GZIP_REQUESTS", "0") == "1"
+GEN_GZIP_MIN_BYTES = int(os.getenv("GEN_GZIP_MIN_BYTES", "16384"))
+# Схема API генератора: llama | openai-chat | openai-comp (пусто — автоопределение)
+GEN_PROTOCOL = os.getenv("GEN_PROTOCOL", "").strip()
+GEN_PROTOCOL_REPROBE_FAILURES = int(os.getenv("GEN_PROTOCOL_REPROBE_FAILURES", "3"))
+# Согласование схемы на старте идёт в фоне; таймаут пробы одной реплики (сек)
+GEN_PROBE_TIMEOUT = float(os.getenv("GEN_PROBE_TIMEOUT", "5"))
+# Маршрутизация по репликам: least_inflight (меньше запросов в полёте) | ewma (меньше латентность)
+GEN_ROUTING = os.getenv("GEN_ROUTING", "least_inflight").strip()
+GEN_EWMA_ALPHA = float(os.getenv("GEN_EWMA_ALPHA", "0.3"))
+GEN_EJECT_FAILURES = int(os.getenv("GEN_EJECT_FAILURES", "3"))
+GEN_EJECT_SECONDS = float(os.getenv("GEN_EJECT_SECONDS", "30"))
+GEN_HEALTH_INTERVAL = float(os.getenv("GEN_HEALTH_INTERVAL", "15"))
+# Ограниченное декодирование экстракции по схеме (GBNF для llama.cpp, response_format для vLLM/OpenAI);
+# по умолчанию выключено — включать после проверки грамматики на своём сервере
+GEN_CONSTRAINED_EXTRACT = os.getenv("GEN_CONSTRAINED_EXTRACT", "0") == "1"
+# Старые vLLM: передавать схему через guided_json вместо response_format
+GEN_GUIDED_JSON = os.getenv("GEN_GUIDED_JSON", "0") == "1"
+# Серверный prefix-кэш llama.cpp: cache_prompt и закрепление слота (id_slot) по хэшу префикса
+GEN_CACHE_PROMPT = os.getenv("GEN_CACHE_PROMPT", "1") == "1"
+GEN_LLAMA_SLOTS = int(os.getenv("GEN_LLAMA_SLOTS", "0"))
+# Стрим для JSON-экстракции: обрыв генерации сразу после закрытия первого JSON-объекта
+GEN_STREAM_EXTRACT = os.getenv("GEN_STREAM_EXTRACT", "0") == "1"
+
 # Storage
 STORAGE_DIR = Path("storage/docs")
 
+# Фоновый приём документов: процессный пул для извлечения текста/чанкинга
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+# Страниц PDF на одну задачу пула (диапазоны извлекаются параллельно)
+INGEST_PAGES_PER_TASK = int(os.getenv("INGEST_PAGES_PER_TASK", "25"))
+
+# Журнал state: компакция в снапшот каждые N записей (и в конце прогона)
+STATE_SNAPSHOT_EVERY = int(os.getenv("STATE_SNAPSHOT_EVERY", "50"))
+
+# Дисковый кэш ответов генератора
+GEN_CACHE_ENABLED = os.getenv("GEN_CACHE_ENABLED", "1") == "1"
+GEN_CACHE_DIR = Path(os.getenv("GEN_CACHE_DIR", "storage/gen_cache"))
+GEN_CACHE_MAX_MB = int(os.getenv("GEN_CACHE_MAX_MB", "512"))
+
 # Лимиты/бюджеты
 MAX_MODEL_LEN = 32768
 SYSTEM_BUDGET = 800
 BATCH_MAX_FILES = 6
 BATCH_MAX_TOKENS = 11000
+# Раскладка документов по батчам: ffd — упаковка в минимум батчей с учётом кластеров,
+# sequential — прежнее последовательное заполнение в порядке кластеров
+BATCH_PACKING = os.getenv("BATCH_PACKING", "ffd")
 CHUNK_TOKENS = 1800
 CHUNK_OVERLAP = 200
 PER_DOC_TOKEN_CAP = 2600
@@ -52,6 +105,17 @@ SECTIONAL_EXTRACTION = True
 ENABLE_PASS2_ON_GAPS = True
 PASS2_PER_DOC_CAP = 2200
 MARKER_SCAN_CHUNKS = 4
+# Кластеризация по маркерам: маркер в доле документов > CLUSTER_HUB_DF (и не менее чем в CLUSTER_HUB_MIN_DOCS)
+# считается «хабом» (телефон следователя, e-mail ведомства) и связей не даёт; CLUSTER_MAX_SIZE=0 — без лимита
+CLUSTER_HUB_DF = float(os.getenv("CLUSTER_HUB_DF", "0.3"))
+CLUSTER_HUB_MIN_DOCS = int(os.getenv("CLUSTER_HUB_MIN_DOCS", "5"))
+CLUSTER_MAX_SIZE = int(os.getenv("CLUSTER_MAX_SIZE", "0"))
+# Раскладка промпта экстракции: classic (state перед документами) | prefix (общий префикс документов для vmf/rest)
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "classic").strip()
+# Сколько вызовов экстракции (батч × секция) держать в полёте одновременно
+EXTRACT_CONCURRENCY = int(os.getenv("EXTRACT_CONCURRENCY", "1"))
+# Инкрементальный прогон: сколько соседей по кластеру (первым чанком) брать в контекст к новому документу
+INCREMENTAL_NEIGHBOURS = int(os.getenv("INCREMENTAL_NEIGHBOURS", "2"))
 STATE_SNIPPET_SIZES = {"investigators": 4, "prosecutors": 4, "actors": 20, "victims": 30, "pyramid_indicators": 12}
 UST_STATE_CAPS = {"actors": 60, "victims": 300, "events": 260, "money_flows": 180, "pyramid_indicators": 40, "mechanism_bullets": 25, "offense_articles": 8}
 
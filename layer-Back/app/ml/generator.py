@@ -2,14 +2,31 @@
 from __future__ import annotations
 
 import re
+import gzip
+import hashlib
+import json
+import time
 import asyncio
 import random
-from typing import Optional
+from functools import lru_cache
+from collections import OrderedDict
+from typing import Callable, Optional, List, Tuple, Set
+from urllib.parse import urlsplit
 
 import httpx
 from httpx import HTTPStatusError, TransportError, TimeoutException
 
-from .config import GENERATOR_MODEL, GENERATOR_URL, logger
+from .json_parse import JsonObjectTracker
+from .grammar import json_schema_to_gbnf
+from .response_cache import response_cache, make_cache_key
+from .config import (
+    GENERATOR_MODEL, GENERATOR_URLS, logger,
+    GEN_HTTP_TIMEOUT, GEN_CONNECT_TIMEOUT, GEN_MAX_CONNECTIONS, GEN_MAX_KEEPALIVE,
+    GEN_KEEPALIVE_EXPIRY, GEN_HTTP2, GEN_GZIP_REQUESTS, GEN_GZIP_MIN_BYTES,
+    GEN_PROTOCOL, GEN_PROTOCOL_REPROBE_FAILURES, GEN_PROBE_TIMEOUT, GEN_CACHE_ENABLED,
+    GEN_ROUTING, GEN_EWMA_ALPHA, GEN_EJECT_FAILURES, GEN_EJECT_SECONDS, GEN_HEALTH_INTERVAL,
+    GEN_GUIDED_JSON, GEN_CACHE_PROMPT, GEN_LLAMA_SLOTS
+)
 
 # Базовые параметры генерации
 _DEFAULT_TEMP = 0.1
@@ -25,6 +42,17 @@ _BANNED_PATTERNS = re.compile(
     r"я\s+не\s+смогу|к\s+сожалению|не\s+удалось|привет[,! ]|hello[,! ]|hi[,! ])",
     re.IGNORECASE
 )
+# Блок-запрет, добавляемый к промптам (см. _inject_guardrails)
+_GUARD_BLOCK = (
+    "\n\n=== ЗАПРЕТЫ/ТОН ===\n"
+    "Никогда не писать фразы вида: «извин», «не могу», «как модель/ИИ/ассистент», "
+    "«недостаточно данных». Даже при неполноте фактов — формируй ответ из доступных сведений; "
+    "разрешено использовать нейтральную формулу «по материалам дела установлено следующее». "
+    "Никаких приветствий/болтовни/метакомментариев."
+)
+# Версия guardrails для ключа кэша: меняется при любой правке запретов
+GUARDRAIL_VERSION = hashlib.sha1((_GUARD_BLOCK + _BANNED_PATTERNS.pattern).encode("utf-8")).hexdigest()[:12]
+
 # --- ADD near imports ---
 from typing import Any, Dict
 # --- END ADD ---
@@ -51,34 +79,223 @@ def _extract_text(data: Dict[str, Any]) -> str:
     # Кастомные ключи
     return data.get("content") or data.get("response") or data.get("text", "") or ""
 
-async def call_generator(prompt: str, n_predict: int):
+def _note_cached_tokens(data: Dict[str, Any]) -> None:
+    """Сколько токенов промпта сервер взял из KV/prefix-кэша (llama.cpp: tokens_cached, vLLM: usage)."""
+    if not isinstance(data, dict):
+        return
+    n = data.get("tokens_cached")
+    if n is None:
+        try:
+            n = (data.get("usage") or {}).get("prompt_tokens_details", {}).get("cached_tokens")
+        except AttributeError:
+            n = None
+    if isinstance(n, int) and n > 0:
+        _pool_stats["prompt_tokens_cached"] += n
+
+# ---------- Общий HTTP-клиент (пул соединений на процесс) ----------
+_client: Optional[httpx.AsyncClient] = None
+_client_lock = asyncio.Lock()
+_pool_stats: Dict[str, Any] = {
+    "opened_at": None,
+    "http2": False,
+    "requests": 0,
+    "new_connections": 0,
+    "gzip_requests": 0,
+    "bytes_sent": 0,
+    "bytes_raw": 0,
+    "errors": 0,
+    "stream_early_stops": 0,
+    "prompt_tokens_cached": 0,
+}
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def _make_client() -> httpx.AsyncClient:
+    http2 = GEN_HTTP2
+    if http2 and not _http2_available():
+        logger.warning("[GEN] GEN_HTTP2=1, но пакет 'h2' не установлен — работаем по HTTP/1.1")
+        http2 = False
+    _pool_stats["http2"] = http2
+    _pool_stats["opened_at"] = time.time()
+    limits = httpx.Limits(
+        max_connections=GEN_MAX_CONNECTIONS,
+        max_keepalive_connections=GEN_MAX_KEEPALIVE,
+        keepalive_expiry=GEN_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(GEN_HTTP_TIMEOUT, connect=GEN_CONNECT_TIMEOUT)
+    logger.info(
+        f"[GEN] open pooled client: max_conn={GEN_MAX_CONNECTIONS}, keepalive={GEN_MAX_KEEPALIVE}, "
+        f"expiry={GEN_KEEPALIVE_EXPIRY}s, http2={http2}, gzip={GEN_GZIP_REQUESTS}"
+    )
+    return httpx.AsyncClient(timeout=timeout, limits=limits, http2=http2)
+
+async def open_generator_client() -> httpx.AsyncClient:
+    """Открывает общий клиент генератора (вызывается из lifespan приложения)."""
+    global _client, _health_task
+    async with _client_lock:
+        if _client is None or _client.is_closed:
+            _client = _make_client()
+        if len(_backends) > 1 and (_health_task is None or _health_task.done()):
+            _health_task = asyncio.create_task(_health_loop())
+        return _client
+
+async def close_generator_client() -> None:
+    """Закрывает общий клиент генератора и освобождает соединения."""
+    global _client, _health_task, _negotiate_task
+    async with _client_lock:
+        for task in (_health_task, _negotiate_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+        _health_task = _negotiate_task = None
+        if _client is not None and not _client.is_closed:
+            await _client.aclose()
+            logger.info(f"[GEN] pooled client closed: {generator_pool_stats()}")
+        _client = None
+
+async def get_generator_client() -> httpx.AsyncClient:
+    """Клиент из lifespan; вне приложения (скрипты) — открываем лениво."""
+    if _client is None or _client.is_closed:
+        return await open_generator_client()
+    return _client
+
+def generator_pool_stats() -> Dict[str, Any]:
+    """Статистика пула: сколько запросов обслужено поверх скольких TCP-соединений."""
+    st = dict(_pool_stats)
+    reqs, conns = st["requests"], st["new_connections"]
+    st["reused_requests"] = max(0, reqs - conns)
+    st["reuse_ratio"] = round(1.0 - conns / reqs, 3) if reqs else 0.0
+    st["open"] = _client is not None and not _client.is_closed
+    return st
+
+async def _trace(event_name: str, info: Dict[str, Any]) -> None:
+    # httpcore сообщает о каждом новом TCP-соединении — по этому считаем переиспользование
+    if event_name == "connection.connect_tcp.complete":
+        _pool_stats["new_connections"] += 1
+
+def _encode_body(payload: Dict[str, Any]) -> Tuple[bytes, Dict[str, str]]:
+    """JSON-тело запроса; крупные тела опционально сжимаем gzip."""
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    _pool_stats["bytes_raw"] += len(body)
+    if GEN_GZIP_REQUESTS and len(body) >= GEN_GZIP_MIN_BYTES:
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+        _pool_stats["gzip_requests"] += 1
+    _pool_stats["requests"] += 1
+    _pool_stats["bytes_sent"] += len(body)
+    return body, headers
+
+async def _post_json(url: str, payload: Dict[str, Any]) -> httpx.Response:
+    """POST JSON через общий пул."""
+    client = await get_generator_client()
+    body, headers = _encode_body(payload)
+    try:
+        return await client.post(url, content=body, headers=headers, extensions={"trace": _trace})
+    except Exception:
+        _pool_stats["errors"] += 1
+        raise
+
+def _extract_delta(data: Dict[str, Any]) -> str:
     """
-    Умный вызов генератора: поддержка OpenAI /v1/chat/completions,
-/v1/completions и llama.cpp-подобных серверов.
-    Сначала пытаемся «по URL», при 400 — пробуем другие схемы.
+    Кусок текста из события стрима:
+    - OpenAI chat: choices[0].delta.content
+    - OpenAI completions: choices[0].text
+    - llama.cpp: content
+    """
+    if not isinstance(data, dict):
+        return ""
+    try:
+        return data["choices"][0]["delta"].get("content") or ""
+    except Exception:
+        pass
+    try:
+        return data["choices"][0]["text"] or ""
+    except Exception:
+        pass
+    return data.get("content") or ""
+
+async def _stream_text(url: str, payload: Dict[str, Any], stop_on_json: bool) -> str:
+    """
+    Потоковая генерация (SSE у OpenAI-совместимых, «data:»-чанки у llama.cpp).
+    При stop_on_json обрываем ответ, как только закрылся первый JSON-объект верхнего уровня:
+    закрытие соединения останавливает декодирование на сервере и освобождает слот.
     """
-    url = GENERATOR_URL
+    client = await get_generator_client()
+    body, headers = _encode_body(payload)
+    tracker = JsonObjectTracker() if stop_on_json else None
+    parts: List[str] = []
+    try:
+        async with client.stream("POST", url, content=body, headers=headers, extensions={"trace": _trace}) as r:
+            if r.status_code >= 400:
+                await r.aread()
+                r.raise_for_status()
+            async for line in r.aiter_lines():
+                line = line.strip()
+                if not line or line.startswith(":"):
+                    continue
+                if line.startswith("data:"):
+                    line = line[5:].strip()
+                if line == "[DONE]":
+                    break
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    continue
+                _note_cached_tokens(data)
+                piece = _extract_delta(data)
+                if piece:
+                    parts.append(piece)
+                    if tracker is not None and tracker.feed(piece):
+                        _pool_stats["stream_early_stops"] += 1
+                        break
+                if isinstance(data, dict) and data.get("stop") is True:
+                    break
+    except Exception:
+        _pool_stats["errors"] += 1
+        raise
+    return "".join(parts)
 
-    # Схемы тел
-    payload_chat = {
-        "model": GENERATOR_MODEL,
-        "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": n_predict,
-        "temperature": _DEFAULT_TEMP,
-        "top_p": _DEFAULT_TOP_P,
-        "stream": False,
-        "stop": _DEFAULT_STOPS,
-    }
-    payload_comp = {
-        "model": GENERATOR_MODEL,
-        "prompt": prompt,
-        "max_tokens": n_predict,
-        "temperature": _DEFAULT_TEMP,
-        "top_p": _DEFAULT_TOP_P,
-        "stream": False,
-        "stop": _DEFAULT_STOPS,
-    }
-    payload_llama = {
+# ---------- Протокол генератора (кэш на процесс) ----------
+_PROTOCOLS = ("llama", "openai-chat", "openai-comp")
+# HTTP-коды, которые означают «сервер не понимает такую схему тела»
+_SCHEMA_ERROR_CODES = (400, 404, 405, 422)
+_PROBE_PROMPT = "ping"
+
+# (url, model) -> {"protocol", "negotiated_at", "failures", "probes", "source"}
+_protocol_cache: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+def _build_payload(protocol: str, prompt: str, n_predict: int) -> Dict[str, Any]:
+    """Тело запроса для конкретной схемы."""
+    if protocol == "openai-chat":
+        return {
+            "model": GENERATOR_MODEL,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": n_predict,
+            "temperature": _DEFAULT_TEMP,
+            "top_p": _DEFAULT_TOP_P,
+            "stream": False,
+            "stop": _DEFAULT_STOPS,
+        }
+    if protocol == "openai-comp":
+        return {
+            "model": GENERATOR_MODEL,
+            "prompt": prompt,
+            "max_tokens": n_predict,
+            "temperature": _DEFAULT_TEMP,
+            "top_p": _DEFAULT_TOP_P,
+            "stream": False,
+            "stop": _DEFAULT_STOPS,
+        }
+    return {
         "model": GENERATOR_MODEL,
         "prompt": prompt,
         "n_predict": n_predict,
@@ -89,52 +306,364 @@ async def call_generator(prompt: str, n_predict: int):
         "stop": _DEFAULT_STOPS,
     }
 
-    # Порядок попыток по эвристике URL
-    attempts = []
+def _protocol_order(url: str) -> List[str]:
+    """Порядок попыток по эвристике URL (или фиксированная схема из .env)."""
+    if GEN_PROTOCOL in _PROTOCOLS:
+        return [GEN_PROTOCOL] + [p for p in _PROTOCOLS if p != GEN_PROTOCOL]
     u = (url or "").lower()
     if "/chat/completions" in u:
-        attempts = [("openai-chat", payload_chat), ("openai-comp", payload_comp), ("llama", payload_llama)]
-    elif "/completions" in u:
-        attempts = [("openai-comp", payload_comp), ("openai-chat", payload_chat), ("llama", payload_llama)]
-    else:
-        attempts = [("llama", payload_llama), ("openai-chat", payload_chat), ("openai-comp", payload_comp)]
+        return ["openai-chat", "openai-comp", "llama"]
+    if "/completions" in u:
+        return ["openai-comp", "openai-chat", "llama"]
+    return ["llama", "openai-chat", "openai-comp"]
 
-    async with httpx.AsyncClient(timeout=240.0) as client:
-        last_exc: Optional[Exception] = None
-        for label, pl in attempts:
-            try:
-                r = await client.post(url, json=pl)
-                r.raise_for_status()
-                data = r.json()
-                return _extract_text(data)
-            except HTTPStatusError as e:
-                # При явной 400 — пробуем следующую схему
-                if e.response is not None and e.response.status_code == 400:
-                    try:
-                        err_txt = e.response.text[:500]
-                    except Exception:
-                        err_txt = str(e)
-                    logger.warning(f"[GEN] {label} -> HTTP 400, retry with next schema; body: {err_txt}")
-                    last_exc = e
-                    continue
-                last_exc = e
-                break
-            except Exception as e:
-                logger.warning(f"[GEN] transport/parse error on {label}: {e}")
+def _protocol_key(url: str) -> Tuple[str, str]:
+    return (url, GENERATOR_MODEL)
+
+def _remember_protocol(url: str, protocol: str, source: str) -> None:
+    prev = _protocol_cache.get(_protocol_key(url)) or {}
+    _protocol_cache[_protocol_key(url)] = {
+        "protocol": protocol,
+        "negotiated_at": time.time(),
+        "failures": 0,
+        "probes": int(prev.get("probes", 0)) + 1,
+        "source": source,
+    }
+    if prev.get("protocol") != protocol:
+        logger.info(f"[GEN] protocol for {url} ({GENERATOR_MODEL}) -> {protocol} (via {source})")
+
+def _note_protocol_failure(url: str) -> None:
+    entry = _protocol_cache.get(_protocol_key(url))
+    if not entry:
+        return
+    entry["failures"] += 1
+    if entry["failures"] >= GEN_PROTOCOL_REPROBE_FAILURES:
+        logger.warning(
+            f"[GEN] protocol {entry['protocol']} failed {entry['failures']}x on {url} -> re-probe on next call"
+        )
+        _protocol_cache.pop(_protocol_key(url), None)
+
+def _is_schema_error(e: Exception) -> bool:
+    return isinstance(e, HTTPStatusError) and e.response is not None and e.response.status_code in _SCHEMA_ERROR_CODES
+
+async def _probe_protocols(url: str, prompt: str, n_predict: int, source: str) -> str:
+    """
+    Перебор схем по порядку; первая успешная запоминается для (url, model).
+    Возвращает текст ответа пробного запроса.
+    """
+    last_exc: Optional[Exception] = None
+    for label in _protocol_order(url):
+        try:
+            r = await _post_json(url, _build_payload(label, prompt, n_predict))
+            r.raise_for_status()
+            text = _extract_text(r.json())
+            _remember_protocol(url, label, source)
+            return text
+        except HTTPStatusError as e:
+            # При ошибке схемы — пробуем следующую
+            if _is_schema_error(e):
+                try:
+                    err_txt = e.response.text[:500]
+                except Exception:
+                    err_txt = str(e)
+                logger.warning(f"[GEN] {label} -> HTTP {e.response.status_code}, retry with next schema; body: {err_txt}")
                 last_exc = e
                 continue
+            last_exc = e
+            break
+        except Exception as e:
+            logger.warning(f"[GEN] transport/parse error on {label}: {e}")
+            last_exc = e
+            continue
+
+    # Если всё перепробовали
+    if last_exc:
+        raise last_exc
+    raise RuntimeError("Generator: no attempts executed (invalid configuration)")
+
+async def negotiate_protocol(force: bool = False) -> Dict[str, Optional[str]]:
+    """
+    Однократное согласование схемы коротким запросом для каждой реплики — параллельно,
+    не дольше GEN_PROBE_TIMEOUT на реплику. Ошибки не пробрасываем: если сервер недоступен
+    или не ответил вовремя — согласуем на первом реальном вызове.
+    """
+    async def one(url: str) -> Optional[str]:
+        entry = _protocol_cache.get(_protocol_key(url))
+        if entry and not force:
+            return entry["protocol"]
+        if force:
+            _protocol_cache.pop(_protocol_key(url), None)
+        try:
+            await asyncio.wait_for(_probe_protocols(url, _PROBE_PROMPT, 1, source="startup"), GEN_PROBE_TIMEOUT)
+            return _protocol_cache[_protocol_key(url)]["protocol"]
+        except asyncio.TimeoutError:
+            logger.warning(f"[GEN] protocol negotiation for {url} timed out after {GEN_PROBE_TIMEOUT}s; will retry on first call")
+        except Exception as e:
+            logger.warning(f"[GEN] protocol negotiation failed for {url} ({e}); will retry on first call")
+        return None
+
+    urls = [b.url for b in _backends]
+    return dict(zip(urls, await asyncio.gather(*(one(url) for url in urls))))
+
+def start_protocol_negotiation() -> None:
+    """Согласование в фоне (из lifespan): старт приложения не ждёт ответа реплик."""
+    global _negotiate_task
+    if _negotiate_task is None or _negotiate_task.done():
+        _negotiate_task = asyncio.create_task(negotiate_protocol())
+
+def generator_protocol_status() -> List[Dict[str, Any]]:
+    """Закэшированные схемы по (url, model) — для статус-эндпоинта."""
+    return [
+        {"url": url, "model": model, **entry}
+        for (url, model), entry in _protocol_cache.items()
+    ]
+
+# ---------- Маршрутизация по репликам генератора ----------
+class _Backend:
+    """Реплика генератора и её счётчики для балансировки."""
+    __slots__ = ("url", "inflight", "ewma_ms", "requests", "errors", "consecutive_failures",
+                 "ejected_until", "ejections", "chars_out", "busy_s", "last_error")
+
+    def __init__(self, url: str):
+        self.url = url
+        self.inflight = 0
+        self.ewma_ms: Optional[float] = None
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.chars_out = 0
+        self.busy_s = 0.0
+        self.last_error: Optional[str] = None
+
+    def healthy(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def load_score(self) -> Tuple[float, float]:
+        ewma = self.ewma_ms if self.ewma_ms is not None else 0.0
+        if GEN_ROUTING == "ewma":
+            # ожидаемое время до ответа: латентность × очередь
+            return (ewma * (self.inflight + 1), self.inflight)
+        return (self.inflight, ewma)
+
+    def on_success(self, elapsed_s: float, chars: int) -> None:
+        ms = elapsed_s * 1000.0
+        self.ewma_ms = ms if self.ewma_ms is None else (GEN_EWMA_ALPHA * ms + (1 - GEN_EWMA_ALPHA) * self.ewma_ms)
+        self.consecutive_failures = 0
+        self.chars_out += chars
+        self.busy_s += elapsed_s
+
+    def on_failure(self, err: Exception) -> None:
+        self.errors += 1
+        self.consecutive_failures += 1
+        self.last_error = str(err)[:200]
+        if self.consecutive_failures >= GEN_EJECT_FAILURES and self.healthy(time.time()):
+            self.ejected_until = time.time() + GEN_EJECT_SECONDS
+            self.ejections += 1
+            logger.warning(f"[GEN] backend {self.url} ejected for {GEN_EJECT_SECONDS:.0f}s after {self.consecutive_failures} failures: {self.last_error}")
+
+_backends: List[_Backend] = [_Backend(u) for u in GENERATOR_URLS]
+# реплики, отвергающие grammar/response_format
+_constraint_unsupported: Set[str] = set()
+_backends_since = time.time()
+_health_task: Optional[asyncio.Task] = None
+_negotiate_task: Optional[asyncio.Task] = None
+
+# cache_hint -> реплика, где лежит KV этого префикса (ограниченный LRU)
+_affinity: "OrderedDict[str, _Backend]" = OrderedDict()
+_AFFINITY_MAX = 1024
+
+def _pick_backend(cache_hint: Optional[str] = None) -> _Backend:
+    now = time.time()
+    alive = [b for b in _backends if b.healthy(now)]
+    if not alive:
+        # все выброшены — идём в ту, что вернётся раньше всех (fail-open)
+        return min(_backends, key=lambda b: b.ejected_until)
+    if cache_hint:
+        b = _affinity.get(cache_hint)
+        if b is not None and b.healthy(now):
+            _affinity.move_to_end(cache_hint)
+            return b
+    b = min(alive, key=lambda b: b.load_score())
+    if cache_hint:
+        _affinity[cache_hint] = b
+        while len(_affinity) > _AFFINITY_MAX:
+            _affinity.popitem(last=False)
+    return b
+
+def _is_backend_failure(e: Exception) -> bool:
+    if isinstance(e, HTTPStatusError):
+        return e.response is not None and e.response.status_code >= 500
+    return isinstance(e, (TransportError, TimeoutException))
+
+def _health_url(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}/health"
+
+async def _health_loop() -> None:
+    """Фоновая проверка выброшенных реплик: GET /health (llama.cpp и vLLM), 200 — возвращаем в ротацию."""
+    while True:
+        await asyncio.sleep(GEN_HEALTH_INTERVAL)
+        client = _client
+        if client is None or client.is_closed:
+            continue
+        for b in _backends:
+            if b.healthy(time.time()) and b.consecutive_failures == 0:
+                continue
+            try:
+                r = await client.get(_health_url(b.url), timeout=5.0)
+                ok = r.status_code == 200
+            except Exception:
+                ok = False
+            if ok:
+                if not b.healthy(time.time()):
+                    logger.info(f"[GEN] backend {b.url} healthy again -> back in rotation")
+                b.ejected_until = 0.0
+                b.consecutive_failures = 0
+            elif b.healthy(time.time()):
+                b.ejected_until = time.time() + GEN_EJECT_SECONDS
+
+def generator_backend_stats() -> List[Dict[str, Any]]:
+    """По каждой реплике: нагрузка, латентность (EWMA), ошибки и пропускная способность."""
+    now = time.time()
+    opened = _pool_stats.get("opened_at") or _backends_since
+    uptime = max(1e-6, now - opened)
+    out = []
+    for b in _backends:
+        out.append({
+            "url": b.url,
+            "healthy": b.healthy(now),
+            "inflight": b.inflight,
+            "ewma_ms": round(b.ewma_ms, 1) if b.ewma_ms is not None else None,
+            "requests": b.requests,
+            "errors": b.errors,
+            "ejections": b.ejections,
+            "ejected_for_s": round(max(0.0, b.ejected_until - now), 1),
+            "req_per_min": round(60.0 * b.requests / uptime, 2),
+            "chars_per_s_busy": round(b.chars_out / b.busy_s, 1) if b.busy_s else 0.0,
+            "constrained_decoding": b.url not in _constraint_unsupported,
+            "last_error": b.last_error,
+        })
+    return out
 
-        # Если всё перепробовали
-        if last_exc:
-            raise last_exc
-        raise RuntimeError("Generator: no attempts executed (invalid configuration)")
+async def call_generator(prompt: str, n_predict: int, stream_json: bool = False,
+                         json_schema: Optional[Dict[str, Any]] = None,
+                         cache_hint: Optional[str] = None):
+    """
+    Умный вызов генератора: поддержка OpenAI /v1/chat/completions,
+/v1/completions и llama.cpp-подобных серверов.
+    Реплика выбирается по GEN_ROUTING (меньше запросов в полёте или меньшая EWMA-латентность);
+    сбойные реплики временно выбрасываются из ротации.
+    cache_hint — ключ общего префикса: такие запросы идут на ту же реплику (и слот llama.cpp).
+    """
+    b = _pick_backend(cache_hint)
+    b.inflight += 1
+    b.requests += 1
+    t0 = time.monotonic()
+    try:
+        text = await _call_backend(b.url, prompt, n_predict, stream_json, json_schema, cache_hint)
+    except Exception as e:
+        if _is_backend_failure(e):
+            b.on_failure(e)
+        raise
+    finally:
+        b.inflight -= 1
+    b.on_success(time.monotonic() - t0, len(text or ""))
+    return text
+
+def _apply_constraint(payload: Dict[str, Any], protocol: str, json_schema: Dict[str, Any]) -> None:
+    """
+    Ограничение вывода схемой:
+    - llama.cpp: GBNF-грамматика в поле grammar;
+    - OpenAI-совместимые (vLLM): response_format=json_schema или guided_json (GEN_GUIDED_JSON=1).
+    """
+    if protocol == "llama":
+        payload["grammar"] = _gbnf_for(json.dumps(json_schema, sort_keys=True, ensure_ascii=False))
+    elif GEN_GUIDED_JSON:
+        payload["guided_json"] = json_schema
+    else:
+        payload["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "extraction", "schema": json_schema},
+        }
+
+@lru_cache(maxsize=16)
+def _gbnf_for(schema_json: str) -> str:
+    return json_schema_to_gbnf(json.loads(schema_json))
+
+async def _send(url: str, payload: Dict[str, Any], stream_json: bool) -> str:
+    if stream_json:
+        payload["stream"] = True
+        return await _stream_text(url, payload, stop_on_json=True)
+    r = await _post_json(url, payload)
+    r.raise_for_status()
+    data = r.json()
+    _note_cached_tokens(data)
+    return _extract_text(data)
 
-async def _try_once(label: str, prompt: str, n_predict: int, retries: int = 3) -> str:
+def _apply_prefix_hints(payload: Dict[str, Any], protocol: str, cache_hint: Optional[str]) -> None:
+    """
+    llama.cpp: cache_prompt — переиспользовать KV общего префикса в слоте;
+    id_slot — закрепить запросы с одинаковым префиксом за одним слотом (GEN_LLAMA_SLOTS > 0).
+    vLLM (--enable-prefix-caching) кэширует префиксы сам — полей не нужно.
+    """
+    if protocol != "llama":
+        return
+    if GEN_CACHE_PROMPT:
+        payload["cache_prompt"] = True
+    if cache_hint and GEN_LLAMA_SLOTS > 0:
+        payload["id_slot"] = int(cache_hint[:8], 16) % GEN_LLAMA_SLOTS
+
+async def _call_backend(url: str, prompt: str, n_predict: int, stream_json: bool,
+                        json_schema: Optional[Dict[str, Any]] = None,
+                        cache_hint: Optional[str] = None) -> str:
+    """
+    Вызов конкретной реплики.
+    Схема согласуется один раз и кэшируется на (url, модель);
+    повторное согласование — только после GEN_PROTOCOL_REPROBE_FAILURES ошибок схемы подряд.
+    stream_json=True — потоковый ответ с обрывом после первого закрытого JSON-объекта.
+    json_schema — ограниченное декодирование; если реплика его не понимает (400/422, а без
+    ограничения тот же запрос проходит), дальше для неё шлём запросы без ограничения.
+    """
+    entry = _protocol_cache.get(_protocol_key(url))
+    if not entry:
+        # только согласование схемы коротким запросом; сам промпт уходит ниже — с подсказкой
+        # слота, ограничением схемой и потоковым ответом, как и все последующие вызовы
+        await _probe_protocols(url, _PROBE_PROMPT, 1, source="first-call")
+        entry = _protocol_cache[_protocol_key(url)]
+
+    constrained = json_schema is not None and url not in _constraint_unsupported
+    payload = _build_payload(entry["protocol"], prompt, n_predict)
+    _apply_prefix_hints(payload, entry["protocol"], cache_hint)
+    if constrained:
+        _apply_constraint(payload, entry["protocol"], json_schema)
+    try:
+        try:
+            text = await _send(url, payload, stream_json)
+        except HTTPStatusError as e:
+            if not (constrained and _is_schema_error(e)):
+                raise
+            logger.warning(f"[GEN] {url}: constrained request rejected (HTTP {e.response.status_code}), retry without constraint")
+            plain = _build_payload(entry["protocol"], prompt, n_predict)
+            _apply_prefix_hints(plain, entry["protocol"], cache_hint)
+            text = await _send(url, plain, stream_json)
+            _constraint_unsupported.add(url)
+            logger.warning(f"[GEN] {url}: constrained decoding disabled for this backend")
+    except HTTPStatusError as e:
+        if _is_schema_error(e):
+            _note_protocol_failure(url)
+        raise
+    entry["failures"] = 0
+    return text
+
+async def _try_once(label: str, prompt: str, n_predict: int, retries: int = 3, stream_json: bool = False,
+                    json_schema: Optional[Dict[str, Any]] = None, cache_hint: Optional[str] = None) -> str:
     delay = 1.0
     for attempt in range(retries):
         try:
             logger.info(f"[GEN] {label} try#{attempt+1}, n_predict={n_predict}")
-            return await call_generator(prompt, n_predict=n_predict)
+            return await call_generator(prompt, n_predict=n_predict, stream_json=stream_json, json_schema=json_schema, cache_hint=cache_hint)
         except HTTPStatusError as e:
             code = e.response.status_code
             logger.warning(f"[GEN] {label} HTTP {code} on n_predict={n_predict} (attempt {attempt+1}/{retries})")
@@ -154,17 +683,10 @@ def _inject_guardrails(prompt: str) -> str:
     К каждому промпту аккуратно добавляем короткий блок-запрет,
     чтобы модель не уводило в «извините/я не могу/как модель…».
     """
-    guard = (
-        "\n\n=== ЗАПРЕТЫ/ТОН ===\n"
-        "Никогда не писать фразы вида: «извин», «не могу», «как модель/ИИ/ассистент», "
-        "«недостаточно данных». Даже при неполноте фактов — формируй ответ из доступных сведений; "
-        "разрешено использовать нейтральную формулу «по материалам дела установлено следующее». "
-        "Никаких приветствий/болтовни/метакомментариев."
-    )
     # чтобы не раздувать контекст для JSON-экстракции, если уже явно прописано — не добавляем второй раз
     if "ЗАПРЕТЫ/ТОН" in prompt or "Жёстко запрещены" in prompt or "Строго запрещены" in prompt:
         return prompt
-    return prompt + guard
+    return prompt + _GUARD_BLOCK
 
 def _has_banned(text: str) -> bool:
     return bool(_BANNED_PATTERNS.search(text or ""))
@@ -198,39 +720,66 @@ async def safe_call_generator(
     label: str = "",
     retries: int = 3,
     fallback_predict: Optional[list[int]] = None,
-    inject_guard: bool = True
+    inject_guard: bool = True,
+    stream_json: bool = False,
+    json_schema: Optional[Dict[str, Any]] = None,
+    cache_hint: Optional[str] = None,
+    cache_ok: Optional[Callable[[str], bool]] = None
 ) -> str:
     """
     Безопасный вызов генератора:
       1) ретраи при сетевых/5xx;
       2) фолбэки по длине ответа;
       3) опциональная инъекция «guardrails» (запрет извинений/отказов);
-      4) пост-фильтр: если появились запрещённые фразы — переписать.
+      4) пост-фильтр: если появились запрещённые фразы — переписать;
+      5) stream_json — для JSON-экстракции: стрим с обрывом после закрытия объекта;
+      6) json_schema — ограниченное декодирование (GBNF для llama.cpp, response_format/guided_json для vLLM);
+      7) cache_hint — ключ общего префикса промпта (маршрутизация/слот для серверного prefix-кэша);
+      8) дисковый кэш ответов: ключ — промпт + фактический n_predict (ответ укороченного фолбэка
+         лежит под своим размером); cache_ok — проверка ответа перед записью (например,
+         json_parse.is_complete_json для экстракции: оборванный/неразборчивый ответ не кэшируется).
     """
     pp = _inject_guardrails(prompt) if inject_guard else prompt
 
-    # 1) основной размер
-    try:
-        out = await _try_once(label, pp, n_predict, retries=retries)
-    except Exception:
-        out = None
+    def cache_key(np: int) -> Optional[str]:
+        if not GEN_CACHE_ENABLED:
+            return None
+        return make_cache_key(pp, np, {
+            "temperature": _DEFAULT_TEMP,
+            "top_p": _DEFAULT_TOP_P,
+            "repeat_penalty": _DEFAULT_REPEAT_PENALTY,
+            "stop": _DEFAULT_STOPS,
+            "guard": GUARDRAIL_VERSION,
+            "stream_json": stream_json,
+            "json_schema": json_schema,
+        })
 
-    # 2) фолбэки по длине при неудаче
-    if out is None:
-        fb = fallback_predict or [2400, 2000, 1600, 1200, 800]
-        for np in fb:
-            try:
+    # 1) основной размер, 2) фолбэки по длине при неудаче
+    out: Optional[str] = None
+    used_predict = n_predict
+    for i, np in enumerate([n_predict] + list(fallback_predict or [2400, 2000, 1600, 1200, 800])):
+        key = cache_key(np)
+        cached = response_cache.get(key) if key else None
+        if cached is not None:
+            logger.info(f"[GEN] {label}: cache hit ({key[:12]}, n_predict={np})")
+            return cached
+        try:
+            if i:
                 logger.info(f"[GEN] {label} fallback n_predict={np}")
-                out = await _try_once(label, pp, np, retries=retries)
-                break
-            except Exception:
-                continue
-        if out is None:
-            raise TimeoutException("Генератор недоступен даже с укороченными ответами")
+            out = await _try_once(label, pp, np, retries=retries, stream_json=stream_json, json_schema=json_schema, cache_hint=cache_hint)
+            used_predict = np
+            break
+        except Exception:
+            continue
+    if out is None:
+        raise TimeoutException("Генератор недоступен даже с укороченными ответами")
 
     # 3) пост-фильтр на запрещённые фразы
     if _has_banned(out):
         logger.info(f"[GEN] {label}: banned phrases detected, rewriting")
         out = await _rewrite_without_banned(out, label)
 
+    key = cache_key(used_predict)
+    if key and out and (cache_ok is None or cache_ok(out)):
+        response_cache.put(key, out, meta={"label": label, "n_predict": used_predict})
     return out or ""
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Ограниченное декодирование (constrained decoding) для JSON-экстракции.
+- schema_from_example: JSON Schema из примера-схемы промпта (prompts._extraction_schema);
+- json_schema_to_gbnf: GBNF-грамматика llama.cpp для того же подмножества схем
+  (object с фиксированным порядком ключей, array, string, number, boolean, nullable).
+"""
+from __future__ import annotations
+
+import json
+from typing import Any, Dict, List
+
+def schema_from_example(example: Any) -> Dict[str, Any]:
+    """
+    Пример значения -> JSON Schema:
+    - dict -> object, все ключи обязательны в порядке примера;
+    - list -> array по первому элементу (пустой список -> массив строк);
+    - скаляры всегда допускают null («null где нет данных» из правил промпта — ограничение
+      не должно вынуждать модель выдумывать значение): null/"" -> string|null, 0/0.0 -> number|null.
+    """
+    if isinstance(example, dict):
+        return {
+            "type": "object",
+            "properties": {k: schema_from_example(v) for k, v in example.items()},
+            "required": list(example.keys()),
+            "additionalProperties": False,
+        }
+    if isinstance(example, list):
+        items = schema_from_example(example[0]) if example else {"type": "string"}
+        return {"type": "array", "items": items}
+    if isinstance(example, bool):
+        return {"type": ["boolean", "null"]}
+    if isinstance(example, (int, float)):
+        return {"type": ["number", "null"]}
+    return {"type": ["string", "null"]}
+
+# Базовые правила JSON (по мотивам grammars/json.gbnf из llama.cpp)
+_GBNF_BASE = r'''ws ::= [ \t\n]*
+string ::= "\"" ( [^"\\\x7F\x00-\x1F] | "\\" ( ["\\/bfnrt] | "u" [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] ) )* "\"" ws
+number ::= "-"? ( [0-9] | [1-9] [0-9]* ) ( "." [0-9]+ )? ( [eE] [-+]? [0-9]+ )? ws
+boolean ::= ( "true" | "false" ) ws
+null ::= "null" ws
+value ::= object | array | string | number | boolean | null
+object ::= "{" ws ( string ":" ws value ( "," ws string ":" ws value )* )? "}" ws
+array ::= "[" ws ( value ( "," ws value )* )? "]" ws'''
+
+_GBNF_PRIMITIVES = {"string": "string", "number": "number", "integer": "number", "boolean": "boolean", "null": "null"}
+
+def json_schema_to_gbnf(schema: Dict[str, Any]) -> str:
+    """JSON Schema (подмножество из schema_from_example) -> GBNF с корнем root."""
+    rules: List[str] = []
+    counter = [0]
+
+    def new_rule(body: str, prefix: str) -> str:
+        counter[0] += 1
+        name = f"{prefix}{counter[0]}"
+        rules.append(f"{name} ::= {body}")
+        return name
+
+    def visit(sch: Dict[str, Any]) -> str:
+        t = sch.get("type")
+        if isinstance(t, list):
+            alts = [visit({**sch, "type": x}) for x in t]
+            return "( " + " | ".join(alts) + " )"
+        if t == "object":
+            props = sch.get("properties") or {}
+            if not props:
+                return "object"
+            parts = []
+            for i, (k, sub) in enumerate(props.items()):
+                key_lit = json.dumps(json.dumps(k, ensure_ascii=False), ensure_ascii=False)
+                sep = "" if i == 0 else '"," ws '
+                parts.append(f'{sep}{key_lit} ws ":" ws {visit(sub)}')
+            return new_rule('"{" ws ' + " ".join(parts) + ' "}" ws', "obj")
+        if t == "array":
+            item = visit(sch.get("items") or {})
+            return new_rule(f'"[" ws ( {item} ( "," ws {item} )* )? "]" ws', "arr")
+        return _GBNF_PRIMITIVES.get(t, "value")
+
+    root = visit(schema)
+    return "\n".join([f"root ::= ws {root}"] + rules + [_GBNF_BASE]) + "\n"
@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""
+Фоновый приём документов (ingest).
+- upload сохраняет сырые байты в storage/<case>/raw и сразу отдаёт job_id;
+- извлечение текста (PyMuPDF), clean_text, подсчёт токенов и чанкинг идут в процессном пуле
+  (INGEST_WORKERS), файлы задания обрабатываются параллельно;
+- PDF читается с диска диапазонами по INGEST_PAGES_PER_TASK страниц в разных процессах; каждый
+  процесс сам очищает свой диапазон и пишет страницы во временный spool (storage/<case>/ingest/spool);
+  после склейки .txt и проверки хэша текста диапазоны так же параллельно режутся на чанки, и
+  build_document склеивает их построчно со сквозной нумерацией — текст страниц через родительский
+  процесс не идёт; у чанка есть source_page/page_end;
+- .txt и .jsonl пишутся атомарно (tmp + rename): хранилище чанков не увидит недописанный файл;
+- дедупликация по содержимому (ContentIndex, общий для всех дел): точный дубль сырых байт
+  распознаётся ещё при загрузке (свою копию в raw/ не хранит) и копирует чанки исходного документа
+  без обработки; при совпадении очищенного текста чанкинг пропускается, чанки берутся у исходного документа;
+- рядом с чанками пишется <doc_id>.scan.json: маркеры, заголовки постановлений/протоколов и
+  кандидаты в потерпевшие по каждому чанку — пайплайн берёт их оттуда, а не сканирует текст;
+- статус задания (по файлам: прогресс, ошибки) в памяти + копия в storage/<case>/ingest/<job_id>.json.
+"""
+from __future__ import annotations
+
+import os
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .config import logger, STORAGE_DIR, INGEST_WORKERS, INGEST_PAGES_PER_TASK
+from .io_utils import is_pdf, pdf_page_count, extract_pdf_pages, clean_text, count_tokens, storage_paths, read_json, write_json
+from .chunking import chunk_pages, scan_path, chunk_scan_record, save_chunk_scans
+
+_pool: Optional[ProcessPoolExecutor] = None
+_jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_tasks: set = set()
+_JOBS_KEEP = 200
+
+def _atomic_write_text(path: Path, text: str) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, path)
+
+def _relink_chunks(src: Path, dst: Path, doc_id: int, filename: str) -> int:
+    """
+    Копия готового .jsonl другого документа с подменой doc_id/title (без извлечения и чанкинга).
+    Индекс сканирования от doc_id не зависит и копируется как есть.
+    """
+    src_scan = scan_path(src.parent, src.stem)
+    if src_scan.exists():
+        _atomic_write_text(scan_path(dst.parent, doc_id), src_scan.read_text(encoding="utf-8"))
+    lines = []
+    with src.open("r", encoding="utf-8") as f:
+        for line in f:
+            rec = json.loads(line)
+            rec["doc_id"] = str(doc_id); rec["title"] = filename
+            lines.append(json.dumps(rec, ensure_ascii=False) + "\n")
+    _atomic_write_text(dst, "".join(lines))
+    return len(lines)
+
+def spool_pages(raw_path: str, start: Optional[int], stop: Optional[int], spool_dir: str, part: int) -> Dict[str, Any]:
+    """
+    Выполняется в дочернем процессе: диапазон страниц PDF [start, stop) (start=None — непостраничный
+    файл целиком) -> очистка. Непустые страницы пишутся в spool_dir/part-<k>.pages.jsonl
+    ({"page", "text"}); чанкинг — отдельным шагом (chunk_spool), только если текст не дубль.
+    В родителя возвращаются только метрики.
+    """
+    if start is None:
+        src: List[Tuple[Optional[int], str]] = [(None, Path(raw_path).read_bytes().decode("utf-8", errors="ignore"))]
+    else:
+        src = [(n, t) for n, t in enumerate(extract_pdf_pages(raw_path, start, stop), start=start + 1)]
+    n_pages = len(src)
+
+    tok_count = 0
+    with (Path(spool_dir) / f"part-{part}.pages.jsonl").open("w", encoding="utf-8") as f:
+        for pg, raw in src:
+            cleaned = clean_text(raw)
+            if not cleaned:
+                continue
+            f.write(json.dumps({"page": pg, "text": cleaned}, ensure_ascii=False) + "\n")
+            tok_count += count_tokens(cleaned)
+    return {"pages": n_pages, "tokens": tok_count}
+
+def _spool_page_texts(spool_dir: Path, part: int) -> Iterator[Tuple[Optional[int], str]]:
+    with (spool_dir / f"part-{part}.pages.jsonl").open("r", encoding="utf-8") as f:
+        for line in f:
+            rec = json.loads(line)
+            yield rec["page"], rec["text"]
+
+def chunk_spool(spool_dir: str, part: int) -> int:
+    """
+    Выполняется в дочернем процессе: очищенные страницы диапазона -> part-<k>.jsonl (нумерация
+    локальная, сквозную проставляет build_document). Возвращает число чанков.
+    """
+    chunks = chunk_pages(_spool_page_texts(Path(spool_dir), part), continued=part > 0)
+    with (Path(spool_dir) / f"part-{part}.jsonl").open("w", encoding="utf-8") as f:
+        for ch in chunks:
+            f.write(json.dumps(ch, ensure_ascii=False) + "\n")
+    return len(chunks)
+
+def merge_spool_text(spool_dir: Path, n_parts: int, txt_path: Path) -> Tuple[str, int]:
+    """
+    Склейка очищенных страниц всех диапазонов через "\\n" в итоговый .txt потоком (tmp + rename)
+    с sha256 — тот же текст, что дала бы очистка файла целиком. Возвращает (sha256, число символов).
+    """
+    sha = hashlib.sha256()
+    chars = 0
+    tmp = txt_path.with_name(txt_path.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as out:
+        for k in range(n_parts):
+            for _, text in _spool_page_texts(spool_dir, k):
+                if chars:
+                    text = "\n" + text
+                out.write(text); sha.update(text.encode("utf-8")); chars += len(text)
+    os.replace(tmp, txt_path)
+    return sha.hexdigest(), chars
+
+def build_document(spool_dir: str, n_parts: int, doc_id: int, filename: str, chunks_dir: str,
+                   text_source: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Выполняется в дочернем процессе: чанки диапазонов из spool -> .jsonl документа (+ .scan.json).
+    Чанки читаются построчно; chunk_id — сквозной, хвост секции в начале диапазона (doc_type=None)
+    получает section_id/heading/doc_type последней секции предыдущего диапазона.
+    text_source — .jsonl документа с тем же очищенным текстом (ContentIndex.lookup_text):
+    тогда чанки копируются оттуда (dedup="text").
+    """
+    dst = Path(chunks_dir) / f"{doc_id}.jsonl"
+    if text_source and Path(text_source).exists():
+        return {"chunks": _relink_chunks(Path(text_source), dst, doc_id, filename), "dedup": "text"}
+
+    scans: List[Dict[str, Any]] = []
+    sid, heading, doc_type = -1, None, "unknown"
+    tmp = dst.with_name(dst.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as out:
+        for k in range(n_parts):
+            sections: Dict[int, int] = {}
+            with (Path(spool_dir) / f"part-{k}.jsonl").open("r", encoding="utf-8") as f:
+                for line in f:
+                    ch = json.loads(line)
+                    if ch["section_id"] not in sections:
+                        if ch["doc_type"] is None and sid >= 0:
+                            sections[ch["section_id"]] = sid
+                        else:
+                            sid += 1
+                            sections[ch["section_id"]] = sid
+                            heading, doc_type = ch["heading"], ch["doc_type"] or "unknown"
+                    ch.update(chunk_id=len(scans), section_id=sections[ch["section_id"]], heading=heading, doc_type=doc_type)
+                    out.write(json.dumps({"doc_id": str(doc_id), "title": filename, **ch}, ensure_ascii=False) + "\n")
+                    scans.append(chunk_scan_record(ch))
+    save_chunk_scans(scan_path(chunks_dir, doc_id), scans)
+    os.replace(tmp, dst)
+    return {"chunks": len(scans)}
+
+def link_document(src_case: int, src_doc: int, case_id: int, doc_id: int, filename: str) -> Dict[str, Any]:
+    """Точный дубль по сырым байтам: .txt и чанки копируются у исходного документа."""
+    t0 = time.monotonic()
+    sp, dp = storage_paths(src_case), storage_paths(case_id)
+    n = _relink_chunks(sp["chunks"] / f"{src_doc}.jsonl", dp["chunks"] / f"{doc_id}.jsonl", doc_id, filename)
+    src_txt = next(iter(sp["docs"].glob(f"{src_doc}_*.txt")), None)
+    if src_txt is not None:
+        shutil.copyfile(src_txt, dp["docs"] / f"{doc_id}_{filename}.txt")
+    return {"chunks": n, "dedup": "raw", "seconds": round(time.monotonic() - t0, 3)}
+
+def original_raw(ref: Dict[str, Any]) -> Optional[Path]:
+    """Сырой файл документа ref={"case_id", "doc_id"} (точные дубли своей копии не хранят)."""
+    return next(iter(storage_paths(ref["case_id"])["raw"].glob(f"{ref['doc_id']}_*")), None)
+
+class ContentIndex:
+    """
+    Общий для всех дел индекс содержимого (storage/docs/_content_index.json):
+    raw — sha256 сырых байт -> документ; text — sha256 очищенного текста -> документ.
+    Записи проверяются по наличию .jsonl (удалённые документы игнорируются).
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data: Optional[Dict[str, Dict[str, Any]]] = None
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if self._data is None:
+            try:
+                self._data = read_json(self.path, None) or {}
+            except ValueError:
+                self._data = {}
+            self._data.setdefault("raw", {}); self._data.setdefault("text", {})
+        return self._data
+
+    @staticmethod
+    def _chunks_path(ref: Dict[str, Any]) -> Path:
+        return storage_paths(ref["case_id"])["chunks"] / f"{ref['doc_id']}.jsonl"
+
+    def lookup_raw(self, raw_sha: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            ref = self._load()["raw"].get(raw_sha)
+        return ref if ref and self._chunks_path(ref).exists() else None
+
+    def lookup_text(self, text_sha: str) -> Optional[str]:
+        """.jsonl документа с тем же очищенным текстом (если он ещё существует)."""
+        with self._lock:
+            ref = self._load()["text"].get(text_sha)
+        path = self._chunks_path(ref) if ref else None
+        return str(path) if path is not None and path.exists() else None
+
+    def register(self, case_id: int, doc_id: int, raw_sha: Optional[str], text_sha: Optional[str]) -> None:
+        ref = {"case_id": case_id, "doc_id": doc_id}
+        with self._lock:
+            data = self._load()
+            if raw_sha:
+                data["raw"][raw_sha] = ref
+            if text_sha:
+                data["text"].setdefault(text_sha, ref)
+                # исходник мог быть удалён — перепривязываем на живой документ
+                if not self._chunks_path(data["text"][text_sha]).exists():
+                    data["text"][text_sha] = ref
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                _atomic_write_text(self.path, json.dumps(data, ensure_ascii=False))
+            except OSError as e:
+                logger.warning(f"[INGEST] cannot persist content index: {e}")
+
+content_index = ContentIndex(STORAGE_DIR / "_content_index.json")
+
+def get_ingest_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn: не форкаем процесс с работающим event loop и открытыми соединениями
+        _pool = ProcessPoolExecutor(max_workers=max(1, INGEST_WORKERS), mp_context=multiprocessing.get_context("spawn"))
+        logger.info(f"[INGEST] process pool started: workers={max(1, INGEST_WORKERS)}")
+    return _pool
+
+def shutdown_ingest_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def _save_job(job: Dict[str, Any]) -> None:
+    try:
+        write_json(storage_paths(job["case_id"])["ingest"] / f"{job['job_id']}.json", job)
+    except OSError as e:
+        logger.warning(f"[INGEST] cannot persist job {job['job_id']}: {e}")
+
+def _finish_status(job: Dict[str, Any]) -> str:
+    if job["failed"] == 0:
+        return "done"
+    return "failed" if job["done"] == 0 else "partial"
+
+async def _spool_document(rec: Dict[str, Any], raw_path: Path, spool_dir: Path) -> Tuple[int, Dict[str, Any]]:
+    """
+    Извлечение и очистка по диапазонам INGEST_PAGES_PER_TASK страниц параллельно в пуле (непостраничный
+    файл — одним диапазоном). Текст страниц в родительский процесс не передаётся.
+    Возвращает (число диапазонов, суммарные метрики).
+    """
+    loop = asyncio.get_running_loop()
+    spool_dir.mkdir(parents=True, exist_ok=True)
+    if not is_pdf(rec["filename"], rec["content_type"]):
+        res = await loop.run_in_executor(get_ingest_pool(), spool_pages, str(raw_path), None, None, str(spool_dir), 0)
+        return 1, {"pages": None, "tokens": res["tokens"]}
+
+    n = await loop.run_in_executor(get_ingest_pool(), pdf_page_count, str(raw_path))
+    rec["pages_total"] = n
+    rec["pages_done"] = 0
+    step = max(1, INGEST_PAGES_PER_TASK)
+
+    async def one(part: int, start: int) -> Dict[str, Any]:
+        res = await loop.run_in_executor(get_ingest_pool(), spool_pages, str(raw_path), start, start + step, str(spool_dir), part)
+        rec["pages_done"] += res["pages"]
+        return res
+
+    parts = await asyncio.gather(*(one(k, start) for k, start in enumerate(range(0, n, step))))
+    return len(parts), {"pages": n, "tokens": sum(p["tokens"] for p in parts)}
+
+async def _run_file(job: Dict[str, Any], rec: Dict[str, Any], raw_path: Path, paths: Dict[str, Path]) -> None:
+    global _pool
+    loop = asyncio.get_running_loop()
+    rec["status"] = "running"
+    t0 = time.monotonic()
+    try:
+        ref = content_index.lookup_raw(rec["raw_sha"]) if rec.get("same_as") else None
+        if ref is not None:
+            res = await asyncio.to_thread(link_document, ref["case_id"], ref["doc_id"], job["case_id"], rec["doc_id"], rec["filename"])
+        else:
+            spool_dir = paths["ingest"] / "spool" / f"{job['job_id']}-{rec['doc_id']}"
+            try:
+                n_parts, res = await _spool_document(rec, raw_path, spool_dir)
+                txt_path = paths["docs"] / f"{rec['doc_id']}_{rec['filename']}.txt"
+                res["text_sha"], res["chars"] = await asyncio.to_thread(merge_spool_text, spool_dir, n_parts, txt_path)
+                # хэш текста известен до чанкинга: у дубля чанки копируются, диапазоны не режутся
+                text_source = content_index.lookup_text(res["text_sha"])
+                if text_source is None:
+                    await asyncio.gather(*(loop.run_in_executor(get_ingest_pool(), chunk_spool, str(spool_dir), k) for k in range(n_parts)))
+                res.update(await loop.run_in_executor(
+                    get_ingest_pool(), build_document,
+                    str(spool_dir), n_parts, rec["doc_id"], rec["filename"], str(paths["chunks"]), text_source,
+                ))
+            finally:
+                shutil.rmtree(spool_dir, ignore_errors=True)
+            res["seconds"] = round(time.monotonic() - t0, 3)
+        content_index.register(job["case_id"], rec["doc_id"], rec.get("raw_sha"), res.pop("text_sha", None))
+        rec.update(res, status="done")
+        job["done"] += 1
+        if res.get("dedup"):
+            job["dedup_hits"] += 1
+        logger.info(f"[INGEST] job={job['job_id']} file='{rec['filename']}' doc_id={rec['doc_id']} pages={res.get('pages')} len={res.get('chars')} tokens={res.get('tokens')} chunks={res['chunks']} dedup={res.get('dedup')} {res['seconds']}s")
+    except Exception as e:
+        if isinstance(e, BrokenProcessPool):
+            # упавший воркер ломает весь пул — следующий файл поднимет новый
+            _pool = None
+        rec.update(status="error", error=f"{type(e).__name__}: {e}")
+        job["failed"] += 1
+        logger.error(f"[INGEST] job={job['job_id']} file='{rec['filename']}' doc_id={rec['doc_id']} error: {e}")
+    _save_job(job)
+
+async def _run_job(job: Dict[str, Any], raw_paths: List[Path], on_failed: Optional[Callable[[List[int]], None]]) -> None:
+    paths = storage_paths(job["case_id"])
+    job["status"] = "running"
+    job["started_at"] = time.time()
+    _save_job(job)
+    # сначала оригиналы, затем дубли (в т.ч. дубли файлов из этого же задания)
+    items = list(zip(job["files"], raw_paths))
+    for phase in (False, True):
+        await asyncio.gather(*(_run_file(job, rec, rp, paths) for rec, rp in items if bool(rec.get("same_as")) == phase))
+    job["status"] = _finish_status(job)
+    job["finished_at"] = time.time()
+    _save_job(job)
+    logger.info(f"[INGEST] job={job['job_id']} case_id={job['case_id']} {job['status']}: done={job['done']} failed={job['failed']} dedup={job['dedup_hits']} in {job['finished_at'] - job['started_at']:.1f}s")
+    failed_ids = [rec["doc_id"] for rec in job["files"] if rec["status"] == "error"]
+    if failed_ids and on_failed is not None:
+        try:
+            on_failed(failed_ids)
+        except Exception as e:
+            logger.warning(f"[INGEST] on_failed callback error: {e}")
+
+def start_ingest_job(case_id: int, files: List[Dict[str, Any]], on_failed: Optional[Callable[[List[int]], None]] = None) -> Dict[str, Any]:
+    """
+    files: [{"doc_id", "filename", "content_type", "raw_path", "raw_sha"?, "same_as"?}] — сырые байты уже на диске;
+    same_as={"case_id", "doc_id"} — точный дубль, чанки копируются без обработки (raw_path — файл оригинала).
+    Запускает фоновую задачу и сразу возвращает описание задания.
+    """
+    job = {
+        "job_id": uuid.uuid4().hex,
+        "case_id": case_id,
+        "status": "queued",
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "total": len(files),
+        "done": 0,
+        "failed": 0,
+        "dedup_hits": 0,
+        "files": [
+            {"doc_id": f["doc_id"], "filename": f["filename"], "content_type": f["content_type"],
+             "raw_sha": f.get("raw_sha"), "same_as": f.get("same_as"), "status": "queued", "error": None}
+            for f in files
+        ],
+    }
+    _jobs[job["job_id"]] = job
+    while len(_jobs) > _JOBS_KEEP:
+        _jobs.popitem(last=False)
+    _save_job(job)
+
+    task = asyncio.create_task(_run_job(job, [Path(f["raw_path"]) for f in files], on_failed))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return job
+
+def get_ingest_job(case_id: int, job_id: str) -> Optional[Dict[str, Any]]:
+    job = _jobs.get(job_id)
+    if job is None:
+        # после рестарта — последняя сохранённая копия
+        job = read_json(storage_paths(case_id)["ingest"] / f"{job_id}.json", None)
+    if job is None or job.get("case_id") != case_id:
+        return None
+    return job
+
+def list_ingest_jobs(case_id: int) -> List[Dict[str, Any]]:
+    d = storage_paths(case_id)["ingest"]
+    jobs = {j["job_id"]: j for j in _jobs.values() if j["case_id"] == case_id}
+    if d.exists():
+        for fn in d.glob("*.json"):
+            if fn.stem not in jobs:
+                try:
+                    jobs[fn.stem] = read_json(fn, None)
+                except ValueError:
+                    continue
+    out = [{k: v for k, v in j.items() if k != "files"} for j in jobs.values() if j]
+    out.sort(key=lambda j: j.get("created_at") or 0, reverse=True)
+    return out
+
+def ingest_active(case_id: int) -> bool:
+    """Есть ли незавершённое задание по делу (пайплайн не должен читать чанки посреди приёма)."""
+    return any(j["case_id"] == case_id and j["status"] in ("queued", "running") for j in _jobs.values())
@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
 import re, json
-from typing import Any, Dict
+from functools import lru_cache
+from typing import Any, Dict, List
 from pathlib import Path
 import fitz  # PyMuPDF
 import tiktoken
-from fastapi import UploadFile
 
 from .config import MODEL_ENCODING, STORAGE_DIR
 
+@lru_cache(maxsize=None)
+def get_encoder() -> "tiktoken.Encoding":
+    """Энкодер создаётся один раз на процесс (get_encoding грузит BPE-таблицы)."""
+    return tiktoken.get_encoding(MODEL_ENCODING)
+
 def count_tokens(text: str) -> int:
-    enc = tiktoken.get_encoding(MODEL_ENCODING)
-    return len(enc.encode(text))
+    return len(get_encoder().encode(text))
 
 def count_words(text: str) -> int:
     return len(re.findall(r"\b\w+\b", text, flags=re.UNICODE))
@@ -19,10 +23,15 @@ def storage_paths(case_id: int) -> Dict[str, Path]:
     base = STORAGE_DIR / str(case_id)
     return {
         "base": base,
+        "raw": base / "raw",
+        "ingest": base / "ingest",
         "docs": base / "docs",
         "chunks": base / "chunks",
+        "store": base / "chunkstore",
         "state_dir": base / "state",
         "state": base / "state" / "global_state.json",
+        "manifest": base / "state" / "run_manifest.json",
+        "clusters": base / "state" / "clusters.json",
     }
 
 def read_json(path: Path, default):
@@ -49,8 +58,15 @@ def clean_text(text: str) -> str:
         out.append(ln)
     return "\n".join(out).strip()
 
-def extract_text(file: UploadFile, content: bytes) -> str:
-    if file.content_type == "application/pdf" or file.filename.lower().endswith(".pdf"):
-        with fitz.open(stream=content, filetype="pdf") as doc:
-            return "\n".join(page.get_text() for page in doc)
-    return content.decode("utf-8", errors="ignore")
+def is_pdf(filename: str, content_type: str) -> bool:
+    return content_type == "application/pdf" or (filename or "").lower().endswith(".pdf")
+
+def pdf_page_count(path: str) -> int:
+    with fitz.open(path) as doc:
+        return doc.page_count
+
+def extract_pdf_pages(path: str, start: int, stop: int) -> List[str]:
+    """Текст страниц [start, stop) PDF-файла с диска (без загрузки всего файла в память как bytes)."""
+    with fitz.open(path) as doc:
+        return [doc[i].get_text() for i in range(start, min(stop, doc.page_count))]
+
@@ -18,6 +18,7 @@ import httpx
 
 from .config import logger
 from .io_utils import count_tokens, storage_paths
+from .scanner import Scanner
 
 # ---------- Markdown fences ----------
 MD_FENCE_RE = re.compile(r"```(?:[a-zA-Z]+)?\s*([\s\S]*?)```", re.IGNORECASE)
@@ -37,6 +38,9 @@ PLATFORM_PATTERNS = [
     (re.compile(r"\bKaspi\b", re.IGNORECASE), "KASPI"),
     (re.compile(r"\bTakorp\b", re.IGNORECASE), "TAKORP"),
 ]
+# те же платформы одним проходом; SCENARIO_HINTS так не объединить — их виды перекрываются
+# («OKX» — и okx_wallet, и p2p_buy рядом), а альтернация отдаёт позицию только первому виду
+PLATFORM_SCANNER = Scanner([(name, rx.pattern) for rx, name in PLATFORM_PATTERNS], flags=re.IGNORECASE)
 SCENARIO_HINTS = {
     "invite": re.compile(r"реферал|реферальн|приглас|5\s*челов", re.IGNORECASE),
     "register": re.compile(r"зарегистр|реферал.*ссылк|получил.*ссылк", re.IGNORECASE),
@@ -126,6 +130,62 @@ def extract_first_json_block(s: str) -> str:
                 return cand[i : j + 1]
     return cand[i:]
 
+def is_complete_json(s: str) -> bool:
+    """
+    Ответ годится в кэш генератора: первый JSON-объект закрыт (не оборван по n_predict/стриму)
+    и разбирается так же, как в parse_or_retry_json (с json_repair_min).
+    """
+    try:
+        blk = extract_first_json_block(s)
+        if balance_json_brackets(blk) != blk.strip():
+            return False
+        json.loads(json_repair_min(blk))
+        return True
+    except Exception:
+        return False
+
+class JsonObjectTracker:
+    """
+    Инкрементальный аналог extract_first_json_block для стриминга:
+    получает текст кусками и сообщает, когда первый JSON-объект верхнего уровня закрылся.
+    """
+    __slots__ = ("depth", "in_str", "esc", "started", "done")
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.in_str = False
+        self.esc = False
+        self.started = False
+        self.done = False
+
+    def feed(self, piece: str) -> bool:
+        if self.done:
+            return True
+        for ch in piece:
+            if not self.started:
+                if ch == "{":
+                    self.started = True
+                    self.depth = 1
+                continue
+            if self.in_str:
+                if self.esc:
+                    self.esc = False
+                elif ch == "\\":
+                    self.esc = True
+                elif ch == '"':
+                    self.in_str = False
+                continue
+            if ch == '"':
+                self.in_str = True
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.done = True
+                    return True
+        return False
+
 def log_batch_raw(batch_id: str | int, label: str, text: str):
     logger.info(
         f"\n===== BATCH {batch_id} RAW {label} START =====\n{text}\n===== BATCH {batch_id} RAW {label} END =====\n"
@@ -137,9 +197,14 @@ async def parse_or_retry_json(
     n_predict: int,
     batch_id: str | int,
     max_retries: int = 3,
+    prompt_tokens: Optional[int] = None,
 ) -> Dict[str, Any]:
-    """Главная точка входа: получить из LLM валидный JSON dict с ретраями/ремонтом."""
-    prompt_tokens = count_tokens(first_prompt)
+    """
+    Главная точка входа: получить из LLM валидный JSON dict с ретраями/ремонтом.
+    prompt_tokens — уже посчитанный размер промпта (чтобы не токенизировать его повторно).
+    """
+    if prompt_tokens is None:
+        prompt_tokens = count_tokens(first_prompt)
     logger.info(f"[EXTRACT] B{batch_id}: prompt_tokens={prompt_tokens}, n_predict={n_predict}")
     raw_first = await call_fn(first_prompt, n_predict=n_predict)
     log_batch_raw(batch_id, "FIRST", raw_first)
@@ -256,12 +321,10 @@ def _platforms_from_text(text: Optional[str]) -> List[Dict[str, Optional[str]]]:
     acc: List[Dict[str, Optional[str]]] = []
     if not text:
         return acc
-    seen = set()
-    for rx, name in PLATFORM_PATTERNS:
-        if rx.search(text):
-            if name not in seen:
-                seen.add(name)
-                acc.append({"service": name, "id": None})
+    found = PLATFORM_SCANNER.kinds(text)
+    for _, name in PLATFORM_PATTERNS:
+        if name in found:
+            acc.append({"service": name, "id": None})
     return acc
 
 def extract_scenario_from_text(text: str) -> List[Dict[str, Any]]:
@@ -467,6 +530,7 @@ def unify_victims_from_response(
 __all__ = [
     "parse_or_retry_json",
     "extract_first_json_block",
+    "JsonObjectTracker",
     "json_repair_min",
     "extract_scenario_from_text",
     "unify_victim_record",
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
-import re, hashlib
+import re, copy, hashlib
 from typing import Optional, Dict, Any, Set, List, Tuple
 from collections import defaultdict, deque
 
+from .config import CLUSTER_HUB_DF, CLUSTER_HUB_MIN_DOCS, CLUSTER_MAX_SIZE
+from .scanner import Scanner, spans_of
+
 # ------------ Базовые маркеры ------------
 IIN_RE = re.compile(r"\b\d{12}\b")
 PHONE_RE = re.compile(r"\b(?:\+7|8)\s?[\(\s-]?\d{3}[\)\s-]?\s?\d{3}[-\s]?\d{2}[-\s]?\d{2}\b")
@@ -34,6 +37,60 @@ PH_REF = re.compile(r"реферал|реферальн", re.IGNORECASE)
 PH_TASKS = re.compile(r"задан", re.IGNORECASE)
 PH_WITHDRAW = re.compile(r"вывод|блокир", re.IGNORECASE)
 
+# ------------ Однопроходный сканер чанков ------------
+# маркеры + заголовки постановлений/протоколов за один проход по тексту чанка. Карта, телефон,
+# e-mail и tg налегают на соседние маркеры («1111\n701123456709» — карта и ИИН, «@ivan@mail.kz» —
+# tg и e-mail), поэтому у них свои проходы и результат совпадает с раздельными регулярками;
+# единственное отличие — «@домен» внутри e-mail Telegram-ником не считается
+# (регистронезависимы только IBAN и заголовки — глобальный IGNORECASE замедляет весь проход)
+CHUNK_SCANNER = Scanner([
+    ("iin", IIN_RE.pattern), ("card", CARD_RE.pattern), ("phone", PHONE_RE.pattern),
+    ("iban", f"(?i:{IBAN_RE.pattern})"), ("email", EMAIL_RE.pattern), ("tg", TG_RE.pattern),
+    ("postanov", f"(?i:{POSTANOV_RE.pattern})"), ("protokol", f"(?i:{PROTOKOL_VICTIM_RE.pattern})"),
+], first_chars=r"\dKkПп", separate={"card": None, "phone": None, "email": "@", "tg": "@"}, drop_inside=[("email", "tg")])
+MARKER_KINDS = ("iin", "phone", "iban", "card", "email", "tg")
+STEP_SCANNER = Scanner([
+    ("ref", PH_REF.pattern), ("register", PH_REGISTER.pattern), ("okx", PH_OKX.pattern),
+    ("usdt", PH_USDT.pattern), ("p2p", PH_P2P.pattern), ("tasks", PH_TASKS.pattern),
+    ("withdraw", PH_WITHDRAW.pattern),
+], flags=re.IGNORECASE)
+
+# Результат сканирования чанка (см. scan_chunk_text) считается при ingest'е и хранится рядом
+# с чанками (<doc_id>.scan.json, chunking.load_chunk_scans); пайплайн только подгружает его в кэш.
+# SCAN_VERSION менять при изменении CHUNK_SCANNER/извлечения потерпевших — индексы пересчитаются.
+SCAN_VERSION = 2
+_SCAN_CACHE: Dict[str, Dict[str, Any]] = {}
+_SCAN_CACHE_MAX = 200_000
+
+def scan_chunk_text(text: str) -> Dict[str, Any]:
+    """
+    Один проход CHUNK_SCANNER по тексту чанка:
+    markers — маркеры MARKER_KINDS, tags — найденные заголовки (postanov/protokol),
+    victims — кандидаты в потерпевшие из постановления (doc_refs проставляет bootstrap).
+    """
+    spans = CHUNK_SCANNER.scan(text)
+    tags = sorted({s.kind for s in spans} & {"postanov", "protokol"})
+    return {
+        "markers": sorted({s.text.strip() for s in spans_of(spans, MARKER_KINDS)}),
+        "tags": tags,
+        "victims": extract_victims_from_postanov_text(text) if "postanov" in tags else [],
+    }
+
+def remember_chunk_scan(key: str, scan: Dict[str, Any]) -> None:
+    if len(_SCAN_CACHE) >= _SCAN_CACHE_MAX:
+        _SCAN_CACHE.pop(next(iter(_SCAN_CACHE)))
+    _SCAN_CACHE[key] = scan
+
+def chunk_scan(ch: Dict[str, Any]) -> Dict[str, Any]:
+    """Сканирование чанка по hash из кэша (предзагруженного из индексов ingest'а); иначе — проход по тексту."""
+    key = ch.get("hash")
+    if key is not None and key in _SCAN_CACHE:
+        return _SCAN_CACHE[key]
+    scan = scan_chunk_text(ch.get("text", ""))
+    if key is not None:
+        remember_chunk_scan(key, scan)
+    return scan
+
 # ------------ Нормализация/ключи ------------
 def norm_email(s: Optional[str]) -> Optional[str]:
     return s.strip().lower() if s else None
@@ -82,6 +139,37 @@ def victim_entity_key(v: Dict[str, Any]) -> Optional[str]:
         return f"name:{nm}"
     return None
 
+def victim_identifiers(v: Dict[str, Any]) -> List[str]:
+    """
+    Все идентификаторы записи потерпевшего (для индекса сущностей), от сильных к слабым:
+    iin, iban, card (хэш), email, phone, name|dob, name. Голое ФИО — только у записи без
+    других идентификаторов: однофамильцы с разными телефонами/e-mail через него не связываются.
+    """
+    ids: List[str] = []
+    iin = re.sub(r"\D+", "", str(v.get("iin") or ""))
+    if iin:
+        ids.append(f"iin:{iin}")
+    iban = norm_iban(v.get("iban")) if v.get("iban") else None
+    if iban:
+        ids.append(f"iban:{iban}")
+    card = norm_card(v.get("card")) if v.get("card") else None
+    card_hash = hash_card(card) if card else v.get("card_hash")
+    if card_hash:
+        ids.append(f"card:{card_hash}")
+    email = norm_email(v.get("email")) if v.get("email") else None
+    if email:
+        ids.append(f"email:{email}")
+    phone = norm_phone(v.get("phone")) if v.get("phone") else None
+    if phone:
+        ids.append(f"phone:{phone}")
+    nm = canonical_name(v.get("name"))
+    dob = (v.get("dob") or "").strip() if isinstance(v.get("dob"), str) else None
+    if nm and dob:
+        ids.append(f"name:{nm}|dob:{dob}")
+    if nm and not ids:
+        ids.append(f"name:{nm}")
+    return ids
+
 def doc_ids_from_refs(refs: List[str]) -> List[str]:
     out = []
     for r in refs or []:
@@ -91,47 +179,75 @@ def doc_ids_from_refs(refs: List[str]) -> List[str]:
 
 # ------------ Кластеризация по маркерам ------------
 def extract_markers_from_text(t: str) -> Set[str]:
-    markers: Set[str] = set()
-    for rx in (IIN_RE, PHONE_RE, IBAN_RE, CARD_RE, EMAIL_RE, TG_RE):
-        for m in rx.findall(t):
-            markers.add(m.strip())
-    return markers
+    return {s.text.strip() for s in spans_of(CHUNK_SCANNER.scan(t), MARKER_KINDS)}
 
 def build_doc_markers(docs_map: Dict[str, List[Dict[str, Any]]], first_n_chunks: int) -> Dict[str, Set[str]]:
     doc_markers: Dict[str, Set[str]] = {}
     for doc_id, chunks in docs_map.items():
-        text = "\n".join(ch.get("text", "") for ch in chunks[:first_n_chunks])
-        doc_markers[doc_id] = extract_markers_from_text(text)
+        doc_markers[doc_id] = {m for ch in chunks[:first_n_chunks] for m in chunk_scan(ch)["markers"]}
     return doc_markers
 
-def cluster_docs_by_markers(doc_markers: Dict[str, Set[str]]) -> List[List[str]]:
+def cluster_docs_by_markers(doc_markers: Dict[str, Set[str]], hub_df: float = CLUSTER_HUB_DF,
+                            max_size: int = CLUSTER_MAX_SIZE, report: Optional[Dict[str, Any]] = None) -> List[List[str]]:
+    """
+    Кластеры документов — компоненты связности «документ — общий маркер»:
+    - union-find по постингам маркер -> документы: O(сумма постингов), без перебора пар;
+    - hub-маркеры (в большем числе документов, чем max(CLUSTER_HUB_MIN_DOCS, hub_df·N)) связей не дают;
+    - max_size > 0 — кластер не растёт сверх max_size документов; маркеры применяются
+      от редких к частым, поэтому первыми склеиваются самые специфичные связи.
+    report — сюда складывается диагностика: подавленные маркеры (с df), граф кластеров
+    (маркер -> документы, давшие склейку) и слияния, отклонённые по max_size.
+    """
+    all_docs = sorted(doc_markers.keys(), key=lambda x: int(x))
     marker_to_docs: Dict[str, List[str]] = defaultdict(list)
-    for d, marks in doc_markers.items():
-        for m in marks:
+    for d in all_docs:
+        for m in doc_markers[d]:
             marker_to_docs[m].append(d)
 
-    adj: Dict[str, Set[str]] = defaultdict(set)
-    for docs in marker_to_docs.values():
-        for i in range(len(docs)):
-            for j in range(i + 1, len(docs)):
-                a, b = docs[i], docs[j]
-                adj[a].add(b); adj[b].add(a)
+    hub_limit = max(CLUSTER_HUB_MIN_DOCS, int(hub_df * len(all_docs)))
+    suppressed = {m: len(docs) for m, docs in marker_to_docs.items() if len(docs) > hub_limit}
 
-    visited: Set[str] = set()
-    clusters: List[List[str]] = []
-    all_docs = sorted(doc_markers.keys(), key=lambda x: int(x))
+    parent = {d: d for d in all_docs}
+    size = {d: 1 for d in all_docs}
+
+    def find(x: str) -> str:
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    graph: Dict[str, List[str]] = {}
+    rejected: List[Tuple[str, str, str]] = []
+    links = sorted((m for m, docs in marker_to_docs.items() if len(docs) > 1 and m not in suppressed),
+                   key=lambda m: (len(marker_to_docs[m]), m))
+    for m in links:
+        docs = marker_to_docs[m]
+        for d in docs[1:]:
+            ra, rb = find(docs[0]), find(d)
+            if ra == rb:
+                continue
+            if max_size and size[ra] + size[rb] > max_size:
+                rejected.append((m, docs[0], d))
+                continue
+            if size[ra] < size[rb]:
+                ra, rb = rb, ra
+            parent[rb] = ra
+            size[ra] += size[rb]
+            graph.setdefault(m, []).append(d)
+
+    comps: Dict[str, List[str]] = {}
     for d in all_docs:
-        if d in visited: continue
-        comp = []
-        q = deque([d]); visited.add(d)
-        while q:
-            cur = q.popleft(); comp.append(cur)
-            for nb in adj.get(cur, []):
-                if nb not in visited:
-                    visited.add(nb); q.append(nb)
-        clusters.append(sorted(comp, key=lambda x: int(x)))
-    if not any(len(c) > 1 for c in clusters):
-        clusters = [[d] for d in all_docs]
+        comps.setdefault(find(d), []).append(d)
+    clusters = list(comps.values())  # по возрастанию минимального doc_id, внутри — по doc_id
+
+    if report is not None:
+        report["hub_limit"] = hub_limit
+        report["suppressed_markers"] = dict(sorted(suppressed.items(), key=lambda kv: -kv[1]))
+        report["graph"] = {m: [marker_to_docs[m][0]] + docs for m, docs in graph.items()}
+        report["rejected_by_size"] = rejected
+        report["clusters"] = clusters
     return clusters
 
 # ------------ Извлечение потерпевших из ПОСТАНОВЛЕНИЙ ------------
@@ -168,8 +284,7 @@ def find_postanov_chunks(docs_map: Dict[str, List[Dict[str, Any]]]) -> List[Tupl
     targets: List[Tuple[str,int]] = []
     for doc_id, chunks in docs_map.items():
         for ch in chunks[:6]:
-            t = ch.get("text","")
-            if POSTANOV_RE.search(t):
+            if "postanov" in chunk_scan(ch)["tags"]:
                 targets.append((doc_id, int(ch.get("chunk_id",0))))
                 break
     return targets
@@ -178,9 +293,9 @@ def bootstrap_victims_from_postanov(docs_map: Dict[str, List[Dict[str, Any]]]) -
     result: List[Dict[str, Any]] = []
     for doc_id, chunks in docs_map.items():
         for ch in chunks[:6]:
-            t = ch.get("text","")
-            if POSTANOV_RE.search(t):
-                vs = extract_victims_from_postanov_text(t)
+            scan = chunk_scan(ch)
+            if "postanov" in scan["tags"]:
+                vs = copy.deepcopy(scan["victims"])  # кэш не должен делить объекты со state
                 for v in vs:
                     v["doc_refs"] = [f"doc:{doc_id}#chunk:{ch.get('chunk_id')}"]
                 result.extend(vs)
@@ -196,13 +311,14 @@ def extract_steps_from_protokol(text: str) -> List[Dict[str, Any]]:
         steps.append({"order": order, "date": None, "action": action, "details": details, "doc_refs": []})
         order += 1
 
-    if PH_REF.search(text): add("Получил реферальную ссылку/приглашение", "Указан реферальный канал/привлекающий")
-    if PH_REGISTER.search(text): add("Регистрация на платформе", "Регистрация аккаунта (TAKORP/OKX/другое)")
-    if PH_OKX.search(text): add("Создание/использование кошелька OKX", "Аккаунт/кошелёк OKX")
-    if PH_USDT.search(text): add("Операции с USDT", "Покупка/перевод USDT")
-    if PH_P2P.search(text): add("Покупка через P2P/Kaspi", "Использование P2P/Kaspi/банков")
-    if PH_TASKS.search(text): add("Выполнение заданий/получение бонусов", "Описаны задания/бонусы")
-    if PH_WITHDRAW.search(text): add("Попытка вывода/блокировка", "Попытка вывести средства/блокировка вывода")
+    found = STEP_SCANNER.kinds(text)
+    if "ref" in found: add("Получил реферальную ссылку/приглашение", "Указан реферальный канал/привлекающий")
+    if "register" in found: add("Регистрация на платформе", "Регистрация аккаунта (TAKORP/OKX/другое)")
+    if "okx" in found: add("Создание/использование кошелька OKX", "Аккаунт/кошелёк OKX")
+    if "usdt" in found: add("Операции с USDT", "Покупка/перевод USDT")
+    if "p2p" in found: add("Покупка через P2P/Kaspi", "Использование P2P/Kaspi/банков")
+    if "tasks" in found: add("Выполнение заданий/получение бонусов", "Описаны задания/бонусы")
+    if "withdraw" in found: add("Попытка вывода/блокировка", "Попытка вывести средства/блокировка вывода")
 
     return steps
 
@@ -210,8 +326,7 @@ def find_protokol_chunks(docs_map: Dict[str, List[Dict[str, Any]]]) -> List[Tupl
     targets: List[Tuple[str,int]] = []
     for doc_id, chunks in docs_map.items():
         for ch in chunks:
-            t = ch.get("text","")
-            if PROTOKOL_VICTIM_RE.search(t):
+            if "protokol" in chunk_scan(ch)["tags"]:
                 targets.append((doc_id, int(ch.get("chunk_id",0))))
                 break
     return targets
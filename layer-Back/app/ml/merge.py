@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Dict, List, Optional, Set, Tuple
+import re
 import json
+import heapq
 
+from .pattern_match import AhoCorasick
 from .markers import (
     norm_phone, norm_email, norm_iban, norm_card, hash_card,
-    canonical_name, victim_entity_key, doc_ids_from_refs
+    canonical_name, victim_entity_key, victim_identifiers, doc_ids_from_refs
 )
 
 def _union_doc_refs(a: List[str], b: List[str], cap: Optional[int] = None) -> List[str]:
@@ -85,114 +88,373 @@ def _normalize_steps_order(steps: List[Dict[str, Any]]) -> None:
             except Exception:
                 pass
 
-def merge_victims(state: Dict[str, Any], incoming: List[Dict[str, Any]], limit: int = 500) -> int:
+# поля, по которым элементы списков state считаются одним фактом
+_LIST_KEY_FIELDS: Dict[str, List[str]] = {
+    "actors": ["name", "iin"],
+    "events": ["type", "date", "desc"],
+    "money_flows": ["amount", "currency", "from", "to", "date"],
+    "pyramid_indicators": ["indicator"],
+    "investigators": ["name"],
+    "prosecutors": ["name"],
+    "mechanism_bullets": ["text"],
+    "offense_articles": ["code", "article", "part", "point"],
+}
+
+def _norm_fp_val(v: Any) -> str:
+    """Значение поля для ключа: без регистра/лишних пробелов, числа — без хвостового .0."""
+    if v is None:
+        return ""
+    if isinstance(v, bool):
+        return str(v)
+    if isinstance(v, (int, float)):
+        return str(int(v)) if float(v).is_integer() else str(float(v))
+    if isinstance(v, list):
+        return "|".join(sorted(_norm_fp_val(x) for x in v))
+    if isinstance(v, dict):
+        return json.dumps(v, ensure_ascii=False, sort_keys=True)
+    return " ".join(str(v).lower().replace("ё", "е").split())
+
+def list_item_key(kind: str, it: Any) -> Tuple[str, ...]:
+    """
+    Нормализованный ключ элемента списка state (тип списка -> поля из _LIST_KEY_FIELDS).
+    Элемент без единого ключевого поля (или не dict) — ключ по всему содержимому.
+    """
+    fields = _LIST_KEY_FIELDS.get(kind)
+    if isinstance(it, dict) and fields:
+        key = tuple(_norm_fp_val(it.get(f)) for f in fields)
+        if any(key):
+            return key
+    return ("#", json.dumps(it, ensure_ascii=False, sort_keys=True))
+
+def _confidence(it: Any) -> float:
+    try:
+        return float(it.get("confidence", 0) or 0.0) if isinstance(it, dict) else 0.0
+    except (TypeError, ValueError):
+        return 0.0
+
+def _enrich_item(cur: Dict[str, Any], new: Dict[str, Any]) -> bool:
+    """Дубль по ключу дополняет существующий элемент: списки — объединение, пустые поля, max confidence."""
+    changed = False
+    for k, v in new.items():
+        if k == "confidence":
+            if _confidence(new) > _confidence(cur):
+                cur[k] = v; changed = True
+        elif isinstance(v, list) and isinstance(cur.get(k), list):
+            have = {json.dumps(x, ensure_ascii=False, sort_keys=True) for x in cur[k]}
+            extra = [x for x in v if json.dumps(x, ensure_ascii=False, sort_keys=True) not in have]
+            if extra:
+                cur[k] = cur[k] + extra; changed = True
+        elif v not in (None, "", [], {}) and cur.get(k) in (None, "", [], {}):
+            cur[k] = v; changed = True
+    return changed
+
+class StateList:
+    """
+    Список state (actors/events/money_flows/...) с поддерживаемым между мерджами индексом:
+    - хэш-индекс нормализованный ключ -> позиция: дубль находится за O(1) и дополняет
+      существующий элемент вместо появления почти-копии;
+    - top-K по confidence: при заполнении до limit новый элемент вытесняет самый слабый
+      (min-куча с ленивым удалением), занимая его позицию, — список не пересортировывается
+      и индексы остальных элементов не плывут (в журнал state уходит patch одной позиции).
+    Стоимость мерджа пропорциональна числу входящих элементов, а не размеру state.
+    """
+    def __init__(self, items: List[Any], kind: str, limit: Optional[int] = None):
+        self.items = items  # тот же объект, что лежит в state
+        self.kind = kind
+        self.limit = limit
+        self.index: Dict[Tuple[str, ...], int] = {}
+        self._heap: List[Tuple[float, int, int, int]] = []  # (confidence, -seq, позиция, версия)
+        self._ver: List[int] = []
+        self._seq = 0
+        for i, it in enumerate(items):
+            self.index.setdefault(list_item_key(kind, it), i)
+            self._ver.append(0)
+            self._push(i)
+
+    def _push(self, i: int) -> None:
+        if self.limit:
+            self._seq += 1
+            # при равном confidence вытесняется более поздний элемент
+            heapq.heappush(self._heap, (_confidence(self.items[i]), -self._seq, i, self._ver[i]))
+
+    def _weakest(self) -> Optional[Tuple[float, int]]:
+        while self._heap:
+            conf, _, i, ver = self._heap[0]
+            if ver == self._ver[i]:
+                return conf, i
+            heapq.heappop(self._heap)
+        return None
+
+    def merge(self, incoming: List[Any], touched: Optional[Set[int]] = None) -> int:
+        """Возвращает число элементов, дописанных в конец; изменённые/замещённые позиции — в touched."""
+        added = 0
+        for it in incoming:
+            key = list_item_key(self.kind, it)
+            i = self.index.get(key)
+            if i is not None:
+                cur = self.items[i]
+                if isinstance(cur, dict) and isinstance(it, dict) and _enrich_item(cur, it):
+                    self._ver[i] += 1
+                    self._push(i)
+                    if touched is not None:
+                        touched.add(i)
+                continue
+            if not self.limit or len(self.items) < self.limit:
+                self.items.append(it)
+                self._ver.append(0)
+                i = len(self.items) - 1
+                added += 1
+            else:
+                weakest = self._weakest()
+                if weakest is None or _confidence(it) <= weakest[0]:
+                    continue  # не входит в top-K
+                i = weakest[1]
+                heapq.heappop(self._heap)
+                old_key = list_item_key(self.kind, self.items[i])
+                if self.index.get(old_key) == i:
+                    del self.index[old_key]
+                self.items[i] = it
+                self._ver[i] += 1
+                if touched is not None:
+                    touched.add(i)
+            self.index[key] = i
+            self._push(i)
+        return added
+
+def _strong_id(v: Dict[str, Any], fld: str) -> str:
+    if fld == "iin":
+        return re.sub(r"\D+", "", str(v.get("iin") or ""))
+    return str(v.get(fld) or "").strip()
+
+def _victim_conflict(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    """
+    Расходится любой сильный идентификатор (ИИН, дата рождения, телефон, e-mail, IBAN, карта) —
+    разные люди: совпадение остальных (общий телефон, ФИО) записи не склеивает.
+    Телефон/e-mail/IBAN/хэш карты к этому моменту уже нормализованы.
+    """
+    for fld in ("iin", "dob", "phone", "email", "iban", "card_hash"):
+        x, y = _strong_id(a, fld), _strong_id(b, fld)
+        if x and y and x != y:
+            return True
+    return False
+
+class VictimIndex:
+    """
+    Индекс сущностей потерпевших: каждый идентификатор записи (victim_identifiers) —
+    узел union-find, идентификаторы одной записи объединены, корень указывает на позицию
+    записи в state["victims"]. Поиск по любому идентификатору — O(1) (амортизированно).
+    Строится один раз на прогон и поддерживается merge_victims; после удаления
+    склеенных записей/обрезки по лимиту перестраивается.
+    """
+    def __init__(self, victims: List[Dict[str, Any]]):
+        self.victims = victims
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        self._parent: Dict[str, str] = {}
+        self._size: Dict[str, int] = {}
+        self._slot: Dict[str, int] = {}  # корень -> позиция записи
+        for i, v in enumerate(self.victims):
+            if not v.get("_key"):
+                v["_key"] = victim_entity_key(v)
+            ids = [x for x in victim_identifiers(v) if x not in self._parent]  # спорный id остаётся за первой записью
+            for x in ids:
+                self._parent[x] = x
+                self._size[x] = 1
+            if ids:
+                self._slot[ids[0]] = i
+                for x in ids[1:]:
+                    self._union(ids[0], x)
+
+    def _find(self, x: str) -> str:
+        root = x
+        while self._parent[root] != root:
+            root = self._parent[root]
+        while self._parent[x] != root:
+            self._parent[x], x = root, self._parent[x]
+        return root
+
+    def _union(self, a: str, b: str) -> str:
+        """Слить множества; позиция записи берётся от множества a."""
+        ra, rb = self._find(a), self._find(b)
+        if ra == rb:
+            return ra
+        slot = self._slot.pop(ra, None)
+        self._slot.pop(rb, None)
+        if self._size[ra] < self._size[rb]:
+            ra, rb = rb, ra
+        self._parent[rb] = ra
+        self._size[ra] += self._size[rb]
+        if slot is not None:
+            self._slot[ra] = slot
+        return ra
+
+    def lookup(self, ident: str) -> Optional[int]:
+        """Позиция записи по идентификатору (iin:..., phone:..., name:...|dob:...)."""
+        return self._slot.get(self._find(ident)) if ident in self._parent else None
+
+    def candidates(self, ids: List[str]) -> List[str]:
+        roots: List[str] = []
+        for x in ids:
+            if x in self._parent:
+                r = self._find(x)
+                if r not in roots and r in self._slot:
+                    roots.append(r)
+        return roots
+
+    def attach(self, root: Optional[str], ids: List[str], slot: int) -> str:
+        """Добавить новые идентификаторы к сущности root (или завести новую сущность на позиции slot)."""
+        for x in ids:
+            if x in self._parent:
+                continue
+            self._parent[x] = x
+            self._size[x] = 1
+            if root is None:
+                root = x
+                self._slot[x] = slot
+            else:
+                root = self._union(root, x)
+        return root
+
+    def merge_roots(self, primary: str, other: str) -> str:
+        return self._union(primary, other)
+
+    def slot(self, root: str) -> int:
+        return self._slot[self._find(root)]
+
+def _normalize_incoming_victim(nv: Dict[str, Any]) -> None:
+    nv["name"] = canonical_name(nv.get("name"))
+    if nv.get("phone"):
+        nv["phone"] = norm_phone(nv["phone"])
+    if nv.get("email"):
+        nv["email"] = norm_email(nv["email"])
+    if nv.get("iban"):
+        nv["iban"] = norm_iban(nv["iban"])
+    if nv.get("card"):
+        cd = norm_card(nv["card"])
+        nv["card_hash"] = hash_card(cd) if cd else None
+    # приводим порядок шагов к int и дальше сортируем при мердже
+    _normalize_steps_order(nv.get("steps") or [])
+
+def _merge_victim_into(cur: Dict[str, Any], nv: Dict[str, Any]) -> None:
+    """Пополнение существующей записи данными nv без потерь."""
+    # confidence — берём максимум
+    cur["confidence"] = max(
+        float(cur.get("confidence", 0) or 0.0),
+        float(nv.get("confidence", 0) or 0.0)
+    )
+
+    # damage_tenge — берём максимум (некоторые источники содержат частичные суммы)
+    try:
+        d1 = int(cur.get("damage_tenge", 0) or 0)
+    except Exception:
+        d1 = 0
+    try:
+        d2 = int(nv.get("damage_tenge", 0) or 0)
+    except Exception:
+        d2 = 0
+    cur["damage_tenge"] = max(d1, d2)
+
+    # заполняем пустые поля из nv
+    for fld in ["iin", "phone", "email", "iban", "card_hash", "tg", "dob", "address", "name", "recruiter", "ref_link"]:
+        if not cur.get(fld) and nv.get(fld):
+            cur[fld] = nv[fld]
+
+    # doc_refs и индекс документов
+    cur["doc_refs"] = _union_doc_refs(cur.get("doc_refs", []), nv.get("doc_refs", []), cap=None)
+    cur["_doc_ids"] = sorted(set((cur.get("_doc_ids") or []) + doc_ids_from_refs(cur.get("doc_refs", []))))
+
+    # списки без потерь
+    cur["steps"] = _merge_list_of_dicts(cur.get("steps", []), nv.get("steps") or [], ["order", "action", "date"], keep_order_field="order")
+    cur["transfers"] = _merge_list_of_dicts(cur.get("transfers", []), nv.get("transfers") or [], ["amount", "currency", "asset", "date", "to", "via"])
+    cur["platform_accounts"] = _merge_list_of_dicts(cur.get("platform_accounts", []), nv.get("platform_accounts") or [], ["service", "id"])
+
+    # ключ сущности — по самому сильному идентификатору после пополнения
+    cur["_key"] = victim_entity_key(cur)
+
+def merge_victims(state: Dict[str, Any], incoming: List[Dict[str, Any]], limit: int = 500,
+                  touched: Optional[Set[int]] = None, index: Optional[VictimIndex] = None) -> int:
     """
     Сливает потерпевших без потерь важной информации:
-    - ключ сущности строится через victim_entity_key (iin/iban/card/email/phone/name|dob)
+    - сущность находится по ЛЮБОМУ идентификатору записи (iin/iban/card/email/phone/name|dob; голое
+      ФИО — только у записей без других идентификаторов) через VictimIndex; если входящая запись
+      связывает несколько существующих — они склеиваются в одну, кроме записей, у которых
+      расходится какой-либо сильный идентификатор (_victim_conflict)
     - пополняет пустые поля
     - объединяет doc_refs без капа на этом этапе
     - steps/transfers/platform_accounts объединяются по ключам без дублей; steps сортируются по order
     - card не храним полностью (только хэш)
+    touched — сюда складываются индексы обновлённых существующих записей (для журнала state).
+    index — индекс, живущий весь прогон (pipeline); без него строится на один вызов.
     """
     if not incoming:
         return 0
 
     victims: List[Dict[str, Any]] = state.setdefault("victims", [])
-
-    # индекс существующих по ключу
-    idx: Dict[str, int] = {}
-    for i, v in enumerate(victims):
-        key = v.get("_key") or victim_entity_key(v)
-        if key:
-            v["_key"] = key
-            idx[key] = i
+    if index is None or index.victims is not victims:
+        index = VictimIndex(victims)
 
     added = 0
+    dead: Set[int] = set()  # позиции записей, склеенных в другие
     for nv in incoming:
-        # нормализация базовых полей
-        nv["name"] = canonical_name(nv.get("name"))
-        if nv.get("phone"):
-            nv["phone"] = norm_phone(nv["phone"])
-        if nv.get("email"):
-            nv["email"] = norm_email(nv["email"])
-        if nv.get("iban"):
-            nv["iban"] = norm_iban(nv["iban"])
-        if nv.get("card"):
-            cd = norm_card(nv["card"])
-            nv["card_hash"] = hash_card(cd) if cd else None
-
-        nv_steps = nv.get("steps") or []
-        nv_transfers = nv.get("transfers") or []
-        nv_platform = nv.get("platform_accounts") or []
-
-        # приводим порядок шагов к int и дальше сортируем при мердже
-        _normalize_steps_order(nv_steps)
-
-        # ключ сущности
-        key = victim_entity_key(nv)
-        nv["_key"] = key
-
-        if key and key in idx:
-            cur = victims[idx[key]]
-
-            # confidence — берём максимум
-            cur["confidence"] = max(
-                float(cur.get("confidence", 0) or 0.0),
-                float(nv.get("confidence", 0) or 0.0)
-            )
-
-            # damage_tenge — берём максимум (некоторые источники содержат частичные суммы)
-            try:
-                d1 = int(cur.get("damage_tenge", 0) or 0)
-            except Exception:
-                d1 = 0
-            try:
-                d2 = int(nv.get("damage_tenge", 0) or 0)
-            except Exception:
-                d2 = 0
-            cur["damage_tenge"] = max(d1, d2)
-
-            # заполняем пустые поля из nv
-            for fld in ["iin", "phone", "email", "iban", "card_hash", "tg", "dob", "address", "name", "recruiter", "ref_link"]:
-                if not cur.get(fld) and nv.get(fld):
-                    cur[fld] = nv[fld]
-
-            # doc_refs и индекс документов
-            cur["doc_refs"] = _union_doc_refs(cur.get("doc_refs", []), nv.get("doc_refs", []), cap=None)
-            cur["_doc_ids"] = sorted(set((cur.get("_doc_ids") or []) + doc_ids_from_refs(cur.get("doc_refs", []))))
-
-            # списки без потерь
-            cur["steps"] = _merge_list_of_dicts(cur.get("steps", []), nv_steps, ["order", "action", "date"], keep_order_field="order")
-            cur["transfers"] = _merge_list_of_dicts(cur.get("transfers", []), nv_transfers, ["amount", "currency", "asset", "date", "to", "via"])
-            cur["platform_accounts"] = _merge_list_of_dicts(cur.get("platform_accounts", []), nv_platform, ["service", "id"])
+        if not isinstance(nv, dict):
+            continue
+        _normalize_incoming_victim(nv)
+        ids = victim_identifiers(nv)
+        roots = index.candidates(ids)
 
+        primary = next((r for r in roots if not _victim_conflict(victims[index.slot(r)], nv)), None)
+        if primary is not None:
+            pos = index.slot(primary)
+            cur = victims[pos]
+            _merge_victim_into(cur, nv)
+            if touched is not None:
+                touched.add(pos)
+            # nv связал несколько сущностей — вторичные записи вливаются в основную
+            for r in roots:
+                if r == primary:
+                    continue
+                other = index.slot(r)
+                if other == pos or _victim_conflict(cur, victims[other]):
+                    continue
+                _merge_victim_into(cur, victims[other])
+                dead.add(other)
+                primary = index.merge_roots(primary, r)
+            index.attach(primary, [x for x in victim_identifiers(cur) if x not in ids] + ids, pos)
         else:
             # новый потерпевший
+            nv["_key"] = victim_entity_key(nv)
             nv.pop("card", None)  # не храним полный номер карты
             nv["doc_refs"] = list(dict.fromkeys(nv.get("doc_refs", [])))
             nv["_doc_ids"] = doc_ids_from_refs(nv["doc_refs"])
-            _normalize_steps_order(nv_steps)
-            nv["steps"] = nv_steps
-            nv["transfers"] = nv_transfers
-            nv["platform_accounts"] = nv_platform
+            nv["steps"] = nv.get("steps") or []
+            nv["transfers"] = nv.get("transfers") or []
+            nv["platform_accounts"] = nv.get("platform_accounts") or []
             victims.append(nv)
-            if key and key not in idx:
-                idx[key] = len(victims) - 1
+            index.attach(None, ids, len(victims) - 1)
             added += 1
 
+    if dead:
+        victims[:] = [v for i, v in enumerate(victims) if i not in dead]
     # мягкий лимит на количество потерпевших в state
-    if limit and len(victims) > limit:
+    truncated = bool(limit) and len(victims) > limit
+    if truncated:
         victims.sort(key=lambda x: float(x.get("confidence", 0) or 0.0), reverse=True)
         del victims[limit:]
+    if dead or truncated:
+        index.rebuild()
 
     return added
 
 def link_money_flows_to_victims(state: Dict[str, Any]) -> None:
     """
     Пытается привязать каждый money_flow к потерпевшему по:
-    - пересечению doc_ids,
-    - совпадениям по ФИО в полях from/to,
-    - нормализованным phone/email/iban в from/to.
+    - пересечению doc_ids (+3),
+    - совпадениям по ФИО в полях from/to (+2 за поле),
+    - нормализованным phone/email/iban в from/to (+2 за идентификатор и поле).
+    Кандидаты — потерпевшие из тех же документов; если таких нет — все, кто совпал по тексту.
+    Идентификаторы потерпевших нормализуются один раз и собираются в автомат Aho–Corasick,
+    from/to каждого потока просматриваются одним проходом: O(суммарный текст + совпадения).
     Записывает ключ потерпевшего в поле mf['victim_key'].
     """
     victims = state.get("victims", []) or []
@@ -200,61 +462,50 @@ def link_money_flows_to_victims(state: Dict[str, Any]) -> None:
     if not victims or not flows:
         return
 
-    v_by_key: Dict[Optional[str], Dict[str, Any]] = {v.get("_key"): v for v in victims if v.get("_key")}
+    v_by_key: Dict[str, Dict[str, Any]] = {v.get("_key"): v for v in victims if v.get("_key")}
+    vkeys = list(v_by_key)
+    rank = {vkey: n for n, vkey in enumerate(vkeys)}  # при равном счёте — раньше в списке
     doc_to_vkeys: Dict[str, Set[str]] = {}
+    pattern_owners: Dict[str, List[Tuple[str, str]]] = {}  # образец -> [(vkey, вид идентификатора)]
 
-    for v in victims:
-        vkey = v.get("_key")
-        if not vkey:
-            continue
+    for vkey, v in v_by_key.items():
         for did in (v.get("_doc_ids") or []):
             doc_to_vkeys.setdefault(did, set()).add(vkey)
-
-    def score_flow_to_victim(mf: Dict[str, Any], vkey: str, v: Dict[str, Any]) -> int:
-        s = 0
-        # 1) пересечение документов
-        mf_docs = set(doc_ids_from_refs(mf.get("doc_refs", [])))
-        if mf_docs & set(v.get("_doc_ids") or []):
-            s += 3
-        # 2) совпадение ФИО в from/to
         nm = (v.get("name") or "").lower()
         if nm:
-            for fld in ["from", "to"]:
-                val = (mf.get(fld) or "")
-                if isinstance(val, str) and nm in val.lower():
-                    s += 2
-        # 3) нормализованные контакты в from/to
+            pattern_owners.setdefault(nm, []).append((vkey, "name"))
         for fld, norm_fn in [("phone", norm_phone), ("email", norm_email), ("iban", norm_iban)]:
             vval = norm_fn(v.get(fld)) if v.get(fld) else None
-            if not vval:
-                continue
-            vval_s = str(vval).lower()
-            for fld2 in ["from", "to"]:
-                target = (mf.get(fld2) or "")
-                if isinstance(target, str) and vval_s in target.lower():
-                    s += 2
-        return s
+            if vval:
+                pattern_owners.setdefault(str(vval).lower(), []).append((vkey, fld))
+
+    automaton = AhoCorasick(pattern_owners)
+    owners = [pattern_owners[p] for p in automaton.patterns]
 
     for mf in flows:
-        best_key: Optional[str] = None
-        best_score = 0
+        scores: Dict[str, int] = {}
+        for fld in ["from", "to"]:
+            val = mf.get(fld) or ""
+            if not isinstance(val, str) or not val:
+                continue
+            # одно совпадение (потерпевший, вид идентификатора) засчитывается на поле один раз
+            hits = {owner for pid in automaton.find_ids(val.lower()) for owner in owners[pid]}
+            for vkey, _ in hits:
+                scores[vkey] = scores.get(vkey, 0) + 2
 
-        # сначала пытаемся по документам
+        doc_vkeys: Set[str] = set()
         for did in doc_ids_from_refs(mf.get("doc_refs", [])):
-            for vkey in doc_to_vkeys.get(did, set()):
-                v = v_by_key.get(vkey)
-                if not v:
-                    continue
-                sc = score_flow_to_victim(mf, vkey, v)
-                if sc > best_score:
-                    best_score, best_key = sc, vkey
-
-        # если не нашли, грубый проход по всем
-        if not best_key:
-            for vkey, v in v_by_key.items():
-                sc = score_flow_to_victim(mf, vkey, v)
-                if sc > best_score:
-                    best_score, best_key = sc, vkey
+            doc_vkeys |= doc_to_vkeys.get(did, set())
+        if doc_vkeys:
+            cands = {vkey: scores.get(vkey, 0) + 3 for vkey in doc_vkeys}
+        else:
+            cands = scores
 
+        best_key: Optional[str] = None
+        best = (0, 0)
+        for vkey, sc in cands.items():
+            cand = (sc, -rank[vkey])
+            if sc > 0 and cand > best:
+                best, best_key = cand, vkey
         if best_key:
             mf["victim_key"] = best_key
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Мультипаттерн-поиск подстрок (Aho–Corasick): автомат строится один раз по набору
+образцов, текст просматривается за один проход — O(len(text) + число совпадений)
+независимо от количества образцов.
+"""
+from __future__ import annotations
+
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+class AhoCorasick:
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns: List[str] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        ids: Dict[str, int] = {}
+        for p in patterns:
+            if not p or p in ids:
+                continue
+            ids[p] = len(self.patterns)
+            self.patterns.append(p)
+            node = 0
+            for ch in p:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({}); self._fail.append(0); self._out.append([])
+                node = nxt
+            self._out[node].append(ids[p])
+        self._ids = ids
+        self._build_fail()
+
+    def _build_fail(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                # выходы суффиксной ссылки наследуются — при поиске цепочку не обходим
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+                queue.append(nxt)
+
+    def pattern_id(self, pattern: str) -> int:
+        return self._ids[pattern]
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int]]:
+        """(позиция конца совпадения, id образца) для всех вхождений."""
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for pos, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for pid in out[node]:
+                yield pos, pid
+
+    def find_ids(self, text: str) -> Set[int]:
+        """Множество id образцов, входящих в text."""
+        return {pid for _, pid in self.iter_matches(text)}
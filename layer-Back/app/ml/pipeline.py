@@ -1,20 +1,32 @@
 # -*- coding: utf-8 -*-
 import json
-from typing import Dict, Any, List, Tuple, Set
+import asyncio
+import hashlib
+from collections import deque
+from typing import Dict, Any, List, Optional, Tuple, Set
 from .config import (
     logger, MARKER_SCAN_CHUNKS, PER_DOC_TOKEN_CAP, BATCH_MAX_FILES, BATCH_MAX_TOKENS,
     ENABLE_PASS2_ON_GAPS, PASS2_PER_DOC_CAP, EXTRACT_MAX_TOKENS,
     STATE_SNIPPET_SIZES, FINAL_MAX_TOKENS, UST_MAX_REFINE_ROUNDS,
-    MAX_MODEL_LEN, SYSTEM_BUDGET
+    MAX_MODEL_LEN, SYSTEM_BUDGET, EXTRACT_CONCURRENCY, GEN_STREAM_EXTRACT,
+    GEN_CONSTRAINED_EXTRACT, PROMPT_LAYOUT, INCREMENTAL_NEIGHBOURS
 )
-from .io_utils import storage_paths, read_json, write_json, count_tokens
-from .chunking import load_doc_chunks
+from .io_utils import storage_paths, count_tokens, write_json
+from .chunking import load_doc_refs, load_chunk_scans, chunk_hash
+from .chunk_store import ChunkStore, open_chunk_store
 from .markers import build_doc_markers, cluster_docs_by_markers, bootstrap_victims_from_postanov, find_postanov_chunks
-from .batching import plan_pass1, plan_pass2, build_batches_for_docs, log_batches_overview
+from .batching import plan_pass1, plan_pass2, plan_batches, log_batches_overview
 from .generator import safe_call_generator
-from .json_parse import parse_or_retry_json, MD_FENCE_RE
-from .merge import merge_victims, link_money_flows_to_victims
-from .prompts import make_extraction_prompt, fit_ustanovil_prompt, make_ustanovil_refine_prompt, make_ustanovil_force_victims_prompt, build_ustanovil_state_subset
+from .response_cache import bypass_cache
+from .state_store import StateJournal, StateTracker
+from .run_manifest import RunManifest, plan_to_batches
+from .json_parse import parse_or_retry_json, is_complete_json, MD_FENCE_RE
+from .merge import merge_victims, link_money_flows_to_victims, StateList, VictimIndex
+from .prompts import (
+    make_extraction_prompt, make_extraction_prefix, extraction_json_schema,
+    extraction_overhead_tokens, extraction_prefix_tokens, doc_block_tokens, chunk_block_tokens,
+)
+from .prompts import fit_ustanovil_prompt, make_ustanovil_refine_prompt, make_ustanovil_force_victims_prompt, build_ustanovil_state_subset
 from .postproc import (
     collapse_repeated_lines, drop_generic_filler, normalize_erdr_mentions,
     ensure_minimum_evidence, compose_final_document, missing_victims_by_paragraphs,
@@ -25,15 +37,43 @@ def _strip_md_fences(s: str) -> str:
     m = MD_FENCE_RE.search(s)
     return m.group(1).strip() if m else s
 
-async def run_pipeline(case_id: int) -> Dict[str, Any]:
+# списки state с индексом дублей и top-K: ключ ответа экстракции -> (список state, лимит)
+_STATE_LISTS = {
+    "actors_add": ("actors", 90),
+    "events_add": ("events", 500),
+    "money_flows_add": ("money_flows", 500),
+    "pyramid_indicators_add": ("pyramid_indicators", 90),
+    "investigators": ("investigators", 10),
+    "prosecutors": ("prosecutors", 10),
+    "mechanism_bullets_add": ("mechanism_bullets", 50),
+    "offense_articles_add": ("offense_articles", 20),
+}
+# списки state, которые журналируются дельтами
+_JOURNAL_LIST_KEYS = ["victims"] + [dst for dst, _ in _STATE_LISTS.values()]
+
+async def run_pipeline(case_id: int, fresh: bool = False) -> Dict[str, Any]:
+    """
+    fresh=True — прогон мимо кэша ответов генератора (новые ответы кэш обновляют)
+    и с нуля по манифесту: без него прерванный прогон продолжается с первого незавершённого вызова,
+    а после завершённого прогона обрабатываются только добавленные/изменённые документы.
+    """
+    with bypass_cache(fresh), open_chunk_store(case_id) as store:
+        return await _run_pipeline(case_id, store, fresh)
+
+async def _run_pipeline(case_id: int, store: ChunkStore, fresh: bool = False) -> Dict[str, Any]:
     paths = storage_paths(case_id)
     paths["state_dir"].mkdir(parents=True, exist_ok=True)
 
-    docs_map = load_doc_chunks(case_id)
+    # только дескрипторы чанков; текст читается из mmap хранилища, когда он нужен
+    docs_map = load_doc_refs(store)
     if not docs_map:
         raise RuntimeError("Нет подготовленных документов. Сначала загрузите /cases/{case_id}/documents")
+    # маркеры/заголовки/кандидаты в потерпевшие по чанкам посчитаны при ingest'е — только подгружаем
+    scan_stats = load_chunk_scans(paths["chunks"], docs_map)
+    logger.info(f"[SCAN] chunk indexes: loaded={scan_stats['loaded']}, rebuilt={scan_stats['rebuilt']}")
 
-    state = read_json(paths["state"], default={
+    journal = StateJournal(paths["state"])
+    state = journal.load(default={
         "case_meta": {
             "case_id": case_id, "erdr": None, "city": None, "region": None,
             "agency": None, "decision_date": None, "offense_article_best": None
@@ -45,184 +85,355 @@ async def run_pipeline(case_id: int) -> Dict[str, Any]:
         "contradictions": [], "notes": []
     })
     logger.info(f"[STATE] initial: actors={len(state.get('actors', []))}, victims={len(state.get('victims', []))}, events={len(state.get('events', []))}")
+    # индексы списков строятся один раз и дальше поддерживаются мерджами
+    state_lists = {dst: StateList(state.setdefault(dst, []), dst, limit) for dst, limit in _STATE_LISTS.values()}
+    victim_index = VictimIndex(state.setdefault("victims", []))
+
+    # манифест прогона: план батчей, завершённые вызовы, стадии; сбрасывается при смене документов/конфига
+    manifest = RunManifest.open(paths["manifest"], docs_map, fresh=fresh)
+    scope: Set[str] = set(manifest.scope or ())  # пусто — полный прогон
+    if manifest.resumed:
+        manifest.reconcile(journal.replayed)
+    else:
+        manifest.finish_stage("start", journal.seq)
 
     # Bootstrap потерпевших из ПОСТАНОВЛЕНИЙ (ожидаемое число)
     boot = bootstrap_victims_from_postanov(docs_map)
     expected_victims = len(boot)
-    if boot:
-        added_boot = merge_victims(state, boot, limit=500)
+    if boot and not manifest.stage_done("bootstrap"):
+        tracker = StateTracker(state, ["victims"])
+        touched: Set[int] = set()
+        added_boot = merge_victims(state, boot, limit=500, touched=touched, index=victim_index)
         logger.info(f"[BOOTSTRAP] victims from POSTANOV: expected={expected_victims}, merged={added_boot}")
-        write_json(paths["state"], state)
+        journal.append(tracker.ops(state, {"victims": added_boot}, {"victims": touched}), "BOOTSTRAP")
+    if not manifest.stage_done("bootstrap"):
+        manifest.finish_stage("bootstrap", journal.seq)
 
     # Кластера и порядок
     doc_markers = build_doc_markers(docs_map, MARKER_SCAN_CHUNKS)
-    clusters = cluster_docs_by_markers(doc_markers)
+    cluster_report: Dict[str, Any] = {}
+    clusters = cluster_docs_by_markers(doc_markers, report=cluster_report)
+    write_json(paths["clusters"], cluster_report)
+    logger.info(f"[CLUSTER] {len(clusters)} clusters, largest={max(len(c) for c in clusters)}, "
+                f"hub markers suppressed={len(cluster_report['suppressed_markers'])} (df>{cluster_report['hub_limit']}), "
+                f"rejected by size={len(cluster_report['rejected_by_size'])}")
     doc_order: List[str] = [doc_id for cluster in clusters for doc_id in cluster]
 
+    # Инкрементальный прогон: только новые/изменённые документы + до INCREMENTAL_NEIGHBOURS
+    # соседей по кластеру первым чанком — контекст для связки с уже извлечёнными фактами
+    context_chunks: Set[tuple] = set()
+    if scope:
+        run_docs = set(scope)
+        for cluster in clusters:
+            if scope.intersection(cluster):
+                for nb in [d for d in cluster if d not in scope][:INCREMENTAL_NEIGHBOURS]:
+                    run_docs.add(nb)
+                    context_chunks.add((nb, int(docs_map[nb][0]["chunk_id"])))
+        doc_order = [d for d in doc_order if d in run_docs]
+        logger.info(f"[INCREMENTAL] docs={sorted(scope, key=int)}, neighbours={sorted(run_docs - scope, key=int)}")
+
     # Pass1
-    take_pass1 = plan_pass1(docs_map, PER_DOC_TOKEN_CAP)
-    batches_p1 = build_batches_for_docs(docs_map, doc_order, BATCH_MAX_FILES, BATCH_MAX_TOKENS, take_pass1)
+    if manifest.plan("P1") is not None:
+        batches_p1 = plan_to_batches(manifest.plan("P1"), docs_map)
+    else:
+        take_pass1 = plan_pass1(docs_map, PER_DOC_TOKEN_CAP)
+        if scope:
+            take_pass1 = {d: v for d, v in take_pass1.items() if d in scope}
+            for nb, cid in context_chunks:
+                take_pass1[nb] = [cid]
+        batches_p1 = plan_batches(docs_map, doc_order, BATCH_MAX_FILES, BATCH_MAX_TOKENS, take_pass1, clusters, "P1")
+        manifest.set_plan("P1", batches_p1)
     log_batches_overview(batches_p1, "P1")
 
-    used_chunks: Set[tuple] = set()
+    # счётчики прогона — с последнего чекпоинта манифеста
+    used_chunks: Set[tuple] = {(d, int(c)) for d, c in manifest.data["used_chunks"]}
+    prefill_saved: Dict[str, int] = dict(manifest.data["prefill_saved"])
+    dup_skipped: Dict[str, int] = dict(manifest.data["dup_skipped"])
+    chunk_by_id = {(doc_id, int(ch["chunk_id"])): ch for doc_id, chunks in docs_map.items() for ch in chunks}
+    sent_hashes: Set[str] = {chunk_by_id[k]["hash"] for k in used_chunks if k in chunk_by_id}
     def mark_used(batch_docs: List[Dict[str, Any]]):
         for d in batch_docs:
             did = d["doc_id"]
             for ch in d["chunks"]:
                 used_chunks.add((did, int(ch["chunk_id"])) )
 
+    def drop_sent_chunks(batch_docs: List[Dict[str, Any]], tag: str) -> List[Dict[str, Any]]:
+        """
+        Чанки, чей текст уже уходил в LLM (дубли документов в деле), в батч не берём;
+        покрытие им засчитываем — содержимое уже извлечено. Контекстные чанки соседей
+        инкрементального прогона отправляются повторно намеренно, но батч из одного контекста не нужен.
+        """
+        out, local, n_new = [], set(), 0
+        for d in batch_docs:
+            keep = []
+            for ch in d["chunks"]:
+                if (d["doc_id"], int(ch["chunk_id"])) in context_chunks:
+                    keep.append(ch)
+                    continue
+                h = ch.get("hash") or chunk_hash(ch["text"])
+                if h in sent_hashes or h in local:
+                    used_chunks.add((d["doc_id"], int(ch["chunk_id"])))
+                    dup_skipped[tag] = dup_skipped.get(tag, 0) + 1
+                    continue
+                local.add(h)
+                keep.append(ch)
+                n_new += 1
+            if keep:
+                out.append({"doc_id": d["doc_id"], "chunks": keep})
+        return out if n_new else []
+
+    def remember_sent(local_docs: List[Dict[str, Any]]):
+        for d in local_docs:
+            for ch in d["chunks"]:
+                sent_hashes.add(ch.get("hash") or chunk_hash(ch["text"]))
+
+    def build_state_snippet() -> Dict[str, Any]:
+        return {
+            "case_meta": {k: state.get("case_meta", {}).get(k) for k in ["erdr","city","region","agency","decision_date"]},
+            "offense_article_best": state.get("case_meta", {}).get("offense_article_best"),
+            "investigators": state.get("investigators", [])[:STATE_SNIPPET_SIZES["investigators"]],
+            "prosecutors": state.get("prosecutors", [])[:STATE_SNIPPET_SIZES["prosecutors"]],
+            "actors": state.get("actors", [])[:STATE_SNIPPET_SIZES["actors"]],
+            "victims": state.get("victims", [])[:STATE_SNIPPET_SIZES["victims"]],
+            "pyramid_indicators": state.get("pyramid_indicators", [])[:STATE_SNIPPET_SIZES["pyramid_indicators"]],
+        }
+
+    def pop_largest_tail(local_docs: List[Dict[str, Any]]) -> Dict[str, Any]:
+        local_docs.sort(key=lambda d: sum(ch["n_tokens"] for ch in d["chunks"]), reverse=True)
+        for d in local_docs:
+            if len(d["chunks"]) > 1:
+                return d["chunks"].pop()
+        raise ValueError("nothing to trim")
+
+    def fit_docs(batch_docs: List[Dict[str, Any]], state_snippet: Dict[str, Any], tag: str, i: int, fit_sections: List[str]):
+        """
+        Урезаем хвостовые чанки, пока промпт самой длинной из fit_sections не влезет в контекст.
+        Подгонка — арифметикой по готовым n_tokens чанков и заранее посчитанному шаблону;
+        точная токенизация — один раз в конце (и повторно только если оценка промахнулась).
+        Возвращает (local_docs, {section: точное число токенов промпта}).
+        """
+        local_docs = [ {"doc_id": d["doc_id"], "chunks": list(d["chunks"]) } for d in batch_docs ]
+        budget = MAX_MODEL_LEN - EXTRACT_MAX_TOKENS - SYSTEM_BUDGET
+        bids = {sec: f"{tag}-{i}" + (f"-{sec}" if sec else "") for sec in fit_sections}
+
+        est = max(extraction_overhead_tokens(state_snippet, bids[sec], sec) for sec in fit_sections)
+        est += sum(doc_block_tokens(d) for d in local_docs)
+        while est > budget and any(len(d["chunks"]) > 1 for d in local_docs):
+            est -= chunk_block_tokens(pop_largest_tail(local_docs))
+
+        def exact() -> Dict[str, int]:
+            return {sec: count_tokens(make_extraction_prompt(local_docs, state_snippet, batch_id=bids[sec], section=sec)) for sec in fit_sections}
+        tokens = exact()
+        while max(tokens.values()) > budget and any(len(d["chunks"]) > 1 for d in local_docs):
+            pop_largest_tail(local_docs)
+            tokens = exact()
+        return local_docs, tokens
+
+    async def extract_section(local_docs: List[Dict[str, Any]], state_snippet: Dict[str, Any], tag: str, i: int, sec: str,
+                              cache_hint: Optional[str] = None, prompt_tokens: Optional[int] = None):
+        """Один LLM-вызов секции батча (с дроблением при невалидном JSON). State не трогает."""
+        prompt = make_extraction_prompt(local_docs, state_snippet, batch_id=f"{tag}-{i}" + (f"-{sec}" if sec else ""), section=sec)
+        json_schema = extraction_json_schema(sec) if GEN_CONSTRAINED_EXTRACT else None
+        try:
+            bout = await parse_or_retry_json(
+                first_prompt=prompt,
+                call_fn=lambda p, n_predict: safe_call_generator(
+                    p, n_predict,
+                    label=f"EXTRACT {tag}-{i}-{sec}",
+                    fallback_predict=[1200, 1000, 800, 600, 400],
+                    stream_json=GEN_STREAM_EXTRACT,
+                    json_schema=json_schema,
+                    cache_hint=cache_hint,
+                    cache_ok=is_complete_json
+                ),
+                n_predict=EXTRACT_MAX_TOKENS,
+                batch_id=f"{tag}-{i}-{sec}",
+                max_retries=3,
+                prompt_tokens=prompt_tokens
+            )
+            subouts = [bout]
+        except Exception as e:
+            logger.warning(f"[{tag}-{i}-{sec}] JSON fail -> {e}. Split halves.")
+            subouts = []
+            if len(local_docs) > 1:
+                mid = len(local_docs) // 2
+                sub_batches = [local_docs[:mid], local_docs[mid:]]
+                for j, sub in enumerate(sub_batches, start=1):
+                    sub_prompt = make_extraction_prompt(sub, state_snippet, batch_id=f"{tag}-{i}.{j}", section=sec)
+                    try:
+                        sub_out = await parse_or_retry_json(
+                            first_prompt=sub_prompt,
+                            call_fn=lambda p, n_predict: safe_call_generator(
+                                p, n_predict,
+                                label=f"EXTRACT {tag}-{i}.{j}-{sec}",
+                                fallback_predict=[1200, 1000, 800, 600, 400],
+                                stream_json=GEN_STREAM_EXTRACT,
+                                json_schema=json_schema,
+                                cache_hint=cache_hint,
+                                cache_ok=is_complete_json
+                            ),
+                            n_predict=EXTRACT_MAX_TOKENS,
+                            batch_id=f"{tag}-{i}.{j}-{sec}",
+                            max_retries=3
+                        )
+                        subouts.append(sub_out)
+                    except Exception as e2:
+                        logger.error(f"[{tag}-{i}.{j}-{sec}] sub-batch failed: {e2}")
+                if not subouts:
+                    for j, single in enumerate(local_docs, start=1):
+                        s_prompt = make_extraction_prompt([single], state_snippet, batch_id=f"{tag}-{i}.S{j}", section=sec)
+                        try:
+                            s_out = await parse_or_retry_json(
+                                first_prompt=s_prompt,
+                                call_fn=lambda p, n_predict: safe_call_generator(
+                                    p, n_predict,
+                                    label=f"EXTRACT {tag}-{i}.S{j}-{sec}",
+                                    fallback_predict=[1000, 800, 600, 400],
+                                    stream_json=GEN_STREAM_EXTRACT,
+                                    json_schema=json_schema,
+                                    cache_hint=cache_hint,
+                                    cache_ok=is_complete_json
+                                ),
+                                n_predict=min(1000, EXTRACT_MAX_TOKENS),
+                                batch_id=f"{tag}-{i}.S{j}-{sec}",
+                                max_retries=3
+                            )
+                            subouts.append(s_out)
+                        except Exception as e3:
+                            logger.error(f"[{tag}-{i}.S{j}-{sec}] single-doc failed: {e3}")
+                if not subouts:
+                    raise RuntimeError(f"Модель не вернула валидный JSON на батче {tag}-{i} даже после дробления")
+            else:
+                raise RuntimeError(f"Модель не вернула валидный JSON на батче {tag}-{i} (single-doc)")
+        return subouts, local_docs
+
+    def merge_outputs(subouts: List[Dict[str, Any]], tag: str, i: int, job_key: str):
+        tracker = StateTracker(state, _JOURNAL_LIST_KEYS)
+        touched: Dict[str, Set[int]] = {k: set() for k in _JOURNAL_LIST_KEYS}
+
+        def _incoming(src_key: str) -> List[Any]:
+            items = []
+            for out in subouts:
+                src = out.get(src_key, [])
+                if isinstance(src, list): items.extend(src)
+            return items
+
+        added = {"victims": merge_victims(state, _incoming("victims_add"), limit=500, touched=touched["victims"], index=victim_index)}
+        for src_key, (dst_key, _) in _STATE_LISTS.items():
+            added[dst_key] = state_lists[dst_key].merge(_incoming(src_key), touched[dst_key])
+        logger.info(f"[{tag}-{i}] merged: {added}")
+
+        # meta_add
+        filled = []
+        for out in subouts:
+            meta_add = out.get("meta_add") or {}
+            cm = state.setdefault("case_meta", {})
+            for k in ["erdr", "city", "region", "agency", "decision_date"]:
+                if meta_add.get(k) and not cm.get(k):
+                    cm[k] = meta_add.get(k); filled.append(k)
+        if filled:
+            logger.info(f"[{tag}-{i}] meta filled: {filled}")
+
+        # offense_article_best
+        arts = [a for a in state.get("offense_articles", []) if isinstance(a, dict)]
+        if arts:
+            # порядок списка не трогаем — на нём держится индекс StateList
+            a = max(arts, key=lambda x: x.get("confidence", 0))
+            article_str = f"ст.{a.get('article','')} ч.{a.get('part','')}"
+            if a.get("point"):
+                article_str += f" п.{a.get('point')}"
+            article_str += " УК РК"
+            state["case_meta"]["offense_article_best"] = article_str
+            logger.info(f"[{tag}-{i}] offense_article_best='{article_str}'")
+
+        # дельта в журнал вместо перезаписи всего state
+        journal.append(tracker.ops(state, added, touched, set_keys=["case_meta"]), job_key)
+
     async def process_batches(batches: List[List[Dict[str, Any]]], tag: str):
-        nonlocal state
-        for i, batch_docs in enumerate(batches, 1):
-            state_snippet = {
-                "case_meta": {k: state.get("case_meta", {}).get(k) for k in ["erdr","city","region","agency","decision_date"]},
-                "offense_article_best": state.get("case_meta", {}).get("offense_article_best"),
-                "investigators": state.get("investigators", [])[:STATE_SNIPPET_SIZES["investigators"]],
-                "prosecutors": state.get("prosecutors", [])[:STATE_SNIPPET_SIZES["prosecutors"]],
-                "actors": state.get("actors", [])[:STATE_SNIPPET_SIZES["actors"]],
-                "victims": state.get("victims", [])[:STATE_SNIPPET_SIZES["victims"]],
-                "pyramid_indicators": state.get("pyramid_indicators", [])[:STATE_SNIPPET_SIZES["pyramid_indicators"]],
-            }
-
-            def fit_prompt(section_label):
-                local_docs = [ {"doc_id": d["doc_id"], "chunks": list(d["chunks"]) } for d in batch_docs ]
-                prompt = make_extraction_prompt(local_docs, state_snippet, batch_id=f"{tag}-{i}" + (f"-{section_label}" if section_label else ""), section=section_label)
-                while count_tokens(prompt) + EXTRACT_MAX_TOKENS + SYSTEM_BUDGET > MAX_MODEL_LEN and any(len(d["chunks"]) > 1 for d in local_docs):
-                    local_docs.sort(key=lambda d: sum(ch["n_tokens"] for ch in d["chunks"]), reverse=True)
-                    for d in local_docs:
-                        if len(d["chunks"]) > 1:
-                            d["chunks"].pop(); break
-                    prompt = make_extraction_prompt(local_docs, state_snippet, batch_id=f"{tag}-{i}" + (f"-{section_label}" if section_label else ""), section=section_label)
-                return prompt, local_docs
-
-            def merge_outputs(subouts: List[Dict[str, Any]]):
-                def _merge_list(src_key: str, dst_key: str, limit: int = None) -> int:
-                    added = 0
-                    dst = state.setdefault(dst_key, [])
-                    seen = {json.dumps(x, sort_keys=True) for x in dst}
-                    for out in subouts:
-                        src = out.get(src_key, [])
-                        if not isinstance(src, list): continue
-                        for it in src:
-                            s = json.dumps(it, sort_keys=True)
-                            if s not in seen:
-                                dst.append(it); seen.add(s); added += 1
-                    if limit is not None and len(dst) > limit:
-                        dst.sort(key=lambda x: x.get("confidence", 0), reverse=True)
-                        del dst[limit:]
-                    return added
-
-                victims_in = []
-                for out in subouts:
-                    items = out.get("victims_add", [])
-                    if isinstance(items, list): victims_in.extend(items)
-                added_victims = merge_victims(state, victims_in, limit=500)
-
-                added = {
-                    "actors": _merge_list("actors_add", "actors", limit=90),
-                    "victims": added_victims,
-                    "events": _merge_list("events_add", "events", limit=500),
-                    "money_flows": _merge_list("money_flows_add", "money_flows", limit=500),
-                    "pyramid_indicators": _merge_list("pyramid_indicators_add", "pyramid_indicators", limit=90),
-                    "investigators": _merge_list("investigators", "investigators", limit=10),
-                    "prosecutors": _merge_list("prosecutors", "prosecutors", limit=10),
-                    "mechanism_bullets": _merge_list("mechanism_bullets_add", "mechanism_bullets", limit=50),
-                    "offense_articles": _merge_list("offense_articles_add", "offense_articles", limit=20),
-                }
-                logger.info(f"[{tag}-{i}] merged: {added}")
-
-                # meta_add
-                filled = []
-                for out in subouts:
-                    meta_add = out.get("meta_add") or {}
-                    cm = state.setdefault("case_meta", {})
-                    for k in ["erdr", "city", "region", "agency", "decision_date"]:
-                        if meta_add.get(k) and not cm.get(k):
-                            cm[k] = meta_add.get(k); filled.append(k)
-                if filled:
-                    logger.info(f"[{tag}-{i}] meta filled: {filled}")
-
-                # offense_article_best
-                arts = state.get("offense_articles", [])
-                if arts:
-                    arts.sort(key=lambda x: x.get("confidence", 0), reverse=True)
-                    a = arts[0]
-                    article_str = f"ст.{a.get('article','')} ч.{a.get('part','')}"
-                    if a.get("point"):
-                        article_str += f" п.{a.get('point')}"
-                    article_str += " УК РК"
-                    state["case_meta"]["offense_article_best"] = article_str
-                    logger.info(f"[{tag}-{i}] offense_article_best='{article_str}'")
-
-                write_json(paths["state"], state)
-
-            sections = ["vmf", "rest"]
-            for sec in sections:
-                prompt, local_docs = fit_prompt(sec)
-                try:
-                    bout = await parse_or_retry_json(
-                        first_prompt=prompt,
-                        call_fn=lambda p, n_predict: safe_call_generator(
-                            p, n_predict,
-                            label=f"EXTRACT {tag}-{i}-{sec}",
-                            fallback_predict=[1200, 1000, 800, 600, 400]
-                        ),
-                        n_predict=EXTRACT_MAX_TOKENS,
-                        batch_id=f"{tag}-{i}-{sec}",
-                        max_retries=3
-                    )
-                    subouts = [bout]
-                except Exception as e:
-                    logger.warning(f"[{tag}-{i}-{sec}] JSON fail -> {e}. Split halves.")
-                    subouts = []
-                    if len(local_docs) > 1:
-                        mid = len(local_docs) // 2
-                        sub_batches = [local_docs[:mid], local_docs[mid:]]
-                        for j, sub in enumerate(sub_batches, start=1):
-                            sub_prompt = make_extraction_prompt(sub, state_snippet, batch_id=f"{tag}-{i}.{j}", section=sec)
-                            try:
-                                sub_out = await parse_or_retry_json(
-                                    first_prompt=sub_prompt,
-                                    call_fn=lambda p, n_predict: safe_call_generator(
-                                        p, n_predict,
-                                        label=f"EXTRACT {tag}-{i}.{j}-{sec}",
-                                        fallback_predict=[1200, 1000, 800, 600, 400]
-                                    ),
-                                    n_predict=EXTRACT_MAX_TOKENS,
-                                    batch_id=f"{tag}-{i}.{j}-{sec}",
-                                    max_retries=3
-                                )
-                                subouts.append(sub_out)
-                            except Exception as e2:
-                                logger.error(f"[{tag}-{i}.{j}-{sec}] sub-batch failed: {e2}")
-                        if not subouts:
-                            for j, single in enumerate(local_docs, start=1):
-                                s_prompt = make_extraction_prompt([single], state_snippet, batch_id=f"{tag}-{i}.S{j}", section=sec)
-                                try:
-                                    s_out = await parse_or_retry_json(
-                                        first_prompt=s_prompt,
-                                        call_fn=lambda p, n_predict: safe_call_generator(
-                                            p, n_predict,
-                                            label=f"EXTRACT {tag}-{i}.S{j}-{sec}",
-                                            fallback_predict=[1000, 800, 600, 400]
-                                        ),
-                                        n_predict=min(1000, EXTRACT_MAX_TOKENS),
-                                        batch_id=f"{tag}-{i}.S{j}-{sec}",
-                                        max_retries=3
-                                    )
-                                    subouts.append(s_out)
-                                except Exception as e3:
-                                    logger.error(f"[{tag}-{i}.S{j}-{sec}] single-doc failed: {e3}")
-                        if not subouts:
-                            raise RuntimeError(f"Модель не вернула валидный JSON на батче {tag}-{i} даже после дробления")
+        """
+        Извлечение по батчам с окном EXTRACT_CONCURRENCY одновременных вызовов (батч × секция).
+        Мерджи в state применяются строго в порядке (батч, секция), поэтому результат
+        детерминирован: вызов k стартует только после мерджа вызова k-окно, и его
+        GLOBAL_STATE_SNIPPET зависит лишь от уже смердженного префикса.
+        При EXTRACT_CONCURRENCY=1 поведение совпадает с последовательным.
+        Вызовы, отмеченные в манифесте выполненными, пропускаются; состав батча после
+        отсева дублей фиксируется в манифесте, чтобы при возобновлении он не поменялся.
+        """
+        sections = ["vmf", "rest"]
+        jobs = [(i, batch_docs, sec) for i, batch_docs in enumerate(batches, 1) for sec in sections]
+        window = max(1, EXTRACT_CONCURRENCY)
+        if window > 1:
+            logger.info(f"[{tag}] concurrent extraction: {len(jobs)} calls, window={window}")
+
+        snippets: Dict[int, Dict[str, Any]] = {}
+        fitted: Dict[int, List[Dict[str, Any]]] = {}
+        hints: Dict[int, Optional[str]] = {}
+        shared_prefix = PROMPT_LAYOUT == "prefix"
+        pending: deque = deque()
+
+        async def merge_next():
+            i, sec, task = pending.popleft()
+            subouts, local_docs = await task
+            key = f"{tag}-{i}-{sec}"
+            merge_outputs(subouts, tag, i, key)
+            for d in local_docs:
+                for ch in d["chunks"]:
+                    used_chunks.add((d["doc_id"], int(ch["chunk_id"])) )
+            manifest.mark_job(key, used_chunks, dup_skipped, prefill_saved, journal.seq)
+            journal.maybe_snapshot(state)
+
+        deduped: Dict[int, List[Dict[str, Any]]] = {}
+        resumed = 0
+        try:
+            for i, batch_docs, sec in jobs:
+                if manifest.job_done(f"{tag}-{i}-{sec}"):
+                    resumed += 1
+                    continue
+                if i not in deduped:
+                    saved_docs = manifest.batch_docs(f"{tag}-{i}")
+                    if saved_docs is not None:
+                        deduped[i] = plan_to_batches([saved_docs], docs_map)[0]
                     else:
-                        raise RuntimeError(f"Модель не вернула валидный JSON на батче {tag}-{i} (single-doc)")
-                merge_outputs(subouts)
-                for d in local_docs:
-                    for ch in d["chunks"]:
-                        used_chunks.add((d["doc_id"], int(ch["chunk_id"])) )
-
-    await process_batches(batches_p1, "P1")
+                        deduped[i] = drop_sent_chunks(batch_docs, tag)
+                        manifest.set_batch_docs(f"{tag}-{i}", deduped[i])
+                        if not deduped[i]:
+                            logger.info(f"[DEDUP] {tag}-{i}: все чанки батча уже отправлялись — пропуск")
+                batch_docs = deduped[i]
+                if not batch_docs:
+                    continue
+                while len(pending) >= window:
+                    await merge_next()
+                # снимок state — один на батч (обе секции видят одинаковый контекст)
+                if i not in snippets:
+                    snippets[i] = build_state_snippet()
+                    hints[i] = None
+                    if shared_prefix:
+                        # один набор чанков на обе секции -> байт-в-байт одинаковый префикс
+                        fitted[i] = fit_docs(batch_docs, snippets[i], tag, i, sections)
+                        prefix = make_extraction_prefix(fitted[i][0])
+                        hints[i] = hashlib.sha1(prefix.encode("utf-8")).hexdigest()
+                        saved = extraction_prefix_tokens(fitted[i][0]) * (len(sections) - 1)
+                        prefill_saved[tag] = prefill_saved.get(tag, 0) + saved
+                        logger.info(f"[PREFIX] {tag}-{i}: shared prefix reused by {len(sections)} sections, prefill saved ≈ {saved} tok")
+                local_docs, prompt_tokens = fitted[i] if shared_prefix else fit_docs(batch_docs, snippets[i], tag, i, [sec])
+                remember_sent(local_docs)
+                task = asyncio.create_task(extract_section(local_docs, snippets[i], tag, i, sec, cache_hint=hints[i], prompt_tokens=prompt_tokens[sec]))
+                pending.append((i, sec, task))
+            while pending:
+                await merge_next()
+        finally:
+            for _, _, task in pending:
+                task.cancel()
+        if resumed:
+            logger.info(f"[RESUME] {tag}: {resumed}/{len(jobs)} calls already done — skipped")
+        # проход завершён — global_state.json отражает его результат
+        journal.snapshot(state)
+        # батчи, целиком отсеянные как дубли, вызовов не дают — счётчики фиксируем по завершении прохода
+        manifest.checkpoint(used_chunks, dup_skipped, prefill_saved, journal.seq)
+        manifest.finish_stage(tag)
+
+    if not manifest.stage_done("P1"):
+        await process_batches(batches_p1, "P1")
 
     total_all_chunks = sum(len(v) for v in docs_map.values())
     total_used = len(used_chunks)
@@ -230,27 +441,37 @@ async def run_pipeline(case_id: int) -> Dict[str, Any]:
 
     # Pass2 (хвосты)
     if ENABLE_PASS2_ON_GAPS:
-        take_pass2 = plan_pass2(docs_map, used_chunks, PASS2_PER_DOC_CAP)
-        take_pass2 = {k: v for k, v in take_pass2.items() if v}
-        if take_pass2:
-            batches_p2 = build_batches_for_docs(docs_map, doc_order, BATCH_MAX_FILES, BATCH_MAX_TOKENS, take_pass2)
+        if manifest.plan("P2") is not None:
+            batches_p2 = plan_to_batches(manifest.plan("P2"), docs_map)
+        else:
+            take_pass2 = plan_pass2(docs_map, used_chunks, PASS2_PER_DOC_CAP)
+            take_pass2 = {k: v for k, v in take_pass2.items() if v and (not scope or k in scope)}
+            batches_p2 = plan_batches(docs_map, doc_order, BATCH_MAX_FILES, BATCH_MAX_TOKENS, take_pass2, clusters, "P2") if take_pass2 else []
+            manifest.set_plan("P2", batches_p2)
+        if batches_p2:
             log_batches_overview(batches_p2, "P2")
-            await process_batches(batches_p2, "P2")
+            if not manifest.stage_done("P2"):
+                await process_batches(batches_p2, "P2")
             logger.info(f"[COVERAGE] Pass2: {len(used_chunks)}/{total_all_chunks} = {(100.0*len(used_chunks)/total_all_chunks):.1f}%")
         else:
             logger.info("[COVERAGE] Pass2: нет непокрытых чанков — пропуск")
 
     # Если ожидаемых потерпевших больше, чем извлечённых — адресный добор
     extracted_victims = len(state.get("victims", []))
-    if expected_victims and extracted_victims < expected_victims:
+    if manifest.plan("P1X") is not None and not manifest.stage_done("P1X"):
+        # прерванный адресный добор — доводим по сохранённому плану
+        await process_batches(plan_to_batches(manifest.plan("P1X"), docs_map), "P1X")
+        extracted_victims = len(state.get("victims", []))
+    elif expected_victims and extracted_victims < expected_victims and not manifest.stage_done("P1X"):
         logger.info(f"[VICTIMS] extracted {extracted_victims} < expected {expected_victims} -> targeted pass")
-        post_chunks = find_postanov_chunks(docs_map)
+        post_chunks = find_postanov_chunks({d: docs_map[d] for d in scope} if scope else docs_map)
         if post_chunks:
             # Сформируем мини-батчи только с постановлениями
             include = {}
             for did, chid in post_chunks:
                 include.setdefault(did, []).append(chid)
-            batches_target = build_batches_for_docs(docs_map, [k for k in include.keys()], max_files=6, max_tokens_in=BATCH_MAX_TOKENS//2, include_chunks=include)
+            batches_target = plan_batches(docs_map, [k for k in include.keys()], max_files=6, max_tokens_in=BATCH_MAX_TOKENS//2, include_chunks=include, title="P1X")
+            manifest.set_plan("P1X", batches_target)
             await process_batches(batches_target, "P1X")
             extracted_victims = len(state.get("victims", []))
             logger.info(f"[VICTIMS] after targeted pass: extracted={extracted_victims}")
@@ -292,27 +513,41 @@ async def run_pipeline(case_id: int) -> Dict[str, Any]:
         pass
 
     link_money_flows_to_victims(state)
-    write_json(paths["state"], state)
+    journal.snapshot(state)
+    state_digest = hashlib.sha1(json.dumps(state, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+    manifest.set_state_digest(state_digest)
+    manifest.finish_stage("extract", journal.seq)
 
-    # «УСТАНОВИЛ» — генерация
+    # «УСТАНОВИЛ» — генерация; промежуточный текст каждого шага сохраняется в манифест
     ustanovil_prompt, used_caps = fit_ustanovil_prompt(state, FINAL_MAX_TOKENS)
-    raw_ustanovil = await safe_call_generator(ustanovil_prompt, n_predict=FINAL_MAX_TOKENS, label="USTANOVIL", fallback_predict=[2400, 2000, 1600, 1200, 800])
-
-    ustanovil_text = _strip_md_fences(raw_ustanovil).strip()
-    if looks_like_refusal(ustanovil_text):
-        # мгновенно форсим расширение без извинений
-        refine0 = make_ustanovil_refine_prompt(state, ustanovil_text, need_pars=12, need_refs=8, need_words=900)
-        ustanovil_text = _strip_md_fences(await safe_call_generator(refine0, n_predict=min(1800, FINAL_MAX_TOKENS), label="USTANOVIL_REFINE#apology", fallback_predict=[1600, 1400, 1200, 800])).strip()
-
-    ustanovil_text = collapse_repeated_lines(ustanovil_text)
-    ustanovil_text = drop_generic_filler(ustanovil_text)
-    ustanovil_text = normalize_erdr_mentions(ustanovil_text, state.get("case_meta", {}).get("erdr"))
+    ust_step = next((st for st in ("final", "refined", "draft") if manifest.ustanovil(st) is not None), None)
+    if ust_step is None and manifest.base_ustanovil(state_digest) is not None:
+        # новые документы не дали новых фактов — текст прошлого прогона остаётся в силе
+        manifest.set_ustanovil("final", manifest.base_ustanovil(state_digest))
+        ust_step = "final"
+        logger.info("[INCREMENTAL] state unchanged — USTANOVIL reused")
+    if ust_step:
+        ustanovil_text = manifest.ustanovil(ust_step)
+        logger.info(f"[RESUME] USTANOVIL: resumed from step '{ust_step}'")
+    else:
+        raw_ustanovil = await safe_call_generator(ustanovil_prompt, n_predict=FINAL_MAX_TOKENS, label="USTANOVIL", fallback_predict=[2400, 2000, 1600, 1200, 800])
+
+        ustanovil_text = _strip_md_fences(raw_ustanovil).strip()
+        if looks_like_refusal(ustanovil_text):
+            # мгновенно форсим расширение без извинений
+            refine0 = make_ustanovil_refine_prompt(state, ustanovil_text, need_pars=12, need_refs=8, need_words=900)
+            ustanovil_text = _strip_md_fences(await safe_call_generator(refine0, n_predict=min(1800, FINAL_MAX_TOKENS), label="USTANOVIL_REFINE#apology", fallback_predict=[1600, 1400, 1200, 800])).strip()
+
+        ustanovil_text = collapse_repeated_lines(ustanovil_text)
+        ustanovil_text = drop_generic_filler(ustanovil_text)
+        ustanovil_text = normalize_erdr_mentions(ustanovil_text, state.get("case_meta", {}).get("erdr"))
+        manifest.set_ustanovil("draft", ustanovil_text)
 
     ok_ev, n_pars, n_refs, n_words = ensure_minimum_evidence(ustanovil_text, min_paragraphs=12, min_docrefs=8, min_words=900)
     logger.info(f"[USTANOVIL] quality: pars={n_pars}, refs={n_refs}, words={n_words}, ok={ok_ev}")
 
     rounds = 0
-    while (not ok_ev) and (rounds < UST_MAX_REFINE_ROUNDS):
+    while (not ok_ev) and (rounds < UST_MAX_REFINE_ROUNDS) and ust_step in (None, "draft"):
         rounds += 1
         need_pars = max(12, n_pars + 3)
         need_refs = max(8, n_refs + 2)
@@ -329,11 +564,13 @@ async def run_pipeline(case_id: int) -> Dict[str, Any]:
         ustanovil_text = refined
         ok_ev, n_pars, n_refs, n_words = ensure_minimum_evidence(ustanovil_text, min_paragraphs=12, min_docrefs=8, min_words=900)
         logger.info(f"[USTANOVIL] after refine#{rounds}: pars={n_pars}, refs={n_refs}, words={n_words}, ok={ok_ev}")
+    if ust_step in (None, "draft"):
+        manifest.set_ustanovil("refined", ustanovil_text)
 
     # Проверка покрытия потерпевших
     rel_for_cov = build_ustanovil_state_subset(state, used_caps)
     victims_all = [v for v in rel_for_cov.get("victims", []) if v.get("name")]
-    miss = missing_victims_by_paragraphs(ustanovil_text, victims_all)
+    miss = missing_victims_by_paragraphs(ustanovil_text, victims_all) if ust_step != "final" else []
     extra_rounds = 0
     while miss and extra_rounds < 3:
         extra_rounds += 1
@@ -346,6 +583,9 @@ async def run_pipeline(case_id: int) -> Dict[str, Any]:
         refined2 = normalize_erdr_mentions(refined2, state.get("case_meta", {}).get("erdr"))
         ustanovil_text = refined2
         miss = missing_victims_by_paragraphs(ustanovil_text, victims_all)
+    if ust_step != "final":
+        manifest.set_ustanovil("final", ustanovil_text)
+    manifest.finish_stage("done", journal.seq)
 
     final_text = compose_final_document(state, ustanovil_text).replace("```", "").strip()
     word_count = len(final_text.split())
@@ -370,5 +610,8 @@ async def run_pipeline(case_id: int) -> Dict[str, Any]:
         "coverage_chunks_used": len(used_chunks),
         "expected_victims": expected_victims,
         "extracted_victims": len(state.get("victims", [])),
+        "prefill_tokens_saved_est": sum(prefill_saved.values()),
+        "dup_chunks_skipped": sum(dup_skipped.values()),
+        "incremental_docs": len(scope),
         "result": final_text
     }
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 import json
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 from .config import (
     MAX_MODEL_LEN, SYSTEM_BUDGET, FINAL_MAX_TOKENS, UST_STATE_CAPS,
-    OFFENSE_DEFAULT_ARTICLE, logger
+    OFFENSE_DEFAULT_ARTICLE, PROMPT_LAYOUT, logger
 )
 from .io_utils import count_tokens
+from .grammar import schema_from_example
 
 def _extraction_schema(section: Optional[str]) -> str:
     if section == "vmf":
@@ -37,30 +39,82 @@ def _extraction_schema(section: Optional[str]) -> str:
         "}"
     )
 
-def make_extraction_prompt(batch_docs: List[Dict[str, Any]], state_snippet: Dict[str, Any], batch_id: str, section: Optional[str] = None) -> str:
-    rules_limits = (
-        "ПРАВИЛА ВЫВОДА:\n"
-        " - ключи/строки в двойных кавычках; null где нет данных; без комментариев; без висячих запятых;\n"
-        " - строки ≤ 200 символов; каждый факт снабжай doc_ref 'doc:<doc_id>#chunk:<chunk_id>'.\n"
-        " - ЛИМИТЫ МИНИМАЛЬНЫЕ, можно вернуть больше при наличии данных. Не придумывай.\n"
-        " - Если встречаются протоколы допросов потерпевших — подробно извлекай steps/transfers.\n"
-        " - Для КАЖДОГО потерпевшего, встречающегося в документах батча, ОБЯЗАТЕЛЬНО заполни steps по схеме: "
-        "кто привлёк → регистрация (TAKORP/реф/OKX) → переводы (сумма/валюта/куда/через что) → обещания → попытка вывода/блокировка → итоговый ущерб.\n"
-        " - Ответ ДОЛЖЕН быть СТРОГО валидным JSON и начинаться символом '{' без преамбул, пояснений и Markdown.\n"
-    )
-    system = (
-        "Ты юрист-аналитик. ДАНО: фрагменты материалов дела.\n"
-        "ЗАДАЧА: извлечь факты для квалификации по ст.217 УК РК, с максимальным вниманием к ПОТЕРПЕВШИМ.\n"
-        "СТРОГО запрещено писать любые извинения, фразы 'не могу', 'не удалось'. Возвращай только JSON по схеме.\n"
-        + rules_limits + "СХЕМА:\n" + _extraction_schema(section)
-    )
-    state_json = json.dumps(state_snippet, ensure_ascii=False)
-    parts = ["=== ИНСТРУКЦИЯ ===", system, "=== GLOBAL_STATE_SNIPPET ===", state_json, "=== ДОКУМЕНТЫ (ПО БАТЧУ) ==="]
+@lru_cache(maxsize=None)
+def extraction_json_schema(section: Optional[str]) -> Dict[str, Any]:
+    """JSON Schema ответа экстракции — выводится из той же схемы-примера, что видит модель."""
+    return schema_from_example(json.loads(_extraction_schema(section)))
+
+_EXTRACTION_RULES = (
+    "ПРАВИЛА ВЫВОДА:\n"
+    " - ключи/строки в двойных кавычках; null где нет данных; без комментариев; без висячих запятых;\n"
+    " - строки ≤ 200 символов; каждый факт снабжай doc_ref 'doc:<doc_id>#chunk:<chunk_id>'.\n"
+    " - ЛИМИТЫ МИНИМАЛЬНЫЕ, можно вернуть больше при наличии данных. Не придумывай.\n"
+    " - Если встречаются протоколы допросов потерпевших — подробно извлекай steps/transfers.\n"
+    " - Для КАЖДОГО потерпевшего, встречающегося в документах батча, ОБЯЗАТЕЛЬНО заполни steps по схеме: "
+    "кто привлёк → регистрация (TAKORP/реф/OKX) → переводы (сумма/валюта/куда/через что) → обещания → попытка вывода/блокировка → итоговый ущерб.\n"
+    " - Ответ ДОЛЖЕН быть СТРОГО валидным JSON и начинаться символом '{' без преамбул, пояснений и Markdown.\n"
+)
+_EXTRACTION_SYSTEM = (
+    "Ты юрист-аналитик. ДАНО: фрагменты материалов дела.\n"
+    "ЗАДАЧА: извлечь факты для квалификации по ст.217 УК РК, с максимальным вниманием к ПОТЕРПЕВШИМ.\n"
+    "СТРОГО запрещено писать любые извинения, фразы 'не могу', 'не удалось'. Возвращай только JSON по схеме.\n"
+    + _EXTRACTION_RULES
+)
+
+def _render_docs(batch_docs: List[Dict[str, Any]]) -> List[str]:
+    parts = []
     for d in batch_docs:
         lines = [f"## DOC doc_id={d['doc_id']}"]
         for ch in d["chunks"]:
             lines.append(f"[chunk {ch['chunk_id']}]\n{ch['text']}")
         parts.append("\n".join(lines))
+    return parts
+
+def make_extraction_prefix(batch_docs: List[Dict[str, Any]]) -> str:
+    """
+    Общий префикс раскладки «prefix»: инструкция без схемы + документы батча.
+    Одинаков для секций vmf/rest и не зависит от state — сервер может переиспользовать KV-кэш.
+    """
+    parts = ["=== ИНСТРУКЦИЯ ===", _EXTRACTION_SYSTEM, "=== ДОКУМЕНТЫ (ПО БАТЧУ) ==="]
+    parts.extend(_render_docs(batch_docs))
+    return "\n\n".join(parts)
+
+# ---------- Учёт токенов без повторной токенизации ----------
+@lru_cache(maxsize=8192)
+def _short_tokens(s: str) -> int:
+    return count_tokens(s)
+
+def chunk_block_tokens(ch: Dict[str, Any]) -> int:
+    """Стоимость чанка в промпте: '[chunk N]\\n' + текст (готовый n_tokens) + перевод строки."""
+    return _short_tokens(f"[chunk {ch['chunk_id']}]\n") + int(ch["n_tokens"]) + 1
+
+def doc_block_tokens(doc: Dict[str, Any]) -> int:
+    """Стоимость блока документа: заголовок '## DOC', разделитель блоков и все его чанки."""
+    return _short_tokens(f"## DOC doc_id={doc['doc_id']}") + 2 + sum(chunk_block_tokens(ch) for ch in doc["chunks"])
+
+def extraction_overhead_tokens(state_snippet: Dict[str, Any], batch_id: str, section: Optional[str], layout: Optional[str] = None) -> int:
+    """Токены шаблона экстракции без документов (инструкция, схема, state, хвост)."""
+    return count_tokens(make_extraction_prompt([], state_snippet, batch_id, section=section, layout=layout))
+
+def extraction_prefix_tokens(batch_docs: List[Dict[str, Any]]) -> int:
+    """Оценка токенов общего префикса раскладки «prefix» — арифметикой, без токенизации документов."""
+    return _short_tokens(make_extraction_prefix([])) + sum(doc_block_tokens(d) for d in batch_docs)
+
+def make_extraction_prompt(batch_docs: List[Dict[str, Any]], state_snippet: Dict[str, Any], batch_id: str, section: Optional[str] = None, layout: Optional[str] = None) -> str:
+    state_json = json.dumps(state_snippet, ensure_ascii=False)
+    if (layout or PROMPT_LAYOUT) == "prefix":
+        # документы первыми; схема секции и быстро меняющийся state — в хвосте
+        parts = [
+            make_extraction_prefix(batch_docs),
+            f"=== СХЕМА ОТВЕТА (СЕКЦИЯ {section or 'all'}) ===", _extraction_schema(section),
+            "=== GLOBAL_STATE_SNIPPET ===", state_json,
+            f'=== ВЕРНИ ТОЛЬКО JSON! Укажи "batch_id":"{batch_id}" ===',
+        ]
+        return "\n\n".join(parts)
+
+    system = _EXTRACTION_SYSTEM + "СХЕМА:\n" + _extraction_schema(section)
+    parts = ["=== ИНСТРУКЦИЯ ===", system, "=== GLOBAL_STATE_SNIPPET ===", state_json, "=== ДОКУМЕНТЫ (ПО БАТЧУ) ==="]
+    parts.extend(_render_docs(batch_docs))
     parts.append(f'=== ВЕРНИ ТОЛЬКО JSON! Укажи "batch_id":"{batch_id}" ===')
     if section: parts.append(f"=== СЕКЦИЯ === {section}")
     return "\n\n".join(parts)
@@ -138,24 +192,66 @@ def make_ustanovil_prompt(state: Dict[str, Any], caps: Optional[Dict[str, int]]
         "\n\n=== ВЕРНИ ТОЛЬКО ТЕКСТ РАЗДЕЛА БЕЗ ЗАГОЛОВКА ==="
     )
 
+_UST_MIN_CAPS = {"victims": 40, "events": 60, "money_flows": 40, "actors": 30, "pyramid_indicators": 20, "mechanism_bullets": 12, "offense_articles": 5}
+_UST_FIT_ORDER = ["victims", "events", "money_flows", "actors", "pyramid_indicators", "mechanism_bullets"]
+
+def _ust_item_tokens(kind: str, it: Any) -> int:
+    """Прирост промпта от одного элемента state: его JSON + разделитель, у потерпевшего ещё имя в списке."""
+    cost = count_tokens(json.dumps(it, ensure_ascii=False)) + 1
+    if kind == "victims" and isinstance(it, dict) and it.get("name"):
+        cost += count_tokens(str(it["name"])) + 1
+    return cost
+
 def fit_ustanovil_prompt(state: Dict[str, Any], predict_budget: int) -> Tuple[str, Dict[str, int]]:
+    """
+    Подбор caps под контекст за один проход (жадный рюкзак):
+    - минимальные caps берутся всегда, их промпт считается точно один раз;
+    - сверх минимума элементы добираются по убыванию (1 + _score_item) / токены,
+      причём внутри каждого вида — строго префиксом его top-k (caps остаются осмысленными);
+    - итоговый промпт токенизируется один раз; при промахе оценки снимаем последние добавленные.
+    """
+    budget = MAX_MODEL_LEN - predict_budget - SYSTEM_BUDGET
+    ranked = {k: sorted(state.get(k, []) or [], key=_score_item, reverse=True) for k in _UST_FIT_ORDER}
     caps = dict(UST_STATE_CAPS)
-    min_caps = {"victims": 40, "events": 60, "money_flows": 40, "actors": 30, "pyramid_indicators": 20, "mechanism_bullets": 12, "offense_articles": 5}
-    order = ["victims", "events", "money_flows", "actors", "pyramid_indicators", "mechanism_bullets"]
-    while True:
+    for k in _UST_FIT_ORDER:
+        caps[k] = min(UST_STATE_CAPS.get(k, 0), _UST_MIN_CAPS[k])
+
+    base = count_tokens(make_ustanovil_prompt(state, caps=caps))
+    free = budget - base
+    added: List[str] = []
+
+    # кандидаты: следующий элемент каждого вида; жадно по ценности на токен
+    def candidate(k: str) -> Optional[Tuple[float, int]]:
+        idx = caps[k]
+        if idx >= min(len(ranked[k]), UST_STATE_CAPS.get(k, 0)):
+            return None
+        it = ranked[k][idx]
+        cost = _ust_item_tokens(k, it)
+        return (1.0 + _score_item(it)) / max(1, cost), cost
+
+    cands = {k: candidate(k) for k in _UST_FIT_ORDER}
+    while free > 0:
+        live = [(c[0], -_UST_FIT_ORDER.index(k), k) for k, c in cands.items() if c]
+        if not live:
+            break
+        _, _, k = max(live)
+        cost = cands[k][1]
+        if cost > free:
+            cands[k] = None  # вид упёрся в бюджет: пропуск нарушил бы префикс top-k
+            continue
+        caps[k] += 1; free -= cost; added.append(k)
+        cands[k] = candidate(k)
+
+    prompt = make_ustanovil_prompt(state, caps=caps)
+    need = count_tokens(prompt)
+    while need > budget and added:
+        for _ in range(max(1, len(added) // 20)):
+            if added:
+                caps[added.pop()] -= 1
         prompt = make_ustanovil_prompt(state, caps=caps)
-        need = count_tokens(prompt) + predict_budget + SYSTEM_BUDGET
-        if need <= MAX_MODEL_LEN:
-            return prompt, caps
-        changed = False
-        for k in order:
-            cur = caps.get(k, 0)
-            if cur > min_caps[k]:
-                newv = max(min_caps[k], int(cur * 0.85))
-                if newv < cur:
-                    caps[k] = newv; changed = True
-        if not changed:
-            return prompt, caps
+        need = count_tokens(prompt)
+    logger.info(f"[USTANOVIL] fit: tokens={need}/{budget} caps={ {k: caps[k] for k in _UST_FIT_ORDER} }")
+    return prompt, caps
 
 def make_ustanovil_refine_prompt(state: Dict[str, Any], draft_text: str, need_pars: int, need_refs: int, need_words: int) -> str:
     cm = state.get("case_meta", {}) or {}
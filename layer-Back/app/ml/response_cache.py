@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Дисковый кэш ответов генератора (content-addressed).
+- ключ: sha256(prompt, model, n_predict, параметры сэмплинга, версия guardrails, режим);
+- одна запись = один файл <key>.json, LRU по mtime, общий размер ограничен GEN_CACHE_MAX_MB;
+- записи другой GENERATOR_MODEL игнорируются (даже при совпадении ключа);
+- bypass_cache() — «свежий» прогон: чтение отключено, запись обновляет кэш.
+"""
+from __future__ import annotations
+
+import os
+import json
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from .config import GENERATOR_MODEL, GEN_CACHE_ENABLED, GEN_CACHE_DIR, GEN_CACHE_MAX_MB
+
+# Флаг «свежего» прогона; ContextVar наследуется задачами asyncio, созданными внутри прогона
+_bypass: ContextVar[bool] = ContextVar("gen_cache_bypass", default=False)
+
+@contextmanager
+def bypass_cache(enabled: bool = True):
+    token = _bypass.set(enabled)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+def make_cache_key(prompt: str, n_predict: int, params: Dict[str, Any]) -> str:
+    h = hashlib.sha256()
+    h.update(json.dumps({"model": GENERATOR_MODEL, "n_predict": n_predict, **params}, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    h.update(b"\0")
+    h.update(prompt.encode("utf-8"))
+    return h.hexdigest()
+
+class ResponseCache:
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (size, atime); строится лениво сканом каталога
+        self._index: Optional[Dict[str, Tuple[int, float]]] = None
+        self._total = 0
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0, "bypassed": 0, "model_mismatch": 0}
+
+    def _path(self, key: str) -> Path:
+        return self.root / f"{key}.json"
+
+    def _load_index(self) -> Dict[str, Tuple[int, float]]:
+        if self._index is None:
+            self._index = {}
+            self._total = 0
+            if self.root.exists():
+                for fn in self.root.glob("*.json"):
+                    try:
+                        st = fn.stat()
+                    except OSError:
+                        continue
+                    self._index[fn.stem] = (st.st_size, st.st_mtime)
+                    self._total += st.st_size
+        return self._index
+
+    def _drop(self, key: str) -> None:
+        idx = self._load_index()
+        size, _ = idx.pop(key, (0, 0.0))
+        self._total -= size
+        try:
+            self._path(key).unlink()
+        except OSError:
+            pass
+
+    def get(self, key: str) -> Optional[str]:
+        if _bypass.get():
+            self.stats["bypassed"] += 1
+            return None
+        with self._lock:
+            idx = self._load_index()
+            if key not in idx:
+                self.stats["misses"] += 1
+                return None
+            try:
+                rec = json.loads(self._path(key).read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                self._drop(key)
+                self.stats["misses"] += 1
+                return None
+            if rec.get("model") != GENERATOR_MODEL:
+                self.stats["model_mismatch"] += 1
+                self.stats["misses"] += 1
+                return None
+            now = time.time()
+            try:
+                os.utime(self._path(key), (now, now))
+            except OSError:
+                pass
+            idx[key] = (idx[key][0], now)
+            self.stats["hits"] += 1
+            return rec.get("text")
+
+    def put(self, key: str, text: str, meta: Optional[Dict[str, Any]] = None) -> None:
+        rec = {"model": GENERATOR_MODEL, "created_at": time.time(), **(meta or {}), "text": text}
+        data = json.dumps(rec, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            idx = self._load_index()
+            self.root.mkdir(parents=True, exist_ok=True)
+            tmp = self._path(key).with_suffix(".tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, self._path(key))
+            self._total -= idx.get(key, (0, 0.0))[0]
+            idx[key] = (len(data), time.time())
+            self._total += len(data)
+            self.stats["writes"] += 1
+            self._evict()
+
+    def _evict(self) -> None:
+        idx = self._load_index()
+        if self._total <= self.max_bytes:
+            return
+        for key, _ in sorted(idx.items(), key=lambda kv: kv[1][1]):
+            if self._total <= self.max_bytes:
+                break
+            self._drop(key)
+            self.stats["evictions"] += 1
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            idx = self._load_index()
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                "enabled": GEN_CACHE_ENABLED,
+                "dir": str(self.root),
+                "entries": len(idx),
+                "bytes": self._total,
+                "max_bytes": self.max_bytes,
+                "hit_ratio": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+                **self.stats,
+            }
+
+response_cache = ResponseCache(GEN_CACHE_DIR, GEN_CACHE_MAX_MB * 1024 * 1024)
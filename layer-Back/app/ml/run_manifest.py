@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Манифест прогона пайплайна (state/run_manifest.json) — чекпоинты для возобновления.
+- план батчей каждого прохода, завершённые вызовы (батч × секция), used_chunks,
+  достигнутые стадии и промежуточный текст «УСТАНОВИЛ»;
+- отпечаток (fingerprint) набора чанков и конфигурации пайплайна: при изменении
+  документов/настроек манифест сбрасывается автоматически;
+- state_seq — seq журнала state, до которого манифест согласован: дельты журнала
+  с бóльшим seq (сбой между записью дельты и манифеста) засчитываются как выполненные вызовы;
+- инкрементальный прогон: если предыдущий прогон завершён, конфигурация та же и документы
+  только добавились/изменились, новый манифест получает scope — doc_id новых/изменённых
+  документов; used_chunks прежнего прогона (кроме scope) переносятся. Факты изменённого
+  документа из прежней версии в state остаются (дельты state не откатываются).
+  Удаление документов — полный прогон.
+"""
+from __future__ import annotations
+
+import os
+import json
+import time
+import hashlib
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import (
+    logger, GENERATOR_MODEL, MARKER_SCAN_CHUNKS, PER_DOC_TOKEN_CAP, BATCH_MAX_FILES, BATCH_MAX_TOKENS,
+    ENABLE_PASS2_ON_GAPS, PASS2_PER_DOC_CAP, EXTRACT_MAX_TOKENS, MAX_MODEL_LEN, SYSTEM_BUDGET,
+    STATE_SNIPPET_SIZES, FINAL_MAX_TOKENS, UST_STATE_CAPS, UST_MAX_REFINE_ROUNDS, SECTIONAL_EXTRACTION,
+    PROMPT_LAYOUT, GEN_CONSTRAINED_EXTRACT, INCREMENTAL_NEIGHBOURS, CLUSTER_HUB_DF, CLUSTER_HUB_MIN_DOCS,
+    CLUSTER_MAX_SIZE, BATCH_PACKING,
+)
+from .generator import GUARDRAIL_VERSION
+
+_VERSION = 2
+
+def doc_fingerprints(docs_map: Dict[str, List[Any]]) -> Dict[str, str]:
+    """doc_id -> отпечаток содержимого чанков документа (hash/n_tokens)."""
+    out: Dict[str, str] = {}
+    for doc_id, chunks in docs_map.items():
+        h = hashlib.sha1()
+        for ch in chunks:
+            h.update(f"{ch['chunk_id']}:{ch['n_tokens']}:{ch['hash']}\n".encode("utf-8"))
+        out[doc_id] = h.hexdigest()
+    return out
+
+def config_fingerprint() -> str:
+    """Отпечаток всего, что влияет на план и промпты."""
+    cfg = {
+        "version": _VERSION, "model": GENERATOR_MODEL, "guardrails": GUARDRAIL_VERSION,
+        "marker_scan": MARKER_SCAN_CHUNKS, "per_doc_cap": PER_DOC_TOKEN_CAP, "batch_files": BATCH_MAX_FILES,
+        "batch_tokens": BATCH_MAX_TOKENS, "pass2": ENABLE_PASS2_ON_GAPS, "pass2_cap": PASS2_PER_DOC_CAP,
+        "extract_max": EXTRACT_MAX_TOKENS, "model_len": MAX_MODEL_LEN, "system_budget": SYSTEM_BUDGET,
+        "snippet": STATE_SNIPPET_SIZES, "final_max": FINAL_MAX_TOKENS, "ust_caps": UST_STATE_CAPS,
+        "ust_rounds": UST_MAX_REFINE_ROUNDS, "sectional": SECTIONAL_EXTRACTION, "layout": PROMPT_LAYOUT,
+        "constrained": GEN_CONSTRAINED_EXTRACT, "neighbours": INCREMENTAL_NEIGHBOURS,
+        "hub_df": CLUSTER_HUB_DF, "hub_min": CLUSTER_HUB_MIN_DOCS, "cluster_max": CLUSTER_MAX_SIZE,
+        "packing": BATCH_PACKING,
+    }
+    return hashlib.sha1(json.dumps(cfg, sort_keys=True).encode("utf-8")).hexdigest()
+
+def run_fingerprint(docs_fp: Dict[str, str], config_fp: str) -> str:
+    h = hashlib.sha1(config_fp.encode("utf-8"))
+    for doc_id in sorted(docs_fp, key=int):
+        h.update(f"{doc_id}:{docs_fp[doc_id]}\n".encode("utf-8"))
+    return h.hexdigest()
+
+def batches_to_plan(batches: List[List[Dict[str, Any]]]) -> List[List[Tuple[str, List[int]]]]:
+    return [[(d["doc_id"], [int(ch["chunk_id"]) for ch in d["chunks"]]) for d in b] for b in batches]
+
+def plan_to_batches(plan: List[List[Tuple[str, List[int]]]], docs_map: Dict[str, List[Any]]) -> List[List[Dict[str, Any]]]:
+    by_id = {doc_id: {int(ch["chunk_id"]): ch for ch in chunks} for doc_id, chunks in docs_map.items()}
+    return [[{"doc_id": doc_id, "chunks": [by_id[doc_id][cid] for cid in cids]} for doc_id, cids in b] for b in plan]
+
+class RunManifest:
+    def __init__(self, path: Path, data: Dict[str, Any]):
+        self.path = path
+        self.data = data
+        self._done = set(data["done"])
+        self.resumed = False
+
+    @classmethod
+    def open(cls, path: Path, docs_map: Dict[str, List[Any]], fresh: bool = False) -> "RunManifest":
+        docs_fp, config_fp = doc_fingerprints(docs_map), config_fingerprint()
+        fingerprint = run_fingerprint(docs_fp, config_fp)
+        data: Optional[Dict[str, Any]] = None
+        if path.exists() and not fresh:
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+            except ValueError:
+                data = None
+            if data is not None and data.get("version") != _VERSION:
+                data = None
+        if data is not None and data.get("fingerprint") == fingerprint:
+            logger.info(f"[RESUME] manifest: stages={data['stages']}, done_calls={len(data['done'])}, used_chunks={len(data['used_chunks'])}")
+            m = cls(path, data)
+            m.resumed = True
+            return m
+
+        new = {
+            "version": _VERSION, "fingerprint": fingerprint, "config": config_fp, "docs": docs_fp,
+            "created_at": time.time(), "updated_at": None, "scope": None, "base": None,
+            "stages": [], "plans": {}, "batches": {}, "done": [], "used_chunks": [],
+            "dup_skipped": {}, "prefill_saved": {}, "state_seq": 0, "ustanovil": {},
+        }
+        if data is not None:
+            prev_docs = data.get("docs") or {}
+            removed = [d for d in prev_docs if d not in docs_fp]
+            if "done" in data["stages"] and data.get("config") == config_fp and not removed:
+                scope = sorted((d for d in docs_fp if prev_docs.get(d) != docs_fp[d]), key=int)
+                new["scope"] = scope
+                new["used_chunks"] = [[d, c] for d, c in data["used_chunks"] if d not in set(scope)]
+                new["base"] = {"state_digest": data.get("state_digest"), "ustanovil": data["ustanovil"].get("final")}
+                logger.info(f"[INCREMENTAL] {len(scope)} new/changed of {len(docs_fp)} documents: {scope}")
+            else:
+                why = "documents removed" if removed else ("previous run unfinished" if "done" not in data["stages"] else "pipeline config changed")
+                logger.info(f"[RESUME] manifest invalidated ({why}) — full run")
+        elif fresh:
+            logger.info("[RESUME] fresh run — manifest reset")
+        return cls(path, new)
+
+    @property
+    def scope(self) -> Optional[List[str]]:
+        """doc_id новых/изменённых документов для инкрементального прогона (None — полный прогон)."""
+        return self.data.get("scope")
+
+    def save(self) -> None:
+        self.data["updated_at"] = time.time()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(self.data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+    # --- стадии ---
+    def stage_done(self, name: str) -> bool:
+        return name in self.data["stages"]
+
+    def finish_stage(self, name: str, state_seq: Optional[int] = None) -> None:
+        if name not in self.data["stages"]:
+            self.data["stages"].append(name)
+        if state_seq is not None:
+            self.data["state_seq"] = state_seq
+        self.save()
+
+    # --- планы и вызовы ---
+    def plan(self, tag: str) -> Optional[List[List[Tuple[str, List[int]]]]]:
+        return self.data["plans"].get(tag)
+
+    def set_plan(self, tag: str, batches: List[List[Dict[str, Any]]]) -> None:
+        self.data["plans"][tag] = batches_to_plan(batches)
+        self.save()
+
+    def batch_docs(self, key: str) -> Optional[List[Tuple[str, List[int]]]]:
+        """Состав батча после отсева уже отправленных чанков (фиксируется при первом запуске батча)."""
+        return self.data["batches"].get(key)
+
+    def set_batch_docs(self, key: str, batch_docs: List[Dict[str, Any]]) -> None:
+        self.data["batches"][key] = batches_to_plan([batch_docs])[0]
+
+    def job_done(self, key: str) -> bool:
+        return key in self._done
+
+    def _add_done(self, key: str) -> None:
+        if key not in self._done:
+            self._done.add(key)
+            self.data["done"].append(key)
+
+    def mark_job(self, key: str, used_chunks: set, dup_skipped: Dict[str, int], prefill_saved: Dict[str, int], state_seq: int) -> None:
+        self._add_done(key)
+        self.checkpoint(used_chunks, dup_skipped, prefill_saved, state_seq)
+
+    def checkpoint(self, used_chunks: set, dup_skipped: Dict[str, int], prefill_saved: Dict[str, int], state_seq: int) -> None:
+        self.data["used_chunks"] = sorted([d, c] for d, c in used_chunks)
+        self.data["dup_skipped"] = dict(dup_skipped)
+        self.data["prefill_saved"] = dict(prefill_saved)
+        self.data["state_seq"] = state_seq
+        self.save()
+
+    def reconcile(self, journal_tags: List[Tuple[int, str]]) -> None:
+        """
+        Дельты, попавшие в журнал после последней записи манифеста, считаем выполненными вызовами
+        (их used_chunks не сохранились — эти чанки при необходимости доберёт Pass2).
+        """
+        if not self.resumed:
+            return
+        late = [tag for seq, tag in journal_tags if seq > self.data["state_seq"]]
+        for tag in late:
+            if tag == "BOOTSTRAP":
+                if "bootstrap" not in self.data["stages"]:
+                    self.data["stages"].append("bootstrap")
+            elif tag:
+                self._add_done(tag)
+        if late:
+            logger.info(f"[RESUME] journal entries ahead of manifest counted as done: {late}")
+            self.data["state_seq"] = max(seq for seq, _ in journal_tags)
+            self.save()
+
+    # --- «УСТАНОВИЛ» ---
+    def ustanovil(self, step: str) -> Optional[str]:
+        return (self.data["ustanovil"] or {}).get(step)
+
+    def set_ustanovil(self, step: str, text: str) -> None:
+        self.data["ustanovil"][step] = text
+        self.save()
+
+    def base_ustanovil(self, state_digest: str) -> Optional[str]:
+        """Текст «УСТАНОВИЛ» прошлого прогона, если state с тех пор не изменился."""
+        base = self.data.get("base") or {}
+        return base.get("ustanovil") if base.get("state_digest") == state_digest else None
+
+    def set_state_digest(self, state_digest: str) -> None:
+        self.data["state_digest"] = state_digest
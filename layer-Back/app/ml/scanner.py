@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Однопроходный сканер текста: набор регулярок объединяется в одну альтернацию
+с именованными группами, и текст просматривается один раз вместо прохода на каждую
+регулярку. Результат — типизированные спаны (вид, начало, конец, текст).
+- альтернативы пробуются слева направо: на одной позиции побеждает первая подошедшая,
+  поэтому порядок видов важен (например, iin до card);
+- спаны одного прохода не перекрываются, поэтому виды, чьи совпадения могут налегать на чужие
+  (e-mail и Telegram-ник съедают цифры и друг друга: «@ivan@mail.kz», «900101300001@mail.kz»),
+  ищутся отдельными проходами (separate: вид -> подстрока, без которой совпадения быть не может,
+  например "@"; проход по тексту без неё пропускается) — иначе совпадение одного вида скрывает другое;
+- drop_inside — пары (внешний, внутренний): спан внутреннего вида, начинающийся строго внутри
+  спана внешнего, отбрасывается («@mail» из «ivan@mail.kz» — не Telegram-ник).
+Бенчмарк против раздельных регулярок: python -m app.ml.scanner
+"""
+from __future__ import annotations
+
+import re
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+class Span(NamedTuple):
+    kind: str
+    start: int
+    end: int
+    text: str
+
+class Scanner:
+    r"""
+    first_chars — класс символов, с которых может начинаться любое совпадение общего прохода (без
+    скобок, например r"\d+A-Z"). Опережающая проверка по нему отсекает позиции, где ни одна альтернатива
+    не начнётся, и возвращает альтернации скорость раздельных регулярок с их префиксными
+    оптимизациями; без неё sre пробует все ветки на каждой позиции.
+    """
+    def __init__(self, patterns: Sequence[Tuple[str, str]], flags: int = 0, first_chars: Optional[str] = None,
+                 separate: Optional[Dict[str, Optional[str]]] = None, drop_inside: Sequence[Tuple[str, str]] = ()):
+        separate = separate or {}
+        body = "|".join(f"(?P<{kind}>{pat})" for kind, pat in patterns if kind not in separate)
+        if first_chars:
+            body = f"(?=[{first_chars}])(?:{body})"
+        self.regex = re.compile(body, flags)
+        self.extra = [(separate[kind], re.compile(f"(?P<{kind}>{pat})", flags)) for kind, pat in patterns if kind in separate]
+        self.drop_inside = list(drop_inside)
+
+    def scan(self, text: str) -> List[Span]:
+        text = text or ""
+        spans = [Span(m.lastgroup, m.start(), m.end(), m.group()) for m in self.regex.finditer(text)]
+        n_main = len(spans)
+        for needle, rx in self.extra:
+            if needle is None or needle in text:
+                spans.extend(Span(m.lastgroup, m.start(), m.end(), m.group()) for m in rx.finditer(text))
+        if len(spans) == n_main:
+            return spans
+        spans.sort(key=lambda s: (s.start, s.end))
+        for outer, inner in self.drop_inside:
+            cover = [(s.start, s.end) for s in spans if s.kind == outer]
+            if cover:
+                spans = [s for s in spans if s.kind != inner or not any(a < s.start < b for a, b in cover)]
+        return spans
+
+    def kinds(self, text: str) -> Set[str]:
+        """Виды, встретившиеся в тексте хотя бы раз."""
+        if self.extra:
+            return {s.kind for s in self.scan(text)}
+        return {m.lastgroup for m in self.regex.finditer(text or "")}
+
+def spans_of(spans: Iterable[Span], kinds: Iterable[str]) -> List[Span]:
+    wanted = set(kinds)
+    return [s for s in spans if s.kind in wanted]
+
+def benchmark(n_chunks: int = 2000, repeat: int = 3) -> None:
+    """
+    Сравнение с прежней схемой: шесть регулярок маркеров на первых чанках документа
+    плюс отдельные пересканирования под постановления/протоколы — против одного прохода
+    CHUNK_SCANNER на чанк с переиспользованием спанов всеми потребителями.
+    """
+    import random
+    from . import markers
+
+    rnd = random.Random(0)
+    words = ["перевёл", "тенге", "потерпевший", "OKX", "USDT", "кошелёк", "следователь", "реферальной", "ссылке"]
+    texts = []
+    for i in range(n_chunks):
+        body = " ".join(rnd.choice(words) for _ in range(250))
+        head = "ПОСТАНОВЛЕНИЕ о признании лица потерпевшим\n" if i % 7 == 0 else ("ПРОТОКОЛ допроса потерпевшего\n" if i % 5 == 0 else "")
+        texts.append(f"{head}{body} тел +7 701 {i % 1000:03d} 45 67 ИИН {900101300000 + i} "
+                     f"iban KZ{i:018d} карта 4400 4301 {i % 10000:04d} 1111 почта u{i}@mail.kz tg @user{i}")
+
+    legacy_res = [markers.IIN_RE, markers.PHONE_RE, markers.IBAN_RE, markers.CARD_RE, markers.EMAIL_RE, markers.TG_RE]
+
+    def legacy() -> int:
+        found = 0
+        for t in texts:
+            for rx in legacy_res:                      # build_doc_markers
+                found += len(rx.findall(t))
+            found += bool(markers.POSTANOV_RE.search(t))        # find_postanov_chunks
+            found += bool(markers.POSTANOV_RE.search(t))        # bootstrap_victims_from_postanov
+            found += bool(markers.PROTOKOL_VICTIM_RE.search(t))  # find_protokol_chunks
+        return found
+
+    def single_pass() -> int:
+        found = 0
+        for t in texts:
+            spans = markers.CHUNK_SCANNER.scan(t)
+            found += len(spans_of(spans, markers.MARKER_KINDS))
+            found += sum(1 for s in spans if s.kind in ("postanov", "protokol"))
+        return found
+
+    for name, fn in (("legacy (6 regexes + rescans)", legacy), ("single pass", single_pass)):
+        best = min(_timed(fn) for _ in range(repeat))
+        print(f"{name:32s} {best * 1000:8.1f} ms на {n_chunks} чанков")
+
+def _timed(fn) -> float:
+    t0 = time.perf_counter()
+    fn()
+    return time.perf_counter() - t0
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Персистентность global_state: снапшот + журнал дельт.
+- после каждого мерджа в журнал (global_state.journal.jsonl) дописывается одна строка
+  с дельтой: добавленные элементы списков, изменённые потерпевшие, заполненная мета;
+- раз в STATE_SNAPSHOT_EVERY записей, в конце каждого прохода и прогона — компакция: снапшот
+  (global_state.snapshot.json) пишется через tmp + fsync + rename, журнал обнуляется;
+- у записей журнала сквозной seq, снапшот помнит последний применённый (_journal_seq),
+  поэтому сбой между rename снапшота и очисткой журнала не применит дельты дважды;
+- вместе со снапшотом обновляется публичный global_state.json — то же состояние без служебных
+  полей; его читают снаружи, журнал для этого не нужен;
+- load(): снапшот + повтор журнала; оборванная последняя строка отбрасывается.
+Операции: extend (добавить в конец списка), patch (заменить элементы по индексу),
+set (заменить ключ целиком — при сортировке/обрезке списка и для мелких полей).
+"""
+from __future__ import annotations
+
+import os
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from .config import logger, STATE_SNAPSHOT_EVERY
+
+_SEQ_KEY = "_journal_seq"
+
+def apply_ops(state: Dict[str, Any], ops: List[Dict[str, Any]]) -> None:
+    for op in ops:
+        kind, key = op["op"], op["key"]
+        if kind == "set":
+            state[key] = op["value"]
+        elif kind == "extend":
+            state.setdefault(key, []).extend(op["items"])
+        elif kind == "patch":
+            dst = state.setdefault(key, [])
+            for idx, item in op["items"].items():
+                dst[int(idx)] = item
+
+class StateTracker:
+    """Снимает длины списков до мерджа и строит по ним дельту после."""
+    def __init__(self, state: Dict[str, Any], keys: Iterable[str]):
+        self.before = {k: len(state.get(k) or []) for k in keys}
+
+    def ops(self, state: Dict[str, Any], added: Dict[str, int], touched: Optional[Dict[str, Set[int]]] = None,
+            set_keys: Iterable[str] = ()) -> List[Dict[str, Any]]:
+        ops: List[Dict[str, Any]] = []
+        for k, n0 in self.before.items():
+            cur = state.get(k) or []
+            n_add = added.get(k, 0)
+            if len(cur) != n0 + n_add:
+                # список отсортирован/обрезан по лимиту — индексы поплыли, пишем целиком
+                ops.append({"op": "set", "key": k, "value": cur})
+                continue
+            patched = sorted(i for i in (touched or {}).get(k, ()) if i < n0)
+            if patched:
+                ops.append({"op": "patch", "key": k, "items": {str(i): cur[i] for i in patched}})
+            if n_add:
+                ops.append({"op": "extend", "key": k, "items": cur[n0:]})
+        for k in set_keys:
+            if k in state:
+                ops.append({"op": "set", "key": k, "value": state[k]})
+        return ops
+
+def _write_durable(path: Path, text: str) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class StateJournal:
+    def __init__(self, state_path: Path, snapshot_every: int = STATE_SNAPSHOT_EVERY):
+        self.state_path = state_path
+        self.snapshot_path = state_path.with_name(state_path.stem + ".snapshot.json")
+        self.journal_path = state_path.with_name(state_path.stem + ".journal.jsonl")
+        self.snapshot_every = max(1, snapshot_every)
+        self.seq = 0
+        self.pending = 0  # записей журнала после последнего снапшота
+        self.replayed: List[Tuple[int, str]] = []  # (seq, tag) повторённых при load записей
+
+    def load(self, default: Dict[str, Any]) -> Dict[str, Any]:
+        # до появления отдельного снапшота им был сам global_state.json (с _journal_seq)
+        src = self.snapshot_path if self.snapshot_path.exists() else self.state_path
+        if src.exists():
+            state = json.loads(src.read_text(encoding="utf-8"))
+        else:
+            state = default
+        self.seq = int(state.pop(_SEQ_KEY, 0) or 0)
+        if not self.journal_path.exists():
+            return state
+
+        replayed, good_bytes = 0, 0
+        with self.journal_path.open("rb") as f:
+            for raw in f:
+                try:
+                    rec = json.loads(raw)
+                except ValueError:
+                    break  # оборванная запись после сбоя
+                good_bytes += len(raw)
+                if rec["seq"] <= self.seq:
+                    continue
+                apply_ops(state, rec["ops"])
+                self.seq = rec["seq"]
+                self.replayed.append((rec["seq"], rec.get("tag", "")))
+                replayed += 1
+        if good_bytes < self.journal_path.stat().st_size:
+            with self.journal_path.open("r+b") as f:
+                f.truncate(good_bytes)
+            logger.warning(f"[STATE] journal tail truncated at {good_bytes} bytes")
+        self.pending = replayed
+        if replayed:
+            logger.info(f"[STATE] replayed {replayed} journal entries (seq={self.seq})")
+        return state
+
+    def append(self, ops: List[Dict[str, Any]], tag: str = "") -> None:
+        if not ops:
+            return
+        self.seq += 1
+        line = json.dumps({"seq": self.seq, "tag": tag, "ops": ops}, ensure_ascii=False) + "\n"
+        self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.journal_path.open("a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending += 1
+
+    def maybe_snapshot(self, state: Dict[str, Any]) -> None:
+        if self.pending >= self.snapshot_every:
+            self.snapshot(state)
+
+    def snapshot(self, state: Dict[str, Any]) -> None:
+        self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        _write_durable(self.snapshot_path, json.dumps({**state, _SEQ_KEY: self.seq}, ensure_ascii=False, indent=2))
+        _write_durable(self.state_path, json.dumps(state, ensure_ascii=False, indent=2))
+        try:
+            self.journal_path.unlink()
+        except FileNotFoundError:
+            pass
+        self.pending = 0
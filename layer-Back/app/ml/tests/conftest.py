@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import pytest
+import tiktoken
+
+from app.ml import io_utils
+
+
+class _CharEncoder:
+    """Токен = символ: тесты не зависят от загрузки BPE-таблиц tiktoken по сети."""
+
+    def encode(self, text, **kw):
+        return [ord(c) for c in text]
+
+    def decode(self, ids):
+        return "".join(map(chr, ids))
+
+
+@pytest.fixture
+def char_tokens(monkeypatch):
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: _CharEncoder())
+    io_utils.get_encoder.cache_clear()
+    yield
+    io_utils.get_encoder.cache_clear()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import random
+
+from app.ml.batching import build_batches_for_docs, pack_batches_for_docs
+
+
+def _docs(sizes):
+    docs_map = {str(i): [{"chunk_id": 0, "n_tokens": n}] for i, n in enumerate(sizes, 1)}
+    order = list(docs_map)
+    return docs_map, order, {d: [0] for d in order}
+
+
+def _doc_ids(batches):
+    return [[d["doc_id"] for d in b] for b in batches]
+
+
+def test_ffd_reaches_lower_bound_where_sequential_does_not():
+    docs_map, order, include = _docs([6000, 6000, 5000, 5000])
+    report = {}
+    batches = pack_batches_for_docs(docs_map, order, 6, 11000, include, report=report)
+    assert report["sequential"] == 3
+    assert len(batches) == report["lower_bound"] == 2
+    assert report["strategy"] == "clusters"
+    assert _doc_ids(batches) == [["1", "3"], ["2", "4"]]
+    assert [(b["tokens"], b["fill_tokens"], b["fill_files"]) for b in report["batches"]] == [
+        (11000, 1.0, 0.333), (11000, 1.0, 0.333),
+    ]
+
+
+def test_cluster_that_fits_stays_in_one_batch():
+    docs_map, order, include = _docs([1000, 1000, 1000, 1000])
+    report = {}
+    batches = pack_batches_for_docs(docs_map, order, 2, 11000, include, clusters=[["1", "3"], ["2", "4"]], report=report)
+    assert _doc_ids(batches) == [["1", "3"], ["2", "4"]]
+    assert report["split_clusters"] == 0
+
+
+def test_oversized_document_goes_alone():
+    docs_map, order, include = _docs([20000, 500, 500])
+    batches = pack_batches_for_docs(docs_map, order, 6, 11000, include)
+    assert _doc_ids(batches) == [["1"], ["2", "3"]]
+
+
+def test_limits_respected_and_never_worse_than_sequential():
+    rnd = random.Random(7)
+    for _ in range(200):
+        sizes = [rnd.choice([300, 1200, 2500, 4000, 7000, 9000]) for _ in range(rnd.randint(1, 30))]
+        docs_map, order, include = _docs(sizes)
+        ids = list(order)
+        rnd.shuffle(ids)
+        clusters = [ids[i:i + 3] for i in range(0, len(ids), 3)]
+        batches = pack_batches_for_docs(docs_map, order, 6, 11000, include, clusters=clusters)
+        sequential = build_batches_for_docs(docs_map, order, 6, 11000, include)
+        assert len(batches) <= len(sequential)
+        assert sorted(d for b in _doc_ids(batches) for d in b) == sorted(order)
+        for b in batches:
+            toks = sum(ch["n_tokens"] for d in b for ch in d["chunks"])
+            assert len(b) <= 6
+            assert toks <= 11000 or len(b) == 1
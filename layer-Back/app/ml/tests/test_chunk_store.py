@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from app.ml.chunk_store import _VERSION, open_chunk_store
+from app.ml.chunking import chunk_hash
+from app.ml.io_utils import storage_paths
+
+CASE = 7
+
+
+@pytest.fixture
+def case_paths(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # STORAGE_DIR относительный
+    paths = storage_paths(CASE)
+    paths["chunks"].mkdir(parents=True)
+    return paths
+
+
+def _write_doc(paths, doc_id, texts, doc_type="protokol"):
+    with (paths["chunks"] / f"{doc_id}.jsonl").open("w", encoding="utf-8") as f:
+        for i, t in enumerate(texts):
+            rec = {"doc_id": str(doc_id), "title": f"{doc_id}.pdf", "chunk_id": i, "section_id": 0,
+                   "doc_type": doc_type, "heading": "ПРОТОКОЛ допроса" if i == 0 else None, "text": t,
+                   "n_tokens": len(t), "hash": chunk_hash(t), "source_page": i + 1, "page_end": None}
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+
+def _read_all(case_id=CASE):
+    store = open_chunk_store(case_id)
+    try:
+        return {d: store.doc_chunks(d) for d in store.doc_ids()}
+    finally:
+        store.close()
+
+
+def _meta(paths):
+    return json.loads((paths["store"] / "meta.json").read_text(encoding="utf-8"))
+
+
+def test_migrate_then_read_back(case_paths):
+    _write_doc(case_paths, 1, ["первый чанк", "второй — с кириллицей"])
+    _write_doc(case_paths, 2, ["x" * 50], doc_type="raport")
+    docs = _read_all()
+    assert list(docs) == ["1", "2"]
+    first = docs["1"][0]
+    assert first["text"] == "первый чанк" and first["hash"] == chunk_hash("первый чанк")
+    assert first["doc_type"] == "protokol" and first["heading"] == "ПРОТОКОЛ допроса"
+    assert first["source_page"] == 1 and first["page_end"] is None
+    assert docs["1"][1]["heading"] is None
+    assert docs["2"][0]["doc_type"] == "raport"
+
+
+def test_append_new_document_keeps_generation(case_paths):
+    _write_doc(case_paths, 1, ["a1", "a2"])
+    before = _read_all()
+    gen = _meta(case_paths)["gen"]
+
+    _write_doc(case_paths, 2, ["b1"])
+    after = _read_all()
+    assert _meta(case_paths)["gen"] == gen
+    assert after["1"] == before["1"]
+    assert [c["text"] for c in after["2"]] == ["b1"]
+
+    # повторное открытие без изменений ничего не дописывает
+    size = (case_paths["store"] / f"text-{gen}.bin").stat().st_size
+    assert _read_all() == after
+    assert (case_paths["store"] / f"text-{gen}.bin").stat().st_size == size
+
+
+def test_torn_tail_from_interrupted_append_is_ignored(case_paths):
+    _write_doc(case_paths, 1, ["a1"])
+    _read_all()
+    meta = _meta(case_paths)
+    # прерванная дозапись: байты за валидной длиной, meta.json не обновлён
+    with (case_paths["store"] / f"index-{meta['gen']}.bin").open("ab") as f:
+        f.write(b"\xff" * 13)
+    with (case_paths["store"] / f"text-{meta['gen']}.bin").open("ab") as f:
+        f.write(b"garbage")
+    assert [c["text"] for c in _read_all()["1"]] == ["a1"]
+
+    _write_doc(case_paths, 2, ["b1", "b2"])
+    docs = _read_all()
+    assert [c["text"] for c in docs["1"]] == ["a1"]
+    assert [c["text"] for c in docs["2"]] == ["b1", "b2"]
+
+
+def test_changed_document_rebuilds_new_generation(case_paths):
+    _write_doc(case_paths, 1, ["a1"])
+    _write_doc(case_paths, 2, ["b1"])
+    _read_all()
+    gen = _meta(case_paths)["gen"]
+
+    _write_doc(case_paths, 1, ["a1 изменён", "a2"])
+    docs = _read_all()
+    assert _meta(case_paths)["gen"] == gen + 1
+    assert [c["text"] for c in docs["1"]] == ["a1 изменён", "a2"]
+    assert [c["text"] for c in docs["2"]] == ["b1"]
+    names = sorted(p.name for p in case_paths["store"].iterdir())
+    assert names == ["index-%d.bin" % (gen + 1), "meta.json", "text-%d.bin" % (gen + 1)]
+
+
+def test_removed_document_disappears_after_rebuild(case_paths):
+    _write_doc(case_paths, 1, ["a1"])
+    _write_doc(case_paths, 2, ["b1"])
+    _read_all()
+    (case_paths["chunks"] / "2.jsonl").unlink()
+    assert list(_read_all()) == ["1"]
+
+
+def test_outdated_format_version_is_rebuilt(case_paths):
+    _write_doc(case_paths, 1, ["a1"])
+    expected = _read_all()
+    meta = _meta(case_paths)
+    meta["version"] = _VERSION - 1
+    (case_paths["store"] / "meta.json").write_text(json.dumps(meta), encoding="utf-8")
+    assert _read_all() == expected
+    assert _meta(case_paths)["gen"] == meta["gen"] + 1
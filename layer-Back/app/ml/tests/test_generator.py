@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import time
+
+from app.ml import generator
+from app.ml.json_parse import JsonObjectTracker
+
+
+def test_negotiation_does_not_wait_for_unresponsive_replica(monkeypatch):
+    async def hang(url, payload):
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(generator, "_post_json", hang)
+    monkeypatch.setattr(generator, "GEN_PROBE_TIMEOUT", 0.05)
+    monkeypatch.setattr(generator, "_protocol_cache", {})
+    t0 = time.monotonic()
+    result = asyncio.run(generator.negotiate_protocol())
+    assert time.monotonic() - t0 < 1
+    assert result == {b.url: None for b in generator._backends}
+    assert generator._protocol_cache == {}
+
+
+def test_startup_negotiation_runs_in_background(monkeypatch):
+    async def main():
+        probed = asyncio.Event()
+
+        async def slow_probe(url, prompt, n_predict, source):
+            probed.set()
+            await asyncio.sleep(60)
+
+        monkeypatch.setattr(generator, "_probe_protocols", slow_probe)
+        monkeypatch.setattr(generator, "_protocol_cache", {})
+        generator.start_protocol_negotiation()  # не блокирует
+        await asyncio.wait_for(probed.wait(), 1)
+        task = generator._negotiate_task
+        assert task is not None and not task.done()
+        await generator.close_generator_client()
+        assert task.cancelled() and generator._negotiate_task is None
+
+    asyncio.run(main())
+
+
+def _feed(pieces):
+    tracker = JsonObjectTracker()
+    return [tracker.feed(p) for p in pieces]
+
+
+def test_tracker_ignores_braces_inside_strings():
+    assert _feed(['{"desc": "скобки { и } в тексте", ', '"x": "}}}"', "}"]) == [False, False, True]
+
+
+def test_tracker_handles_escaped_quotes_and_backslashes():
+    assert _feed(['{"a": "кавычка \\" и {"', ', "b": "\\\\"', "}"]) == [False, False, True]
+    # экранирование, разорванное между кусками стрима
+    assert _feed(['{"a": "x\\', '"}', '"}']) == [False, False, True]
+
+
+def test_tracker_truncated_object_never_closes():
+    assert _feed(["текст до ", '{"batch_id": "1", "victims_add": [{"name": "А"', "}, {"]) == [False, False, False]
+
+
+def test_tracker_closes_on_first_top_level_object():
+    tracker = JsonObjectTracker()
+    assert tracker.feed('ответ: {"a": {"b": 1}} и хвост {"c": 2}') is True
+    assert tracker.feed("ещё текст") is True
+
+
+class _FakeStream:
+    def __init__(self, lines):
+        self.lines = lines
+        self.consumed = 0
+        self.status_code = 200
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def aiter_lines(self):
+        for line in self.lines:
+            self.consumed += 1
+            yield line
+
+
+class _FakeClient:
+    def __init__(self, lines):
+        self.response = _FakeStream(lines)
+
+    def stream(self, method, url, **kw):
+        return self.response
+
+
+def _sse(*pieces):
+    return [f"data: {json.dumps({'choices': [{'delta': {'content': p}}]})}" for p in pieces] + ["data: [DONE]"]
+
+
+def _stream(monkeypatch, lines, stop_on_json=True):
+    client = _FakeClient(lines)
+
+    async def get_client():
+        return client
+
+    monkeypatch.setattr(generator, "get_generator_client", get_client)
+    text = asyncio.run(generator._stream_text("http://x/v1/chat/completions", {"stream": True}, stop_on_json))
+    return text, client.response.consumed
+
+
+def test_stream_stops_after_object_closes(monkeypatch):
+    stops = generator._pool_stats["stream_early_stops"]
+    text, consumed = _stream(monkeypatch, _sse('{"a": "}"', ', "b": 1} хвост', " лишнее", " ещё"))
+    assert text == '{"a": "}", "b": 1} хвост'
+    assert consumed == 2
+    assert generator._pool_stats["stream_early_stops"] == stops + 1
+
+
+def test_truncated_stream_returns_everything_received(monkeypatch):
+    stops = generator._pool_stats["stream_early_stops"]
+    text, consumed = _stream(monkeypatch, _sse('{"a": [1, ', "2"))
+    assert text == '{"a": [1, 2'
+    assert consumed == 3
+    assert generator._pool_stats["stream_early_stops"] == stops
+
+
+def test_stream_without_json_stop_reads_to_the_end(monkeypatch):
+    text, consumed = _stream(monkeypatch, _sse("{}", " после"), stop_on_json=False)
+    assert text == "{} после"
+    assert consumed == 3
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import json
+import re
+
+from app.ml.grammar import json_schema_to_gbnf, schema_from_example
+from app.ml.prompts import _extraction_schema, extraction_json_schema
+
+
+# ---------- минимальный распознаватель GBNF (подмножество, которое порождает grammar.py) ----------
+_TOKEN = re.compile(r'\s*(?:("(?:[^"\\]|\\.)*")|(\[(?:[^\]\\]|\\.)*\])|([()|*?+])|([a-zA-Z][\w-]*))')
+_ESC = {"n": "\n", "t": "\t", "r": "\r", "\\": "\\", '"': '"', "/": "/", "]": "]", "[": "[", "-": "-", "^": "^"}
+
+
+def _unescape(s):
+    out, i = [], 0
+    while i < len(s):
+        if s[i] == "\\":
+            if s[i + 1] == "x":
+                out.append(chr(int(s[i + 2:i + 4], 16))); i += 4
+            else:
+                out.append(_ESC[s[i + 1]]); i += 2
+        else:
+            out.append(s[i]); i += 1
+    return out
+
+
+def _char_class(body):
+    neg = body.startswith("^")
+    chars = _unescape(body[1:] if neg else body)
+    ranges, i = [], 0
+    while i < len(chars):
+        if i + 2 < len(chars) and chars[i + 1] == "-":
+            ranges.append((chars[i], chars[i + 2])); i += 3
+        else:
+            ranges.append((chars[i], chars[i])); i += 1
+    return ("class", neg, ranges)
+
+
+def _parse_body(body):
+    toks = [m.groups() for m in _TOKEN.finditer(body) if any(m.groups())]
+    pos = [0]
+
+    def alt():
+        options = [seq()]
+        while pos[0] < len(toks) and toks[pos[0]][2] == "|":
+            pos[0] += 1
+            options.append(seq())
+        return ("alt", options)
+
+    def seq():
+        items = []
+        while pos[0] < len(toks) and toks[pos[0]][2] not in ("|", ")"):
+            lit, cls, op, ref = toks[pos[0]]
+            pos[0] += 1
+            if lit:
+                node = ("lit", "".join(_unescape(lit[1:-1])))
+            elif cls:
+                node = _char_class(cls[1:-1])
+            elif ref:
+                node = ("ref", ref)
+            else:  # "("
+                node = alt()
+                pos[0] += 1  # ")"
+            if pos[0] < len(toks) and toks[pos[0]][2] in ("*", "?", "+"):
+                node = (toks[pos[0]][2], node)
+                pos[0] += 1
+            items.append(node)
+        return ("seq", items)
+
+    return alt()
+
+
+def _matches(grammar, text):
+    rules = {}
+    for line in grammar.splitlines():
+        if line.strip():
+            name, body = line.split("::=", 1)
+            rules[name.strip()] = _parse_body(body)
+
+    def m(node, i):
+        kind = node[0]
+        if kind == "lit":
+            if text.startswith(node[1], i):
+                yield i + len(node[1])
+        elif kind == "class":
+            if i < len(text):
+                hit = any(lo <= text[i] <= hi for lo, hi in node[2])
+                if hit != node[1]:
+                    yield i + 1
+        elif kind == "ref":
+            yield from m(rules[node[1]], i)
+        elif kind == "alt":
+            for option in node[1]:
+                yield from m(option, i)
+        elif kind == "seq":
+            yield from seq(node[1], 0, i)
+        elif kind == "?":
+            yield from m(node[1], i)
+            yield i
+        elif kind in ("*", "+"):
+            for j in m(node[1], i):
+                if j > i:
+                    yield from m(("*", node[1]), j)
+            if kind == "*":
+                yield i
+
+    def seq(items, k, i):
+        if k == len(items):
+            yield i
+            return
+        for j in m(items[k], i):
+            yield from seq(items, k + 1, j)
+
+    return any(end == len(text) for end in m(rules["root"], 0))
+
+
+def _nullify(value):
+    if isinstance(value, dict):
+        return {k: _nullify(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_nullify(v) for v in value]
+    return None
+
+
+def _scalar_types(schema, path="$"):
+    if schema["type"] == "object":
+        for k, sub in schema["properties"].items():
+            yield from _scalar_types(sub, f"{path}.{k}")
+    elif schema["type"] == "array":
+        yield from _scalar_types(schema["items"], f"{path}[]")
+    else:
+        yield path, schema["type"]
+
+
+# ---------- schema_from_example ----------
+def test_schema_from_example_shapes():
+    schema = schema_from_example({"name": "", "n": 0, "ok": False, "x": None, "tags": [], "items": [{"a": 1.5}]})
+    assert schema["required"] == ["name", "n", "ok", "x", "tags", "items"]
+    assert schema["additionalProperties"] is False
+    props = schema["properties"]
+    assert props["name"] == {"type": ["string", "null"]}
+    assert props["n"] == {"type": ["number", "null"]}
+    assert props["ok"] == {"type": ["boolean", "null"]}
+    assert props["x"] == {"type": ["string", "null"]}
+    assert props["tags"] == {"type": "array", "items": {"type": "string"}}  # doc_refs и т.п.: элементы — строки
+    assert props["items"]["items"]["properties"]["a"] == {"type": ["number", "null"]}
+
+
+def test_every_extraction_scalar_is_nullable():
+    for section in ("vmf", "rest"):
+        fields = {p: t for p, t in _scalar_types(extraction_json_schema(section)) if not p.endswith("[]")}
+        assert [p for p, t in fields.items() if "null" not in t] == []
+    assert "null" in dict(_scalar_types(extraction_json_schema("rest")))["$.events_add[].date"]
+    assert "null" in dict(_scalar_types(extraction_json_schema("vmf")))["$.money_flows_add[].from"]
+
+
+# ---------- json_schema_to_gbnf ----------
+def test_gbnf_rules_are_all_defined():
+    grammar = json_schema_to_gbnf(extraction_json_schema("vmf"))
+    defined = {line.split("::=")[0].strip() for line in grammar.splitlines() if "::=" in line}
+    body = "\n".join(line.split("::=", 1)[1] for line in grammar.splitlines() if "::=" in line)
+    body = re.sub(r'"(?:[^"\\]|\\.)*"|\[(?:[^\]\\]|\\.)*\]', "", body)
+    assert set(re.findall(r"[a-zA-Z][\w-]*", body)) <= defined
+    assert grammar.startswith("root ::= ws ")
+
+
+def test_gbnf_follows_schema():
+    grammar = json_schema_to_gbnf(schema_from_example({"id": "", "n": 0, "refs": [], "sub": {"ok": False}}))
+    assert _matches(grammar, '{"id": "a\\"b", "n": -1.5e3, "refs": ["x", "y"], "sub": {"ok": true}}')
+    assert _matches(grammar, '{ "id":null,"n":null,"refs":[],"sub":{"ok":null} }\n')
+    assert not _matches(grammar, '{"id": "a", "n": 1, "refs": []}')  # нет ключа
+    assert not _matches(grammar, '{"id": "a", "n": 1, "refs": [null], "sub": {"ok": true}}')
+    assert not _matches(grammar, '{"n": 1, "id": "a", "refs": [], "sub": {"ok": true}}')  # порядок ключей
+    assert not _matches(grammar, '{"id": "a", "n": "1", "refs": [], "sub": {"ok": true}}')  # тип
+    assert not _matches(grammar, '{"id": "a", "n": 1, "refs": [], "sub": {"ok": true}, "extra": 1}')
+
+
+def test_gbnf_accepts_section_examples_with_nulls():
+    for section in ("vmf", "rest"):
+        grammar = json_schema_to_gbnf(extraction_json_schema(section))
+        example = json.loads(_extraction_schema(section))
+        assert _matches(grammar, json.dumps(example, ensure_ascii=False))
+        assert _matches(grammar, json.dumps(_nullify(example), ensure_ascii=False))
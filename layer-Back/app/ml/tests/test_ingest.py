@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import pytest
+
+from app.ml import ingest
+from app.ml.io_utils import storage_paths
+
+PAGES = [("ПРОТОКОЛ допроса\n" if i in (0, 4) else "") + f"страница {i} " + "текст " * 60 for i in range(9)]
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch, char_tokens):
+    """
+    Приём в каталоге tmp_path: пул потоков вместо процессного (spawn не видит подмен),
+    PDF — список PAGES, диапазоны по 2 страницы.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ingest, "_jobs", OrderedDict())
+    monkeypatch.setattr(ingest, "content_index", ingest.ContentIndex(tmp_path / "_content_index.json"))
+    pool = ThreadPoolExecutor(4)
+    monkeypatch.setattr(ingest, "get_ingest_pool", lambda: pool)
+    monkeypatch.setattr(ingest, "is_pdf", lambda fn, ct: fn.endswith(".pdf"))
+    monkeypatch.setattr(ingest, "pdf_page_count", lambda p: len(PAGES))
+    monkeypatch.setattr(ingest, "extract_pdf_pages", lambda p, a, b: PAGES[a:b])
+    monkeypatch.setattr(ingest, "INGEST_PAGES_PER_TASK", 2)
+    paths = storage_paths(1)
+    for k in ("raw", "docs", "chunks", "ingest"):
+        paths[k].mkdir(parents=True, exist_ok=True)
+    yield paths
+    pool.shutdown()
+
+
+def _file(paths, doc_id, filename, data=None, same_as=None):
+    raw = paths["raw"] / f"{doc_id}_{filename}"
+    raw.write_bytes(data if data is not None else f"{filename}\n".encode() + "\n".join(PAGES).encode())
+    return {"doc_id": doc_id, "filename": filename, "content_type": "", "raw_path": str(raw),
+            "raw_sha": hashlib.sha256(raw.read_bytes()).hexdigest(), "same_as": same_as}
+
+
+def _run(files, on_failed=None):
+    async def go():
+        job = ingest.start_ingest_job(1, files, on_failed=on_failed)
+        assert ingest.ingest_active(1)
+        while ingest.ingest_active(1):
+            await asyncio.sleep(0.01)
+        return job
+    return asyncio.run(go())
+
+
+def test_job_moves_through_states(env, monkeypatch):
+    seen = []
+    save = ingest._save_job
+    monkeypatch.setattr(ingest, "_save_job", lambda job: (seen.append(job["status"]), save(job)))
+
+    job = _run([_file(env, 1, "a.pdf"), _file(env, 2, "b.txt")])
+
+    assert seen[0] == "queued" and seen[1] == "running" and seen[-1] == "done"
+    assert set(seen[1:-1]) == {"running"}
+    assert (job["done"], job["failed"], job["total"]) == (2, 0, 2)
+    assert job["started_at"] <= job["finished_at"]
+    assert [f["status"] for f in job["files"]] == ["done", "done"]
+    assert job["files"][0]["pages_total"] == job["files"][0]["pages_done"] == len(PAGES)
+    assert all(f["chunks"] > 0 and f["error"] is None for f in job["files"])
+    assert not (env["ingest"] / "spool").exists() or not any((env["ingest"] / "spool").iterdir())
+
+    # после рестарта статус читается с диска; список заданий — без пофайловых деталей
+    ingest._jobs.clear()
+    assert ingest.get_ingest_job(1, job["job_id"])["status"] == "done"
+    assert ingest.get_ingest_job(2, job["job_id"]) is None
+    assert [j["job_id"] for j in ingest.list_ingest_jobs(1)] == [job["job_id"]]
+    assert "files" not in ingest.list_ingest_jobs(1)[0]
+
+
+def test_failed_worker_marks_file_and_reports_it(env, monkeypatch):
+    def extract(path, start, stop):
+        if "bad" in path:
+            raise ValueError("битый PDF")
+        return PAGES[start:stop]
+
+    monkeypatch.setattr(ingest, "extract_pdf_pages", extract)
+    dropped = []
+    job = _run([_file(env, 1, "a.pdf"), _file(env, 2, "bad.pdf")], on_failed=dropped.extend)
+
+    assert job["status"] == "partial"
+    assert (job["done"], job["failed"]) == (1, 1)
+    bad = job["files"][1]
+    assert bad["status"] == "error" and bad["error"].startswith("ValueError")
+    assert dropped == [2]
+    assert not (env["chunks"] / "2.jsonl").exists()
+
+
+def test_all_failed_and_callback_errors_are_contained(env, monkeypatch):
+    monkeypatch.setattr(ingest, "extract_pdf_pages", lambda p, a, b: 1 / 0)
+
+    def on_failed(ids):
+        raise RuntimeError("БД недоступна")
+
+    job = _run([_file(env, 1, "a.pdf"), _file(env, 2, "b.pdf")], on_failed=on_failed)
+    assert job["status"] == "failed"
+    assert all(f["error"].startswith("ZeroDivisionError") for f in job["files"])
+    assert not ingest.ingest_active(1)
+
+
+def test_broken_pool_is_recreated(env, monkeypatch):
+    def extract(path, start, stop):
+        raise BrokenProcessPool("worker died")
+
+    monkeypatch.setattr(ingest, "extract_pdf_pages", extract)
+    monkeypatch.setattr(ingest, "_pool", object())
+    job = _run([_file(env, 1, "a.pdf")])
+    assert job["status"] == "failed"
+    assert ingest._pool is None
+
+
+def _sections(chunks):
+    return [(c["section_id"], c["doc_type"], c["heading"]) for c in chunks]
+
+
+@pytest.mark.parametrize("step", [1, 2, 3, 4, 5, 100])
+def test_page_ranges_give_the_same_document(env, monkeypatch, step):
+    # пустые страницы 2–3 образуют целый пустой диапазон при step=2, заголовок на странице 4 —
+    # то в начале диапазона, то в середине
+    pages = list(PAGES)
+    pages[2] = pages[3] = "  \n\n "
+    monkeypatch.setattr(ingest, "extract_pdf_pages", lambda p, a, b: pages[a:b])
+    monkeypatch.setattr(ingest, "INGEST_PAGES_PER_TASK", step)
+    job = _run([_file(env, 1, "a.pdf")])
+    assert job["status"] == "done" and job["files"][0]["pages_done"] == len(pages)
+
+    text = (env["docs"] / "1_a.pdf.txt").read_text(encoding="utf-8")
+    assert text == "\n".join(c for c in map(ingest.clean_text, pages) if c)
+    assert job["files"][0]["chars"] == len(text)
+
+    chunks = [json.loads(line) for line in (env["chunks"] / "1.jsonl").open(encoding="utf-8")]
+    assert [c["chunk_id"] for c in chunks] == list(range(len(chunks)))
+    assert sorted(set(_sections(chunks))) == [(0, chunks[0]["doc_type"], chunks[0]["heading"]),
+                                              (1, chunks[-1]["doc_type"], chunks[-1]["heading"])]
+    assert chunks[0]["doc_type"] == chunks[-1]["doc_type"] != "unknown"
+    assert [c["section_id"] for c in chunks] == sorted(c["section_id"] for c in chunks)
+    # вторая секция начинается ровно со страницы заголовка
+    assert min(c["source_page"] for c in chunks if c["section_id"] == 1) == 5
+    # чанк не пересекает границу диапазона, страницы идут по порядку и покрывают весь текст
+    for c in chunks:
+        assert (c["source_page"] - 1) // step == (c["page_end"] - 1) // step
+    assert [c["source_page"] for c in chunks] == sorted(c["source_page"] for c in chunks)
+    covered = {p for c in chunks for p in range(c["source_page"], c["page_end"] + 1)}
+    assert covered == {i + 1 for i, t in enumerate(pages) if ingest.clean_text(t)}
+
+
+def test_parts_are_merged_in_page_order(env, monkeypatch):
+    # поздние диапазоны завершаются первыми
+    def extract(path, start, stop):
+        time.sleep(0.02 * (len(PAGES) - start))
+        return PAGES[start:stop]
+
+    monkeypatch.setattr(ingest, "extract_pdf_pages", extract)
+    _run([_file(env, 1, "a.pdf")])
+    monkeypatch.setattr(ingest, "extract_pdf_pages", lambda p, a, b: PAGES[a:b])
+    monkeypatch.setattr(ingest, "INGEST_PAGES_PER_TASK", len(PAGES))
+    _run([_file(env, 2, "b.pdf")])
+
+    assert (env["docs"] / "1_a.pdf.txt").read_text(encoding="utf-8") == (env["docs"] / "2_b.pdf.txt").read_text(encoding="utf-8")
+    chunks = [json.loads(line) for line in (env["chunks"] / "1.jsonl").open(encoding="utf-8")]
+    assert [c["chunk_id"] for c in chunks] == list(range(len(chunks)))
+    assert [c["source_page"] for c in chunks] == sorted(c["source_page"] for c in chunks)
+    assert "".join(c["text"] for c in chunks if c["source_page"] == 1).startswith("ПРОТОКОЛ")
+
+
+def _spy(monkeypatch, name):
+    calls = []
+    fn = getattr(ingest, name)
+    monkeypatch.setattr(ingest, name, lambda *a: (calls.append(a), fn(*a))[1])
+    return calls
+
+
+def _chunk_texts(paths, doc_id):
+    return [(c["text"], c["section_id"], c["source_page"]) for c in map(json.loads, (paths["chunks"] / f"{doc_id}.jsonl").open(encoding="utf-8"))]
+
+
+def test_text_duplicate_is_not_chunked(env, monkeypatch):
+    _run([_file(env, 1, "a.pdf")])
+    chunked = _spy(monkeypatch, "chunk_spool")
+    # другие байты, тот же очищенный текст
+    texts = {"b.pdf": [p.replace("текст ", "текст  ") for p in PAGES], "c.pdf": [p + " иной" for p in PAGES]}
+    monkeypatch.setattr(ingest, "extract_pdf_pages", lambda p, a, b: texts[Path(p).name.split("_", 1)[1]][a:b])
+    job = _run([_file(env, 2, "b.pdf", data=b"other bytes")])
+
+    rec = job["files"][0]
+    assert rec["status"] == "done" and rec["dedup"] == "text"
+    assert chunked == []
+    assert _chunk_texts(env, 2) == _chunk_texts(env, 1)
+    assert {json.loads(line)["doc_id"] for line in (env["chunks"] / "2.jsonl").open(encoding="utf-8")} == {"2"}
+    assert (env["docs"] / "2_b.pdf.txt").read_text(encoding="utf-8") == (env["docs"] / "1_a.pdf.txt").read_text(encoding="utf-8")
+    assert ingest.scan_path(env["chunks"], 2).exists()
+
+    # новый текст режется как обычно
+    job = _run([_file(env, 3, "c.pdf", data=b"c")])
+    assert job["files"][0].get("dedup") is None
+    assert len(chunked) == -(-len(PAGES) // 2)
+
+
+def test_raw_duplicate_skips_extraction_and_reuses_the_original_file(env, monkeypatch):
+    first = _file(env, 1, "a.pdf")
+    _run([first])
+    spooled = _spy(monkeypatch, "spool_pages")
+    src = ingest.original_raw({"case_id": 1, "doc_id": 1})
+    assert src == env["raw"] / "1_a.pdf"
+
+    dup = dict(first, doc_id=2, filename="copy.pdf", raw_path=str(src), same_as={"case_id": 1, "doc_id": 1})
+    job = _run([dup])
+    rec = job["files"][0]
+    assert rec["status"] == "done" and rec["dedup"] == "raw"
+    assert spooled == []
+    assert _chunk_texts(env, 2) == _chunk_texts(env, 1)
+    assert (env["docs"] / "2_copy.pdf.txt").exists()
+    # своей копии сырых байт у дубля нет
+    assert sorted(p.name for p in env["raw"].iterdir()) == ["1_a.pdf"]
+    assert ingest.original_raw({"case_id": 1, "doc_id": 2}) is None
+
+
+def test_raw_duplicate_falls_back_to_processing_when_original_is_gone(env, monkeypatch):
+    first = _file(env, 1, "a.pdf")
+    _run([first])
+    (env["chunks"] / "1.jsonl").unlink()
+    dup = dict(first, doc_id=2, filename="copy.pdf", same_as={"case_id": 1, "doc_id": 1})
+    job = _run([dup])
+    rec = job["files"][0]
+    assert rec["status"] == "done" and rec.get("dedup") is None and rec["chunks"] > 0
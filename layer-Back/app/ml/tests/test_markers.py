@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import random
+
+import pytest
+
+from app.ml import markers
+from app.ml.markers import cluster_docs_by_markers, extract_markers_from_text, scan_chunk_text
+
+_LEGACY = (markers.IIN_RE, markers.PHONE_RE, markers.IBAN_RE, markers.CARD_RE, markers.EMAIL_RE, markers.TG_RE)
+
+
+def _legacy_markers(text):
+    """Прежнее извлечение — шесть раздельных регулярок; без «@домена» внутри e-mail (сознательное отличие)."""
+    emails = [(m.start(), m.end()) for m in markers.EMAIL_RE.finditer(text)]
+    out = set()
+    for rx in _LEGACY:
+        for m in rx.finditer(text):
+            if rx is markers.TG_RE and any(a < m.start() < b for a, b in emails):
+                continue
+            out.add(m.group().strip())
+    return out
+
+
+def test_chained_markers_form_one_cluster():
+    doc_markers = {"1": {"a"}, "2": {"a", "b"}, "3": {"b", "c"}, "4": {"c"}, "5": {"z"}}
+    assert cluster_docs_by_markers(doc_markers, max_size=0) == [["1", "2", "3", "4"], ["5"]]
+
+
+def test_hub_marker_does_not_link():
+    # телефон следователя встречается в 6 из 12 документов: лимит max(5, int(0.3·12)) = 5
+    doc_markers = {str(i): {"hub"} for i in range(1, 13) if i <= 6}
+    doc_markers.update({str(i): set() for i in range(7, 13)})
+    doc_markers["1"].add("pair")
+    doc_markers["10"].add("pair")
+    report = {}
+    clusters = cluster_docs_by_markers(doc_markers, hub_df=0.3, max_size=0, report=report)
+    assert report["hub_limit"] == 5
+    assert report["suppressed_markers"] == {"hub": 6}
+    assert ["1", "10"] in clusters
+    assert len(clusters) == 11
+
+
+def test_max_size_rejects_merge_and_reports_it():
+    doc_markers = {"1": {"rare", "common"}, "2": {"rare", "common"}, "3": {"common"}}
+    report = {}
+    clusters = cluster_docs_by_markers(doc_markers, hub_df=1.0, max_size=2, report=report)
+    # редкий маркер склеивает первым, общий упирается в лимит
+    assert clusters == [["1", "2"], ["3"]]
+    assert report["graph"] == {"rare": ["1", "2"]}
+    assert report["rejected_by_size"] == [("common", "1", "3")]
+
+
+def test_clusters_ordered_by_min_doc_id():
+    doc_markers = {"10": {"x"}, "2": {"y"}, "9": {"y"}, "3": {"x"}, "1": set()}
+    assert cluster_docs_by_markers(doc_markers, max_size=0) == [["1"], ["2", "9"], ["3", "10"]]
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("контакт @ivan@mail.kz", {"@ivan", "ivan@mail.kz"}),
+    ("почта 900101300001@mail.kz", {"900101300001", "900101300001@mail.kz"}),
+    ("0)7011234567 1239@mail.kz 4400 4301 1234 1111\n701123456709", {"4400 4301 1234 1111", "701123456709"}),
+    ("a9+7123 701 4400 4301 1234 1111", {"+7123 701 4400", "4400 4301 1234 1111"}),
+    ("тг @user_1 и KZ123456789012345678", {"@user_1", "KZ123456789012345678"}),
+])
+def test_overlapping_markers_are_all_found(text, expected):
+    found = extract_markers_from_text(text)
+    assert expected <= found
+    assert found == _legacy_markers(text)
+    assert "@mail" not in found
+
+
+def test_scanner_matches_legacy_regexes():
+    toks = ["@", "ivan", "@mail.kz", "mail.kz", "ivan@mail.kz", " ", "\n", "+7", "8", " 701 ", "7011234567", "123", "45",
+            "-", "(", ")", "900101300001", "4400 4301 1234 1111", "4400430112341111", "KZ", "123456789012345678",
+            "kz12345678901234567a", "_", "a.b", "x", "%", "ПОСТАНОВЛЕНИЕ о признании лица потерпевшим", "0", "1", "9"]
+    rnd = random.Random(0)
+    for _ in range(5000):
+        text = "".join(rnd.choice(toks) for _ in range(rnd.randint(1, 12)))
+        assert extract_markers_from_text(text) == _legacy_markers(text), text
+        assert ("postanov" in scan_chunk_text(text)["tags"]) == bool(markers.POSTANOV_RE.search(text))
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import json
+import random
+
+import pytest
+
+from app.ml.merge import StateList, VictimIndex, merge_victims, link_money_flows_to_victims
+from app.ml.pattern_match import AhoCorasick
+from app.ml.state_store import StateTracker, apply_ops
+
+
+def _victim(**kw):
+    v = {"doc_refs": [], "steps": [], "platform_accounts": [], "confidence": 0.5}
+    v.update(kw)
+    return v
+
+
+def test_shared_identifier_bridges_two_records():
+    state = {"victims": []}
+    index = VictimIndex(state["victims"])
+    merge_victims(state, [_victim(name="Иванов Иван", phone="+7 701 111 22 33", doc_refs=["doc:1#chunk:0"])], index=index)
+    merge_victims(state, [_victim(email="ivanov@mail.kz", damage_tenge=500000, doc_refs=["doc:2#chunk:0"])], index=index)
+    assert len(state["victims"]) == 2
+
+    # запись с телефоном первой и e-mail второй склеивает обе в одну сущность
+    touched = set()
+    added = merge_victims(state, [_victim(phone="87011112233", email="IVANOV@mail.kz", doc_refs=["doc:3#chunk:1"])],
+                          touched=touched, index=index)
+    assert added == 0
+    assert len(state["victims"]) == 1
+    v = state["victims"][0]
+    assert v["name"] and v["email"] == "ivanov@mail.kz" and v["damage_tenge"] == 500000
+    assert v["_doc_ids"] == ["1", "2", "3"]
+    assert index.lookup("email:ivanov@mail.kz") == 0
+    assert index.lookup(f"phone:{v['phone']}") == 0
+
+
+def test_transitive_merge_through_later_identifier():
+    state = {"victims": []}
+    index = VictimIndex(state["victims"])
+    merge_victims(state, [_victim(name="Петров Петр", iin="900101300001")], index=index)
+    # новый телефон присоединяется к сущности через ИИН ...
+    merge_victims(state, [_victim(iin="900101300001", phone="+77015556677")], index=index)
+    # ... и дальше сущность находится уже по телефону
+    merge_victims(state, [_victim(phone="8 701 555 66 77", iban="KZ123456789012345678")], index=index)
+    assert len(state["victims"]) == 1
+    assert state["victims"][0]["iban"] == "KZ123456789012345678"
+    assert index.lookup("iban:KZ123456789012345678") == 0
+
+
+def test_conflicting_iin_is_not_merged():
+    state = {"victims": []}
+    index = VictimIndex(state["victims"])
+    merge_victims(state, [_victim(name="Сидоров Сидор", iin="900101300001")], index=index)
+    merge_victims(state, [_victim(name="Сидоров Сидор", iin="850505400002")], index=index)
+    assert len(state["victims"]) == 2
+    assert {v["iin"] for v in state["victims"]} == {"900101300001", "850505400002"}
+
+
+def test_namesakes_with_different_identifiers_are_not_merged():
+    state = {"victims": []}
+    index = VictimIndex(state["victims"])
+    merge_victims(state, [_victim(name="Иванов Иван Иванович", phone="+77011112233", doc_refs=["doc:1#chunk:0"])], index=index)
+    merge_victims(state, [_victim(name="Иванов Иван Иванович", phone="+77019998877", doc_refs=["doc:2#chunk:0"])], index=index)
+    merge_victims(state, [_victim(name="Иванов Иван Иванович", email="ivanov@mail.kz", dob="01.02.1990")], index=index)
+    assert len(state["victims"]) == 3
+    assert index.lookup("phone:+77011112233") == 0 and index.lookup("phone:+77019998877") == 1
+    assert index.lookup("name:Иванов Иван Иванович") is None
+
+    # запись без сильных идентификаторов сливается с такой же, но не мостит однофамильцев
+    merge_victims(state, [_victim(name="Петров Петр", doc_refs=["doc:3#chunk:0"])], index=index)
+    merge_victims(state, [_victim(name="Петров Петр", doc_refs=["doc:4#chunk:0"])], index=index)
+    assert len(state["victims"]) == 4
+    assert state["victims"][3]["_doc_ids"] == ["3", "4"]
+
+    # запись-мост не склеивает сущности с расходящейся датой рождения
+    merge_victims(state, [_victim(phone="+77019998877", email="ivanov@mail.kz", dob="05.05.1985")], index=index)
+    assert len(state["victims"]) == 4
+    assert [v.get("dob") for v in state["victims"][1:3]] == ["05.05.1985", "01.02.1990"]
+
+
+def test_persistent_index_matches_rebuilt_index():
+    state = {"victims": []}
+    index = VictimIndex(state["victims"])
+    batches = [
+        [_victim(name="А А", phone="+77010000001"), _victim(name="Б Б", email="b@x.kz")],
+        [_victim(phone="+77010000001", email="a@x.kz"), _victim(name="В В", iin="900101300003")],
+        [_victim(email="a@x.kz", iin="900101300004"), _victim(email="b@x.kz", phone="+77010000002")],
+        [_victim(phone="+77010000002", iin="900101300003")],  # склеивает Б и В
+    ]
+    for b in batches:
+        merge_victims(state, b, index=index)
+    fresh = VictimIndex(state["victims"])
+    for i, v in enumerate(state["victims"]):
+        for x in ("iin", "email", "phone"):
+            if v.get(x):
+                key = f"{x}:{v[x]}"
+                assert index.lookup(key) == fresh.lookup(key) == i
+    assert len(state["victims"]) == 2
+
+
+def _linked_state():
+    state = {"victims": [], "money_flows": []}
+    merge_victims(state, [
+        _victim(name="Иванов Иван", phone="+77011112233", doc_refs=["doc:1#chunk:0"]),
+        _victim(name="Петров Петр", email="petrov@mail.kz", doc_refs=["doc:2#chunk:0"]),
+        _victim(name="Сидоров Сидор", iban="KZ123456789012345678", doc_refs=["doc:2#chunk:1"]),
+    ])
+    return state, {v["name"]: v["_key"] for v in state["victims"]}
+
+
+def test_money_flows_link_by_identifier_in_text():
+    state, keys = _linked_state()
+    state["money_flows"] = [
+        {"from": "карта, тел. +77011112233", "to": "OKX"},
+        {"from": "PETROV@mail.kz", "to": "кошелёк USDT"},
+        {"from": "счёт kz123456789012345678", "to": "P2P"},
+        {"from": "неизвестный", "to": "OKX"},
+    ]
+    link_money_flows_to_victims(state)
+    assert [mf.get("victim_key") for mf in state["money_flows"]] == [
+        keys["Иванов Иван"], keys["Петров Петр"], keys["Сидоров Сидор"], None,
+    ]
+
+
+def test_money_flow_document_overlap_outweighs_text_match():
+    state, keys = _linked_state()
+    # тот же документ (+3) и имя в from (+2) против одного телефона чужого потерпевшего (+2)
+    state["money_flows"] = [{"from": "Сидоров Сидор, тел +77011112233", "to": "OKX", "doc_refs": ["doc:2#chunk:1"]}]
+    link_money_flows_to_victims(state)
+    assert state["money_flows"][0]["victim_key"] == keys["Сидоров Сидор"]
+
+
+def test_money_flow_ties_go_to_earlier_victim():
+    state, keys = _linked_state()
+    state["money_flows"] = [{"from": "перевод", "to": "OKX", "doc_refs": ["doc:2#chunk:0"]}]
+    link_money_flows_to_victims(state)
+    assert state["money_flows"][0]["victim_key"] == keys["Петров Петр"]
+
+
+def test_aho_corasick_reports_overlapping_patterns():
+    ac = AhoCorasick(["he", "she", "hers", "his", "he"])
+    assert ac.patterns == ["he", "she", "hers", "his"]
+    found = sorted((pos, ac.patterns[pid]) for pos, pid in ac.iter_matches("ushers"))
+    assert found == [(3, "he"), (3, "she"), (5, "hers")]
+    assert ac.find_ids("this") == {ac.pattern_id("his")}
+
+
+def _baseline_merge_list(dst, incoming, limit):
+    """Прежний мердж списков state: дедуп по JSON, при переполнении — стабильная сортировка по confidence и обрезка."""
+    added = 0
+    seen = {json.dumps(x, sort_keys=True) for x in dst}
+    for it in incoming:
+        s = json.dumps(it, sort_keys=True)
+        if s not in seen:
+            dst.append(it); seen.add(s); added += 1
+    if limit is not None and len(dst) > limit:
+        dst.sort(key=lambda x: x.get("confidence", 0), reverse=True)
+        del dst[limit:]
+    return added
+
+
+def _as_set(items):
+    return sorted(json.dumps(x, sort_keys=True, ensure_ascii=False) for x in items)
+
+
+def test_state_list_ties_at_cutoff_keep_earlier_items():
+    items = []
+    sl = StateList(items, "events", limit=3)
+    ev = [{"type": "перевод", "date": "2024-01-01", "desc": f"e{k}", "confidence": c}
+          for k, c in enumerate([0.5, 0.5, 0.5, 0.5, 0.6, 0.5])]
+    touched = set()
+    assert sl.merge(ev[:4], touched) == 3
+    assert [e["desc"] for e in items] == ["e0", "e1", "e2"]  # e3 с равным confidence не вытесняет
+    sl.merge(ev[4:], touched)
+    assert sorted(e["desc"] for e in items) == ["e0", "e1", "e4"]  # вытеснен самый поздний из равных
+    assert touched == {2}
+    baseline = []
+    _baseline_merge_list(baseline, ev[:4], 3)
+    _baseline_merge_list(baseline, ev[4:], 3)
+    assert _as_set(baseline) == _as_set(items)
+
+
+@pytest.mark.parametrize("limit", [5, 30])
+def test_state_list_matches_baseline_merge(limit):
+    rnd = random.Random(limit)
+    pool = [{"type": rnd.choice(["перевод", "регистрация"]), "date": f"2024-01-{k % 28 + 1:02d}", "desc": f"событие {k}",
+             "doc_refs": [f"doc:{k % 7}#chunk:0"], "confidence": rnd.choice([0.2, 0.5, 0.5, 0.8, 0.8, 1.0])}
+            for k in range(120)]
+    state = {"events": []}
+    mirror = {"events": []}
+    sl = StateList(state["events"], "events", limit=limit)
+    baseline = []
+    for _ in range(150):
+        batch = [dict(rnd.choice(pool)) for _ in range(rnd.randint(1, 10))]
+        tracker = StateTracker(state, ["events"])
+        touched = set()
+        added = sl.merge(json.loads(json.dumps(batch)), touched)
+        _baseline_merge_list(baseline, json.loads(json.dumps(batch)), limit)
+        assert _as_set(state["events"]) == _as_set(baseline)
+        # дельта в журнал воспроизводит список позиционно
+        apply_ops(mirror, json.loads(json.dumps(tracker.ops(state, {"events": added}, {"events": touched}))))
+        assert mirror == state
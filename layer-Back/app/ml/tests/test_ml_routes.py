@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from datetime import date
+
+import pytest
+
+pytest.importorskip("jose")      # app.security
+pytest.importorskip("psycopg2")  # engine для DATABASE_URL из .env создаётся при импорте app.db
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.db.database import Base, get_db
+from app.ml import ingest
+from app.models.cases import CaseModel, DocumentModel
+from app.models.user import User
+from app.routes import ml as ml_routes
+from app.security.security import get_current_user
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """In-memory SQLite вместо Postgres; _drop_failed_documents открывает свою сессию — подменяем SessionLocal."""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    monkeypatch.setattr(ml_routes, "SessionLocal", Session)
+    monkeypatch.setattr(ingest, "_jobs", OrderedDict())
+    s = Session()
+    user = User(username="следователь", hashed_password="x")
+    s.add(user)
+    s.flush()
+    case = CaseModel(case_number="1", user_id=user.id, surname="Иванов", name="Иван", iin="000000000000")
+    s.add(case)
+    s.flush()
+    for title in ("a.pdf", "b.pdf", "c.pdf"):
+        s.add(DocumentModel(case_id=case.id, weaviate_id="", title=title, created_at=date.today()))
+    s.commit()
+    yield s
+    s.close()
+
+
+@pytest.fixture
+def client(db):
+    app = FastAPI()
+    app.include_router(ml_routes.router)
+    user = db.query(User).first()
+    app.dependency_overrides[get_db] = lambda: db
+    app.dependency_overrides[get_current_user] = lambda: user
+    return TestClient(app)
+
+
+def _case_id(db):
+    return db.query(CaseModel).first().id
+
+
+def test_prompt_is_refused_while_ingest_is_active(client, db, monkeypatch):
+    case_id = _case_id(db)
+
+    async def run_pipeline(*a, **kw):
+        raise AssertionError("пайплайн не должен стартовать посреди приёма")
+
+    monkeypatch.setattr(ml_routes, "run_pipeline", run_pipeline)
+    for status in ("queued", "running"):
+        ingest._jobs["j"] = {"job_id": "j", "case_id": case_id, "status": status}
+        assert client.get(f"/cases/{case_id}/prompt").status_code == 409
+
+    # задание по другому делу не мешает
+    ingest._jobs["j"] = {"job_id": "j", "case_id": case_id + 1, "status": "running"}
+
+    async def done(*a, **kw):
+        return {"ok": True}
+
+    monkeypatch.setattr(ml_routes, "run_pipeline", done)
+    r = client.get(f"/cases/{case_id}/prompt")
+    assert r.status_code == 200 and r.json() == {"ok": True}
+
+
+def test_ingest_job_status_route(client, db):
+    case_id = _case_id(db)
+    ingest._jobs["j"] = {"job_id": "j", "case_id": case_id, "status": "running", "created_at": 1, "files": []}
+    assert client.get(f"/cases/{case_id}/ingest/j").json()["status"] == "running"
+    assert client.get(f"/cases/{case_id}/ingest/nope").status_code == 404
+    assert [j["job_id"] for j in client.get(f"/cases/{case_id}/ingest").json()["jobs"]] == ["j"]
+
+
+def test_drop_failed_documents(db):
+    ids = [d.id for d in db.query(DocumentModel).order_by(DocumentModel.id)]
+    ml_routes._drop_failed_documents(ids[1:])
+    db.expire_all()
+    assert [d.id for d in db.query(DocumentModel)] == ids[:1]
+    # освобождённые места снова доступны в лимите дела
+    assert len(db.query(CaseModel).first().documents) == 1
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import random
+import re
+
+import pytest
+
+from app.ml import pipeline
+from app.ml.io_utils import storage_paths
+
+NAMES = ["Иванов Иван Иванович", "Петров Петр Петрович", "Сидоров Сидор Сидорович", "Ахметов Асан Болатович"]
+
+
+def _doc_chunks(d, rnd):
+    out = []
+    for c in range(rnd.randint(1, 4)):
+        head = "ПОСТАНОВЛЕНИЕ о признании лица потерпевшим\n" if (d % 3 == 0 and c == 0) else ""
+        text = (head + f"Документ {d} чанк {c}. Потерпевший {NAMES[d % 4]} 01.02.1990 перевёл 150000 тенге. "
+                f"тел +7 701 123 45 {d % 3:02d} iban KZ12345678901234567{d % 2} email a{d % 2}@x.kz " + "текст " * rnd.randint(50, 300))
+        out.append({"doc_id": str(d), "title": f"d{d}.pdf", "chunk_id": c, "section_id": 0,
+                    "doc_type": "postanovlenie" if head else "unknown", "heading": None, "text": text, "n_tokens": len(text)})
+    return out
+
+
+def write_doc(case_id, d, chunks):
+    path = storage_paths(case_id)["chunks"] / f"{d}.jsonl"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("".join(json.dumps(ch, ensure_ascii=False) + "\n" for ch in chunks), encoding="utf-8")
+
+
+def write_case(case_id=1, ndocs=12, seed=0):
+    rnd = random.Random(seed)
+    for d in range(1, ndocs + 1):
+        write_doc(case_id, d, _doc_chunks(d, rnd))
+
+
+class FakeLLM:
+    """Детерминированные ответы по секциям промпта; fail_after — «падение» генератора после N вызовов."""
+
+    def __init__(self):
+        self.labels = []
+        self.prompts = []
+        self.fail_after = None
+
+    async def __call__(self, prompt, n_predict, label="", **kw):
+        if self.fail_after is not None and len(self.labels) >= self.fail_after:
+            raise RuntimeError("generator down")
+        self.labels.append(label)
+        self.prompts.append(prompt)
+        m = re.search(r'"batch_id":"([^"]+)"', prompt)
+        bid = m.group(1) if m else "x"
+        docs = re.findall(r"## DOC doc_id=(\d+)", prompt)
+        if "-vmf" in label:
+            return json.dumps({
+                "batch_id": bid,
+                "victims_add": [{"name": f"Жертва Д{d}", "iin": None, "phone": f"+7701000{int(d) % 5:04d}",
+                                 "doc_refs": [f"doc:{d}#chunk:0"], "confidence": 0.5} for d in docs],
+                "money_flows_add": [{"amount": 1000 * int(d), "from": f"Жертва Д{d}", "to": "OKX",
+                                     "doc_refs": [f"doc:{d}#chunk:0"], "confidence": 0.4} for d in docs],
+            }, ensure_ascii=False)
+        if "-rest" in label:
+            return json.dumps({
+                "batch_id": bid, "meta_add": {"erdr": "123456789012345"},
+                "actors_add": [{"name": f"Актор {d}", "role": ["организатор"], "doc_refs": [f"doc:{d}#chunk:0"], "confidence": 0.6} for d in docs],
+                "events_add": [{"type": "перевод", "date": "2024-01-01", "desc": f"событие {d}", "doc_refs": [], "confidence": 0.3} for d in docs],
+            }, ensure_ascii=False)
+        return "\n\n".join(f"Абзац {k} о деле (см. doc:1#chunk:0) " + "слово " * 80 for k in range(14))
+
+    def reset(self):
+        self.labels.clear()
+        self.prompts.clear()
+        self.fail_after = None
+
+    def extract_jobs(self):
+        """Ключи заданий манифеста (P1-3-vmf) по меткам вызовов, включая дробления P1-3.2-vmf / P1-3.S2-vmf."""
+        keys = set()
+        for label in self.labels:
+            m = re.fullmatch(r"EXTRACT (\w+)-(\d+)(?:\.S?\d+)?-(\w+)", label)
+            if m:
+                keys.add(f"{m.group(1)}-{m.group(2)}-{m.group(3)}")
+        return keys
+
+
+@pytest.fixture
+def llm(tmp_path, monkeypatch, char_tokens):
+    monkeypatch.chdir(tmp_path)
+    fake = FakeLLM()
+    monkeypatch.setattr(pipeline, "safe_call_generator", fake)
+    return fake
+
+
+def run(case_id=1, **kw):
+    return asyncio.run(pipeline.run_pipeline(case_id, **kw))
+
+
+def public_state(case_id=1):
+    return json.loads(storage_paths(case_id)["state"].read_text(encoding="utf-8"))
+
+
+def comparable(result):
+    return {k: v for k, v in result.items() if k != "state_path"}
+
+
+@pytest.mark.parametrize("window", [1, 3])
+@pytest.mark.parametrize("stop_at", [3, 9, -2])
+def test_interrupted_run_resumes_where_it_stopped(llm, monkeypatch, stop_at, window):
+    monkeypatch.setattr(pipeline, "EXTRACT_CONCURRENCY", window)
+    write_case(1)
+    write_case(2)
+    ref = run(1)
+    n_ref = len(llm.labels)
+
+    llm.reset()
+    llm.fail_after = stop_at % n_ref
+    with pytest.raises(RuntimeError):
+        run(2)
+    done = set(json.loads(storage_paths(2)["manifest"].read_text(encoding="utf-8"))["done"])
+    assert done
+
+    llm.reset()
+    res = run(2)
+    assert not llm.extract_jobs() & done  # завершённые вызовы не повторяются
+    assert len(llm.labels) < n_ref
+    ref_cmp, res_cmp = comparable(ref), comparable(res)
+    ref_cmp["case_id"] = res_cmp["case_id"] = None
+    assert res_cmp == ref_cmp
+    ref_state, res_state = public_state(1), public_state(2)
+    ref_state["case_meta"]["case_id"] = res_state["case_meta"]["case_id"] = None
+    assert res_state == ref_state
+
+    # завершённый прогон без изменений не вызывает генератор вовсе
+    llm.reset()
+    assert comparable(run(2)) == comparable(res)
+    assert llm.labels == []
+
+
+def sent_chunks(llm):
+    """(doc_id, chunk_id), отправленные в промптах экстракции."""
+    out = set()
+    for label, prompt in zip(llm.labels, llm.prompts):
+        if label.startswith("EXTRACT"):
+            for block in prompt.split("## DOC doc_id=")[1:]:
+                doc_id = block.split("\n", 1)[0]
+                out.update((doc_id, int(c)) for c in re.findall(r"^\[chunk (\d+)\]$", block, re.M))
+    return out
+
+
+@pytest.mark.parametrize("change", ["added", "edited"])
+def test_only_new_or_changed_document_is_reanalysed(llm, monkeypatch, change):
+    monkeypatch.setattr(pipeline, "INCREMENTAL_NEIGHBOURS", 2)
+    write_case(1, ndocs=16, seed=3)
+    run(1)
+    victims_before = public_state(1)["victims"]
+
+    llm.reset()
+    rnd = random.Random(7)
+    target = "17" if change == "added" else "5"
+    chunks = _doc_chunks(int(target), rnd)
+    for ch in chunks:
+        ch["text"] += " Новиков Николай Николаевич перевёл 5000 тенге на карту 4400 4300 1234 5678"
+    write_doc(1, target, chunks)
+    res = run(1)
+
+    assert res["incremental_docs"] == 1
+    sent = sent_chunks(llm)
+    assert {c for d, c in sent if d == target} == {ch["chunk_id"] for ch in chunks}
+    # соседи по кластеру — только первым чанком и не больше INCREMENTAL_NEIGHBOURS
+    others = {(d, c) for d, c in sent if d != target}
+    assert all(c == 0 for _, c in others)
+    assert len(others) <= 2
+    # прежние факты сохранены, новый документ их дополняет
+    victims_after = public_state(1)["victims"]
+    assert len(victims_after) >= len(victims_before)
+
+    # повторный запуск без изменений — ни одного вызова
+    llm.reset()
+    run(1)
+    assert llm.labels == []
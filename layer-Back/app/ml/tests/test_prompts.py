@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from app.ml import prompts
+from app.ml.config import UST_STATE_CAPS
+from app.ml.io_utils import count_tokens
+
+
+def _state(n=150):
+    return {
+        "case_meta": {"erdr": "123456789012345"},
+        "victims": [{"name": f"Потерпевший {i:03d}", "damage_tenge": 1000 * i, "doc_refs": [f"doc:{i}#chunk:0"],
+                     "confidence": (i % 10) / 10} for i in range(n)],
+        "events": [{"type": "перевод", "desc": f"событие {i}", "doc_refs": [], "confidence": 0.9} for i in range(n)],
+        "money_flows": [{"amount": i, "from": "x" * 300, "to": "OKX", "doc_refs": [], "confidence": 0.1} for i in range(n)],
+        "actors": [{"name": f"Актор {i}", "role": ["организатор"], "doc_refs": [], "confidence": 0.5} for i in range(n)],
+        "pyramid_indicators": [], "mechanism_bullets": [], "offense_articles": [],
+    }
+
+
+def _min_caps():
+    return {k: min(UST_STATE_CAPS.get(k, 0), prompts._UST_MIN_CAPS[k]) for k in prompts._UST_FIT_ORDER}
+
+
+def _fit(monkeypatch, state, room):
+    """room — сколько токенов сверх промпта с минимальными caps."""
+    base = count_tokens(prompts.make_ustanovil_prompt(state, caps={**UST_STATE_CAPS, **_min_caps()}))
+    monkeypatch.setattr(prompts, "MAX_MODEL_LEN", base + room + prompts.SYSTEM_BUDGET + 1000)
+    prompt, caps = prompts.fit_ustanovil_prompt(state, predict_budget=1000)
+    return prompt, caps, base + room
+
+
+@pytest.mark.usefixtures("char_tokens")
+def test_minimum_caps_are_kept_even_without_room(monkeypatch):
+    state = _state()
+    prompt, caps, _ = _fit(monkeypatch, state, room=-500)
+    assert {k: caps[k] for k in prompts._UST_FIT_ORDER} == _min_caps()
+    top = sorted(state["victims"], key=prompts._score_item, reverse=True)[:_min_caps()["victims"]]
+    assert all(v["name"] in prompt for v in top)
+
+
+@pytest.mark.usefixtures("char_tokens")
+@pytest.mark.parametrize("room", [0, 50, 400, 3000, 20000, 200000])
+def test_token_budget_is_never_exceeded(monkeypatch, room):
+    state = _state()
+    prompt, caps, budget = _fit(monkeypatch, state, room)
+    assert count_tokens(prompt) <= budget
+    assert all(caps[k] >= v for k, v in _min_caps().items())
+    assert all(caps[k] <= UST_STATE_CAPS[k] for k in prompts._UST_FIT_ORDER)
+    assert prompt == prompts.make_ustanovil_prompt(state, caps=caps)
+
+
+@pytest.mark.usefixtures("char_tokens")
+def test_higher_value_per_token_is_added_first(monkeypatch):
+    state = _state()
+    _, caps, _ = _fit(monkeypatch, state, room=3000)
+    mins = _min_caps()
+    # дешёвые события с высокой уверенностью добираются раньше длинных слабых денежных потоков
+    assert caps["events"] > mins["events"]
+    assert caps["money_flows"] == mins["money_flows"]
+    # с запасом по контексту берётся всё до UST_STATE_CAPS
+    _, caps, _ = _fit(monkeypatch, state, room=10 ** 6)
+    assert caps["money_flows"] == min(len(state["money_flows"]), UST_STATE_CAPS["money_flows"])
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from app.ml import generator
+from app.ml.json_parse import is_complete_json
+from app.ml.response_cache import ResponseCache, bypass_cache
+
+
+@pytest.fixture
+def gen(tmp_path, monkeypatch):
+    """safe_call_generator поверх кэша во временном каталоге; вызовы генератора считаются."""
+    g = SimpleNamespace(cache=ResponseCache(tmp_path / "gen_cache", 1 << 20), calls=[], fail=set(), reply='{"batch_id": "1"}')
+
+    async def try_once(label, prompt, n_predict, retries=3, stream_json=False, json_schema=None, cache_hint=None):
+        g.calls.append(n_predict)
+        if n_predict in g.fail:
+            raise generator.TimeoutException("timeout")
+        return g.reply
+
+    monkeypatch.setattr(generator, "GEN_CACHE_ENABLED", True)
+    monkeypatch.setattr(generator, "response_cache", g.cache)
+    monkeypatch.setattr(generator, "_try_once", try_once)
+    return g
+
+
+def _call(**kw):
+    kw.setdefault("fallback_predict", [800, 400])
+    return asyncio.run(generator.safe_call_generator("промпт", 1000, **kw))
+
+
+def test_get_put_hit_and_miss(tmp_path):
+    cache = ResponseCache(tmp_path, 1 << 20)
+    assert cache.get("k1") is None
+    cache.put("k1", "ответ")
+    assert cache.get("k1") == "ответ"
+    assert cache.get("k2") is None
+    assert (cache.stats["hits"], cache.stats["misses"], cache.stats["writes"]) == (1, 2, 1)
+    # индекс восстанавливается с диска
+    assert ResponseCache(tmp_path, 1 << 20).get("k1") == "ответ"
+
+
+def test_repeat_call_is_served_from_cache(gen):
+    assert _call() == gen.reply
+    assert _call() == gen.reply
+    assert gen.calls == [1000]
+
+
+def test_key_depends_on_schema_stream_and_guardrails(gen, monkeypatch):
+    _call()
+    _call(json_schema={"type": "object"})
+    _call(stream_json=True)
+    monkeypatch.setattr(generator, "GUARDRAIL_VERSION", "other")
+    _call()
+    assert gen.calls == [1000] * 4
+    _call(json_schema={"type": "object"})
+    assert len(gen.calls) == 5  # схема + новая версия guardrails — тоже другой ключ
+
+
+def test_fallback_answer_is_cached_under_its_own_n_predict(gen):
+    gen.fail = {1000}
+    _call()
+    assert gen.calls == [1000, 800]
+    _call()
+    # основной размер снова промахивается в кэш, ответ 800 берётся из кэша
+    assert gen.calls == [1000, 800, 1000]
+    gen.fail = set()
+    assert _call() == gen.reply
+    assert gen.calls == [1000, 800, 1000, 1000]
+
+
+def test_only_validated_answers_are_cached(gen):
+    gen.reply = '{"batch_id": "1", "victims_add": [{"name"'
+    _call(cache_ok=is_complete_json)
+    _call(cache_ok=is_complete_json)
+    assert gen.calls == [1000, 1000]
+    assert gen.cache.stats["writes"] == 0
+
+
+def test_bypass_reads_nothing_but_refreshes_entry(gen):
+    _call()
+    gen.reply = '{"batch_id": "2"}'
+
+    async def fresh_run():
+        # как run_pipeline(fresh=True): флаг наследуют задачи, созданные внутри прогона
+        with bypass_cache(True):
+            return await asyncio.gather(generator.safe_call_generator("промпт", 1000, fallback_predict=[]))
+
+    assert asyncio.run(fresh_run()) == ['{"batch_id": "2"}']
+    assert gen.calls == [1000, 1000]
+    assert gen.cache.stats["bypassed"] == 1
+    assert _call() == '{"batch_id": "2"}'
+    assert gen.calls == [1000, 1000]
+
+
+def test_lru_eviction_by_mtime(tmp_path):
+    cache = ResponseCache(tmp_path, 1 << 20)
+    for i, key in enumerate(("a", "b", "c")):
+        cache.put(key, "x" * 100)
+        os.utime(tmp_path / f"{key}.json", (1000 + i, 1000 + i))
+    size = (tmp_path / "a.json").stat().st_size
+
+    # новый процесс: порядок берётся из mtime файлов; чтение «a» делает её свежей
+    cache = ResponseCache(tmp_path, int(3.5 * size))  # три записи, четвёртая не влезает
+    assert cache.get("a") is not None
+    cache.put("d", "x" * 100)
+    assert sorted(p.stem for p in tmp_path.glob("*.json")) == ["a", "c", "d"]
+    assert cache.stats["evictions"] == 1
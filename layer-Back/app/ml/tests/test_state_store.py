@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import json
+
+from app.ml.state_store import StateJournal, StateTracker, apply_ops
+
+
+def _default():
+    return {"case_meta": {"erdr": None}, "victims": [], "events": []}
+
+
+def _merge(journal, state, victims=(), events=(), patch=None, tag=""):
+    """Мердж как в пайплайне: StateTracker до изменения, дельта в журнал после."""
+    tracker = StateTracker(state, ["victims", "events"])
+    touched = {}
+    if patch:
+        idx, value = patch
+        state["victims"][idx] = value
+        touched["victims"] = {idx}
+    state["victims"].extend(victims)
+    state["events"].extend(events)
+    ops = tracker.ops(state, {"victims": len(victims), "events": len(events)}, touched, set_keys=["case_meta"])
+    journal.append(ops, tag)
+    return ops
+
+
+def test_replay_after_truncated_last_line(tmp_path):
+    path = tmp_path / "global_state.json"
+    j = StateJournal(path, snapshot_every=100)
+    state = j.load(_default())
+    _merge(j, state, victims=[{"name": "А"}], tag="P1-1")
+    _merge(j, state, events=[{"desc": "e1"}], tag="P1-2")
+    _merge(j, state, patch=(0, {"name": "А", "iin": "900101300001"}), tag="P1-3")
+    good_size = j.journal_path.stat().st_size
+    with j.journal_path.open("ab") as f:
+        f.write(b'{"seq": 4, "tag": "P1-4", "ops": [{"op": "ext')  # сбой посреди записи
+
+    j2 = StateJournal(path, snapshot_every=100)
+    restored = j2.load(_default())
+    assert restored == state
+    assert j2.seq == 3
+    assert [tag for _, tag in j2.replayed] == ["P1-1", "P1-2", "P1-3"]
+    assert j2.journal_path.stat().st_size == good_size
+
+    # журнал после обрезки снова дописывается с правильного seq
+    _merge(j2, restored, events=[{"desc": "e2"}], tag="P1-4")
+    j3 = StateJournal(path, snapshot_every=100)
+    assert j3.load(_default()) == restored
+    assert j3.seq == 4
+
+
+def test_snapshot_then_replay(tmp_path):
+    path = tmp_path / "global_state.json"
+    j = StateJournal(path, snapshot_every=2)
+    state = j.load(_default())
+    _merge(j, state, victims=[{"name": "А"}])
+    _merge(j, state, victims=[{"name": "Б"}])
+    j.maybe_snapshot(state)
+    assert not j.journal_path.exists()
+    assert json.loads(j.snapshot_path.read_text(encoding="utf-8"))["_journal_seq"] == 2
+    # публичная копия — то же состояние без служебных полей
+    assert json.loads(path.read_text(encoding="utf-8")) == state
+
+    _merge(j, state, events=[{"desc": "после снапшота"}], tag="P2-1")
+    j2 = StateJournal(path, snapshot_every=2)
+    assert j2.load(_default()) == state
+    assert j2.replayed == [(3, "P2-1")]
+    assert j2.pending == 1
+
+
+def test_entries_already_in_snapshot_are_not_applied_twice(tmp_path):
+    path = tmp_path / "global_state.json"
+    j = StateJournal(path, snapshot_every=100)
+    state = j.load(_default())
+    _merge(j, state, victims=[{"name": "А"}])
+    _merge(j, state, events=[{"desc": "e1"}])
+    stale = j.journal_path.read_bytes()
+    j.snapshot(state)
+    # сбой между rename снапшота и удалением журнала: старые записи остались
+    j.journal_path.write_bytes(stale)
+    _merge(j, state, events=[{"desc": "e2"}], tag="P1-3")
+
+    j2 = StateJournal(path, snapshot_every=100)
+    restored = j2.load(_default())
+    assert restored == state
+    assert len(restored["events"]) == 2
+    assert j2.replayed == [(3, "P1-3")]
+
+
+def test_legacy_snapshot_in_public_file_is_loaded(tmp_path):
+    path = tmp_path / "global_state.json"
+    legacy = {**_default(), "victims": [{"name": "А"}], "_journal_seq": 1}
+    path.write_text(json.dumps(legacy, ensure_ascii=False), encoding="utf-8")
+    j = StateJournal(path, snapshot_every=100)
+    state = j.load(_default())
+    assert j.seq == 1 and "_journal_seq" not in state
+    _merge(j, state, victims=[{"name": "Б"}])
+    j.snapshot(state)
+    assert "_journal_seq" not in json.loads(path.read_text(encoding="utf-8"))
+    assert StateJournal(path).load(_default()) == state
+
+
+def test_tracker_writes_whole_list_when_indices_shift():
+    state = {"victims": [{"n": 1}, {"n": 2}]}
+    before = json.loads(json.dumps(state))
+    tracker = StateTracker(state, ["victims"])
+    state["victims"].append({"n": 3})
+    state["victims"].sort(key=lambda v: -v["n"])
+    del state["victims"][2:]
+    ops = tracker.ops(state, {"victims": 1})
+    assert ops == [{"op": "set", "key": "victims", "value": [{"n": 3}, {"n": 2}]}]
+    apply_ops(before, ops)
+    assert before == state
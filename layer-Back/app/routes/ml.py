@@ -2,24 +2,29 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException, Depends
 from sqlalchemy.orm import Session
 from datetime import datetime, timezone
-from typing import List
+from typing import Dict, List
 import json
+import hashlib
 import logging
 from pathlib import Path
 
-from app.db.database import get_db
+from app.db.database import get_db, SessionLocal
 from app.security.security import get_current_user
 from app.models.cases import CaseModel, DocumentModel
 from app.models.user import User
 
 # локальные модули
 from app.ml.config import logger, STORAGE_DIR
-from app.ml.io_utils import clean_text, extract_text, count_tokens, storage_paths, write_json
-from app.ml.chunking import chunk_text
+from app.ml.io_utils import storage_paths
+from app.ml.ingest import start_ingest_job, get_ingest_job, list_ingest_jobs, ingest_active, content_index, original_raw
 from app.ml.pipeline import run_pipeline
+from app.ml.generator import generator_pool_stats, generator_protocol_status, generator_backend_stats
+from app.ml.response_cache import response_cache
 
 router = APIRouter()
 
+UPLOAD_SPOOL_BLOCK = 1 << 20  # 1 МБ
+
 def validate_case(case_id: int, user_id: int, db: Session) -> CaseModel:
     case = db.query(CaseModel).filter(
         CaseModel.id == case_id,
@@ -43,20 +48,18 @@ async def upload_documents(
         raise HTTPException(status_code=400, detail="Превышен лимит документов (100)")
 
     paths = storage_paths(case_id)
-    for p in [paths["docs"], paths["chunks"], paths["state_dir"]]:
+    for p in [paths["raw"], paths["docs"], paths["chunks"], paths["state_dir"]]:
         p.mkdir(parents=True, exist_ok=True)
 
-    processed = 0
-    for file in files:
-        try:
-            content = await file.read()
-            text = extract_text(file, content)
-            cleaned = clean_text(text)
-            tok_count = count_tokens(cleaned)
-            logger.info(f"[UPLOAD] file='{file.filename}', type='{file.content_type}', len={len(cleaned)}, tokens={tok_count}")
-
+    # только сохраняем сырые байты; извлечение/чанкинг — фоновое задание в процессном пуле
+    accepted = []
+    seen: Dict[str, Dict[str, int]] = {}
+    part_path = None
+    try:
+        for file in files:
+            filename = Path(file.filename or "file").name
             doc = DocumentModel(
-                title=file.filename,
+                title=filename,
                 filetype=file.content_type or "text/plain",
                 created_at=datetime.now(timezone.utc),
                 case_id=case.id
@@ -64,30 +67,75 @@ async def upload_documents(
             db.add(doc)
             db.flush()
 
-            # сохраняем .txt
-            (paths["docs"] / f"{doc.id}_{file.filename}.txt").write_text(cleaned, encoding="utf-8")
-
-            # чанки -> .jsonl
-            chunks = chunk_text(cleaned)
-            with (paths["chunks"] / f"{doc.id}.jsonl").open("w", encoding="utf-8") as f:
-                for ch in chunks:
-                    rec = {"doc_id": str(doc.id), "title": file.filename, **ch}
-                    f.write(json.dumps(rec, ensure_ascii=False) + "\n")
-
-            processed += 1
-        except Exception as e:
-            logger.exception(f"[UPLOAD] error '{file.filename}': {e}")
-            db.rollback()
-            raise HTTPException(status_code=500, detail=f"Ошибка обработки {file.filename}: {e}")
-
-    try:
+            # спулим во временный файл кусками, не держа весь файл в памяти; sha256 — по ходу записи
+            raw_path = paths["raw"] / f"{doc.id}_{filename}"
+            part_path = paths["raw"] / f".{doc.id}_{filename}.part"
+            size = 0
+            sha = hashlib.sha256()
+            with part_path.open("wb") as f:
+                while True:
+                    block = await file.read(UPLOAD_SPOOL_BLOCK)
+                    if not block:
+                        break
+                    f.write(block)
+                    sha.update(block)
+                    size += len(block)
+            raw_sha = sha.hexdigest()
+
+            # точный дубль (в любом деле или в этом же запросе) — чанки будут скопированы без обработки,
+            # вторая копия байтов в raw/ не сохраняется (если файл оригинала на месте)
+            same_as = content_index.lookup_raw(raw_sha) or seen.get(raw_sha)
+            src_raw = original_raw(same_as) if same_as else None
+            if src_raw is not None:
+                part_path.unlink()
+                raw_path = src_raw
+            else:
+                os.replace(part_path, raw_path)
+            seen.setdefault(raw_sha, {"case_id": case_id, "doc_id": doc.id})
+            accepted.append({
+                "doc_id": doc.id, "filename": filename, "content_type": file.content_type or "",
+                "raw_path": str(raw_path), "raw_sha": raw_sha, "same_as": same_as,
+            })
+            logger.info(f"[UPLOAD] stored file='{filename}', type='{file.content_type}', bytes={size}, doc_id={doc.id}" + (f", duplicate of {same_as}" if same_as else ""))
         db.commit()
     except Exception as e:
-        logger.exception(f"[UPLOAD] DB commit error: {e}")
+        logger.exception(f"[UPLOAD] error storing files: {e}")
         db.rollback()
-        raise HTTPException(status_code=500, detail="Ошибка сохранения в БД")
+        if part_path is not None:
+            part_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=500, detail=f"Ошибка сохранения файлов: {e}")
+
+    job = start_ingest_job(case_id, accepted, on_failed=_drop_failed_documents)
+    return {
+        "message": f"Принято {len(accepted)} документов, обработка в фоне",
+        "job_id": job["job_id"],
+        "documents": [{"doc_id": a["doc_id"], "filename": a["filename"]} for a in accepted],
+        "duplicates": [{"doc_id": a["doc_id"], "filename": a["filename"], "same_as": a["same_as"]} for a in accepted if a["same_as"]],
+    }
+
+def _drop_failed_documents(doc_ids: List[int]) -> None:
+    """Документы, которые не удалось разобрать, не должны занимать лимит дела."""
+    db = SessionLocal()
+    try:
+        db.query(DocumentModel).filter(DocumentModel.id.in_(doc_ids)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+@router.get("/cases/{case_id}/ingest")
+async def ingest_jobs(case_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    validate_case(case_id, current_user.id, db)
+    return {"jobs": list_ingest_jobs(case_id)}
+
+@router.get("/cases/{case_id}/ingest/{job_id}")
+async def ingest_job_status(case_id: int, job_id: str, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    """Прогресс задания приёма: статус и ошибки по каждому файлу."""
+    validate_case(case_id, current_user.id, db)
+    job = get_ingest_job(case_id, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    return job
 
-    return {"message": f"Загружено и проиндексировано {processed} документов"}
 import time,os
 
 # можно задать лимит логируемого payload через .env
@@ -96,16 +144,19 @@ LOG_PAYLOAD_MAX = int(os.getenv("LOG_PAYLOAD_MAX", "20000"))  # 20k символ
 @router.get("/cases/{case_id}/prompt")
 async def generate_and_analyze_prompt(
     case_id: int,
+    fresh: bool = False,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
     t0 = time.monotonic()
-    logger.info(f"[RUN] start: case_id={case_id}, user_id={current_user.id}")
+    logger.info(f"[RUN] start: case_id={case_id}, user_id={current_user.id}, fresh={fresh}")
 
     validate_case(case_id, current_user.id, db)
+    if ingest_active(case_id):
+        raise HTTPException(status_code=409, detail="Документы дела ещё обрабатываются, повторите позже")
 
     try:
-        res = await run_pipeline(case_id)
+        res = await run_pipeline(case_id, fresh=fresh)
     except Exception as e:
         logger.exception(f"[RUN] failed: case_id={case_id}, user_id={current_user.id}")
         raise
@@ -131,4 +182,14 @@ async def generate_and_analyze_prompt(
     # если хочешь гарантированно увидеть в docker-логах даже при другой конфигурации логгера:
     # print(f"[DONE] case_id={case_id} user_id={current_user.id} time={dt:.3f}s\n{pretty_to_log}", flush=True)
 
-    return res
\ No newline at end of file
+    return res
+
+@router.get("/generator/status")
+async def generator_status(current_user: User = Depends(get_current_user)):
+    """Состояние клиента генератора: реплики, пул соединений, согласованная схема API, кэш ответов."""
+    return {
+        "backends": generator_backend_stats(),
+        "pool": generator_pool_stats(),
+        "protocols": generator_protocol_status(),
+        "cache": response_cache.summary(),
+    }